@@ -0,0 +1,215 @@
+"""
+Asyncio API for roam orbit
+
+For services which handle review clicks on an event loop, eg: with aiohttp or
+Starlette. Blocks are parsed and processed on an executor, so the event loop
+isn't blocked, and:
+
+- updates to the same block uid are processed one after the other, and the
+  responses which wait while one is processed are merged: the block is parsed
+  once, gets all of the responses in order and is rendered once. They all
+  return the new block string. If one of them is invalid, the others are
+  still applied, one at a time, and only its caller gets the error
+- updates are versioned by a content hash of their block string. The new
+  string of each update is remembered, so a click on a version of the block
+  which was already updated, eg: two clicks on the same string, is a stale
+  write. It's applied on top of the latest version instead of overwriting it,
+  so no response is lost
+- at most max_concurrency blocks are processed at once. Other updates wait
+  for one to finish, so a burst of clicks queues up instead of flooding the
+  executor
+- at most max_pending updates wait or are processed at once, across all
+  blocks. Callers of other updates wait for one of them to finish, so the
+  queue of a burst of clicks is bounded
+
+    orbiter = AsyncOrbiter(max_concurrency=8)
+    text = await orbiter.process_response(text, 0, uid="abcdefghi")
+    result = await orbiter.process_record(request_body)
+"""
+import asyncio
+from collections import OrderedDict
+from roam_orbit import main, process_responses, parse_record, record_error
+from due_index import content_hash
+
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_MAX_VERSIONS = 10000
+DEFAULT_MAX_PENDING = 1000
+
+
+class AsyncOrbiter:
+    """Runs roam orbit actions from an event loop
+
+    Attributes:
+        stale_writes (int): number of updates whose block string was an old
+            version of the block, and which were applied to the latest one
+    Args:
+        executor (concurrent.futures.Executor): where blocks are processed.
+            Defaults to the event loop's default executor, a thread pool. A
+            ProcessPoolExecutor processes blocks on several cores
+        max_concurrency (int): at most this many blocks are processed at once
+        max_versions (int): number of updates whose new block string is
+            remembered to detect stale writes
+        max_pending (int): at most this many updates wait to be processed or
+            are processed at once
+    """
+    def __init__(self, executor=None, max_concurrency=DEFAULT_MAX_CONCURRENCY, max_versions=DEFAULT_MAX_VERSIONS,
+                 max_pending=DEFAULT_MAX_PENDING):
+        self.executor = executor
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.pending = asyncio.Semaphore(max_pending)
+        self.max_versions = max_versions
+        self.stale_writes = 0
+        # uid -> updates waiting, (text, action, arg, seed, future) in the order they arrived
+        self._waiting = {}
+        # uid -> task processing the updates to the block
+        self._tasks = {}
+        # (uid, content hash) -> the block string it was updated to
+        self._versions = OrderedDict()
+
+    async def main(self, text, action, arg=None, uid=None, seed=0, text_hash=None):
+        """roam_orbit.main without blocking the event loop
+
+        Updates with a uid are versioned, and their responses merged, see
+        the module docstring.
+
+        Args:
+            text_hash (str): content_hash of `text` in hex, if the client sends it.
+                Raises ValueError if it doesn't match
+        Returns:
+            str: the new block string
+        """
+        if text_hash is not None and text_hash!=content_hash(text).hex():
+            raise ValueError("the hash doesn't match the block string")
+        async with self.pending:
+            if uid is None:
+                return await self._run(main, text, action, arg, uid, seed)
+            update = (text, action, arg, seed, asyncio.get_running_loop().create_future())
+            self._waiting.setdefault(uid, []).append(update)
+            if uid not in self._tasks:
+                self._tasks[uid] = asyncio.create_task(self._process_block(uid))
+            try:
+                return await update[-1]
+            finally:
+                # Don't keep the update of a caller who gave up until its block is processed
+                waiting = self._waiting.get(uid, [])
+                for i in range(len(waiting)):
+                    if waiting[i] is update:
+                        del waiting[i]
+                        break
+
+    async def process_response(self, text, response_num, uid=None, seed=0, text_hash=None):
+        "RoamOrbiterManager.process_response on a block string without blocking the event loop"
+        return await self.main(text, "add_response", response_num, uid, seed, text_hash)
+
+    async def process_record(self, record):
+        """roam_orbit.process_record without blocking the event loop
+
+        Records can also have the "hash" of their text, in hex. Records with a "uid"
+        are versioned like in `main`
+        """
+        try:
+            record = parse_record(record)
+            text = await self.main(record["text"], record["action"], record.get("arg"),
+                                   record.get("uid"), record.get("seed", 0), record.get("hash"))
+            return {"text": text, "error": None}
+        except Exception as e:
+            return record_error(record, e)
+
+    def latest_version(self, uid, text):
+        """Return the latest version of a block which was updated from `text`
+
+        Returns `text` if it wasn't updated. A block which is edited back to
+        a string it had before is taken to be that old version.
+        """
+        seen = set()
+        while True:
+            key = (uid, content_hash(text))
+            if key not in self._versions or key in seen:
+                return text
+            seen.add(key)
+            text = self._versions[key]
+
+    async def _run(self, func, *args):
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _process_block(self, uid):
+        "Process the updates to a block until none are waiting"
+        updates = []
+        try:
+            while uid in self._waiting:
+                # Skip the updates whose callers gave up
+                updates = [update for update in self._waiting.pop(uid) if not update[-1].done()]
+                while updates:
+                    batch, updates = self._next_batch(uid, updates)
+                    await self._process_batch(uid, batch)
+        except asyncio.CancelledError:
+            for update in updates + self._waiting.pop(uid, []):
+                update[-1].cancel()
+            raise
+        finally:
+            del self._tasks[uid]
+
+    def _next_batch(self, uid, updates):
+        """Split off the first update, and the responses after it which can be
+        merged with it: on the same version of the block and with the same seed
+        """
+        text, action, _, seed, _ = updates[0]
+        latest = self.latest_version(uid, text)
+        end = 1
+        if action=="add_response":
+            while end < len(updates) and updates[end][1]=="add_response" and updates[end][3]==seed \
+                    and self.latest_version(uid, updates[end][0])==latest:
+                end += 1
+        return updates[:end], updates[end:]
+
+    async def _process_batch(self, uid, batch):
+        text, action, arg, seed, _ = batch[0]
+        latest = self.latest_version(uid, text)
+        self.stale_writes += sum(self.latest_version(uid, update[0])!=update[0] for update in batch)
+        errors = [None]*len(batch)
+        try:
+            if action=="add_response":
+                try:
+                    result = await self._run(process_responses, latest, [update[2] for update in batch], uid, seed)
+                except Exception as e:
+                    if len(batch)==1:
+                        raise
+                    # Apply the responses one at a time, so only the ones which fail, eg: an
+                    # invalid response number, get the error
+                    result = latest
+                    for i, update in enumerate(batch):
+                        try:
+                            result = await self._run(main, result, action, update[2], uid, seed)
+                        except Exception as e:
+                            errors[i] = e
+            else:
+                result = await self._run(main, latest, action, arg, uid, seed)
+        except asyncio.CancelledError:
+            for update in batch:
+                update[-1].cancel()
+            raise
+        except Exception as e:
+            for update in batch:
+                if not update[-1].done():
+                    update[-1].set_exception(e)
+            return
+        for update_text in {latest, *(update[0] for update, e in zip(batch, errors) if e is None)}:
+            self._remember(uid, update_text, result)
+        for update, e in zip(batch, errors):
+            if update[-1].done():
+                continue
+            if e is None:
+                update[-1].set_result(result)
+            else:
+                update[-1].set_exception(e)
+
+    def _remember(self, uid, text, result):
+        "Remember that a version of a block was updated to `result`"
+        if text==result:
+            return
+        key = (uid, content_hash(text))
+        self._versions[key] = result
+        self._versions.move_to_end(key)
+        while len(self._versions) > self.max_versions:
+            self._versions.popitem(last=False)
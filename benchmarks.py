@@ -0,0 +1,407 @@
+"""
+Benchmarks for roam orbit
+
+Run all of them with `python benchmarks.py` or pick some by name,
+eg: `python benchmarks.py parse`
+"""
+import sys
+import json
+import time
+import random
+import timeit
+import tracemalloc
+import subprocess
+from roam.content import BlockContent
+
+SHORT_BLOCK = \
+    "Some thing I want to review later {{↑}} {{↓}} #[[Roam Orbiter]] "\
+    "#[[feed: ToReview]] #[[schedule: ExpVarFactor]] #[[interval: 2]] #[[due: 2020-08-10]]"
+LONG_BLOCK = \
+    "{{[[TODO]]}} " + \
+    "Inversion of [[Top five regrets of the dying]]: \"Don't ignore your dreams; "\
+    "don't work too much; say what you think.\" #Quote #[[[[source]][[:]][[http://www.paulgraham.com/todo.html]]]] "\
+    "see ((abcdefghi)) and [this essay]([[How to Do What You Love]]) " * 20 + \
+    "{{↑}} {{↓}} #[[[[feed]]:ToReview]] #[[[[schedule]]:ExpDefault]] #[[[[interval]]:2]] "\
+    "#[[[[due]]:[[August 10th, 2020]]]] #[[[[factor]]:2]] #[[[[feedback]]:Vote]] "\
+    "#[[[[↑_count]]:0]] #[[[[↓_count]]:0]]"
+LEGACY_BLOCK = \
+    "Some thing I want to review later {{thought-provoking}} {{not}} #[[[[feed]]: ToThink]] "\
+    "#[[[[schedule]]: ExpReset]] #[[[[interval]]: 10]] #[[[[due]]: [[August 8th, 2020]]]] "\
+    "#[[[[factor]]: 3]] #[[[[thought-provoking_count]]: 0]] #[[[[not_count]]: 0]]"
+MANY_REFS_BLOCK = " ".join(f"[[Page {i}]] #[[[[key {i}]]:[[value {i}]]]]" for i in range(200))
+
+
+def time_per_call(func, number=None):
+    "Return the best time per call in microseconds"
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number * 1e6
+
+
+def bench_parse():
+    "Parse time per block for the single pass and multi-pass parsers"
+    for name, block in [("short", SHORT_BLOCK), ("long", LONG_BLOCK), ("refs", MANY_REFS_BLOCK)]:
+        single = time_per_call(lambda: BlockContent.find_and_replace(block))
+        multi = time_per_call(lambda: BlockContent.find_and_replace_multipass(block))
+        print(f"parse {name:5} ({len(block):5} chars): "\
+              f"single pass {single:8.1f}us  multi-pass {multi:8.1f}us  ({multi/single:.1f}x)")
+
+
+def bench_orbit():
+    "Time to parse, respond to and render an orbiter block"
+    from roam_orbit import RoamOrbiterManager
+    def process(block):
+        orbiter = RoamOrbiterManager.from_string(block)
+        orbiter.process_response(0)
+        return orbiter.to_string()
+    for name, block in [("short", SHORT_BLOCK), ("long", LONG_BLOCK)]:
+        print(f"orbit {name:5} ({len(block):5} chars): {time_per_call(lambda: process(block)):8.1f}us")
+
+
+def bench_equality():
+    "Time to compare parsed items and to find one in a block"
+    from roam.content import PageTag
+    tag = PageTag.from_string("#[[[[feed]]:[[Some long page title]]]]")
+    other = PageTag.from_string("#[[[[feed]]:[[Some long page title]]]]")
+    block = BlockContent.from_string(MANY_REFS_BLOCK)
+    last = block[-1]
+    print(f"equal nested tags:   {time_per_call(lambda: tag==other):8.2f}us")
+    print(f"index of last item:  {time_per_call(lambda: block.index(last)):8.2f}us  ({len(block)} items)")
+    print(f"set of block items:  {time_per_call(lambda: set(block)):8.2f}us")
+
+
+def bench_migrate():
+    "Time to load a block in the latest format and one in an old format"
+    from roam_orbit import RoamOrbiterManager
+    current = RoamOrbiterManager.from_string(SHORT_BLOCK).to_string()
+    for name, block in [("current", current), ("legacy", LEGACY_BLOCK)]:
+        t = time_per_call(lambda: RoamOrbiterManager.from_string(block))
+        print(f"load {name:7} ({len(block):4} chars): {t:8.1f}us")
+
+
+def bench_collapse(n=200):
+    "Time to collapse a block with long prose and all the orbit metadata"
+    from roam_orbit import collapse_roam_orbit, RoamOrbiterManager
+    from roam.content import BlockContentKV
+    prose = LONG_BLOCK[:LONG_BLOCK.index("{{↑}}")]
+    canonical = RoamOrbiterManager.from_string(prose + " {{↑}} {{↓}}").to_string()
+    # The orbit items in the middle of the prose
+    half = len(prose) // 2
+    scattered = prose[:half] + " " + canonical[canonical.index("{{↑}}"):] + " " + prose[half:]
+    for name, block in [("canonical", canonical), ("scattered", scattered)]:
+        # Parsed beforehand, since a block is only collapsed once
+        best = None
+        for _ in range(5):
+            blocks = [BlockContentKV.from_string(block) for _ in range(n)]
+            start = time.perf_counter()
+            for block_content in blocks:
+                collapse_roam_orbit(block_content)
+            t = (time.perf_counter() - start) / n * 1e6
+            best = t if best is None else min(best, t)
+        print(f"collapse {name:9} ({len(block):4} chars, {len(blocks[0]):3} items): {best:8.1f}us")
+    block_content = collapse_roam_orbit(BlockContentKV.from_string(scattered))
+    again = time_per_call(lambda: collapse_roam_orbit(block_content))
+    print(f"collapse again without changes: {again:8.2f}us")
+
+
+def bench_dates():
+    "Time to parse key-value values, most of which aren't dates"
+    from roam.content import KeyValue
+    for value in ["ToReview", "ExpVarFactor", "2020-08-10", "August 10th, 2020"]:
+        print(f"parse value {value!r:20}: {time_per_call(lambda: KeyValue.parse_value(value)):8.2f}us")
+
+
+def bench_scan(n=2000):
+    "Time to find the due date and feed of n orbiter blocks"
+    from roam.content import BlockContentKV
+    from roam_orbit import RoamOrbiterManager
+    block = RoamOrbiterManager.from_string(SHORT_BLOCK).to_string()
+    blocks = [f"Block {i} {block}" for i in range(n)]
+    def scan():
+        for block in blocks:
+            block_content = BlockContentKV.from_string(block)
+            block_content.get_kv("due").value, block_content.get_kv("feed").value
+    print(f"scan {n} blocks for due and feed: {time_per_call(scan, number=1)/1e3:8.1f}ms")
+
+
+def synthetic_export(n, orbiter_share=0.2, seed=0):
+    "Return the pages of a Roam export with n blocks, some of which are orbiter blocks"
+    from roam_orbit import RoamOrbiterManager
+    rng = random.Random(seed)
+    orbiter = RoamOrbiterManager.from_string(SHORT_BLOCK).to_string()
+    strings = synthetic_blocks(n, seed)
+    blocks = []
+    for i, string in enumerate(strings):
+        if rng.random()<orbiter_share:
+            due = f"2020-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+            string = string + " " + orbiter.replace("2020-08-10", due)
+        blocks.append({"uid": f"uid{i}", "string": string})
+    return [{"title": f"Page {p}", "children": blocks[p::100]} for p in range(100)]
+
+
+def bench_due(n=20000):
+    "Time to find the due blocks of a graph by parsing every block vs with the due index"
+    import os
+    import tempfile
+    from due_index import DueIndex, parse_orbit_metadata
+    from roam.export import iter_export_blocks
+    with tempfile.TemporaryDirectory() as tmp:
+        export, db = os.path.join(tmp, "export.json"), os.path.join(tmp, "orbit.db")
+        with open(export, "w", encoding="utf-8") as f:
+            json.dump(synthetic_export(n), f)
+
+        def parse_all():
+            due = []
+            for page, uid, string in iter_export_blocks(export):
+                metadata = parse_orbit_metadata(string)
+                if metadata and metadata["due"]<="2020-01-31" and metadata["feed"]=="ToReview":
+                    due.append(uid)
+            return due
+        start = time.perf_counter()
+        due = parse_all()
+        parse = time.perf_counter() - start
+
+        with DueIndex(db) as index:
+            start = time.perf_counter()
+            index.build_from_export(export)
+            build = time.perf_counter() - start
+            query = time_per_call(lambda: index.due("2020-01-31", feed="ToReview"))
+            assert {e["uid"] for e in index.due("2020-01-31", feed="ToReview")}==set(due)
+            # Most blocks are unchanged in the next export
+            start = time.perf_counter()
+            index.sync_from_export(export)
+            sync = time.perf_counter() - start
+            start = time.perf_counter()
+            index.sync_from_export(export, stream=False)
+            sync_loaded = time.perf_counter() - start
+    print(f"due {n} blocks, {len(due)} due: parse every block {parse*1e3:8.1f}ms  "\
+          f"build index {build*1e3:8.1f}ms  query index {query/1e3:6.2f}ms")
+    print(f"due {n} blocks unchanged: sync index {sync*1e3:8.1f}ms  "\
+          f"sync index from loaded export {sync_loaded*1e3:8.1f}ms")
+
+
+def synthetic_blocks(n, seed=0):
+    "Return n block strings with a mix of prose, page refs, tags, buttons and key-values"
+    rng = random.Random(seed)
+    parts = [
+        lambda i: f"Some prose about topic {i} which goes on for a while.",
+        lambda i: f"[[Page {i % 500}]]",
+        lambda i: f"#tag{i % 50}",
+        lambda i: f"#[[Long tag {i % 100}]]",
+        lambda i: f"[[[[nested {i % 20}]] page]]",
+        lambda i: "((abcdefghi))",
+        lambda i: "{{[[TODO]]}}",
+        lambda i: f"[alias {i}]([[Page {i % 500}]])",
+        lambda i: "{{↑}} {{↓}}",
+        lambda i: f"#[[feed: ToReview]] #[[interval: {i % 30}]] #[[due: 2020-08-10]]",
+    ]
+    return [" ".join(rng.choice(parts)(i) for _ in range(rng.randint(1, 6))) for i in range(n)]
+
+
+def bench_memory(n=100_000):
+    "Memory held by n parsed blocks"
+    from roam.content import BlockContentKV
+    blocks = synthetic_blocks(n)
+    for name, parse in [("BlockContent", BlockContent.from_string), ("BlockContentKV", BlockContentKV.from_string)]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        parsed = [parse(block) for block in blocks]
+        elapsed = time.perf_counter() - start
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"memory {name:14} {n} blocks: {size/1e6:7.1f}MB  ({size/n:6.0f} bytes/block, {elapsed:.1f}s)")
+        del parsed
+
+
+def bench_batch(n=20):
+    "Time to process n blocks with one process per block vs one batch process"
+    args = [SHORT_BLOCK, "add_response", "0"]
+    start = time.perf_counter()
+    for _ in range(n):
+        subprocess.run([sys.executable, "roam_orbit.py"] + args, check=True, capture_output=True)
+    spawn = time.perf_counter() - start
+
+    records = "".join(json.dumps(dict(zip(["text", "action", "arg"], args))) + "\n" for _ in range(n))
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "roam_orbit.py", "--batch"], input=records, check=True,
+                   capture_output=True, text=True, encoding="utf-8")
+    batch = time.perf_counter() - start
+    print(f"batch {n} blocks: process per block {spawn*1e3:8.1f}ms  "\
+          f"one batch {batch*1e3:8.1f}ms  ({spawn/batch:.1f}x)")
+
+
+def import_time(module):
+    "Return the time to import a module in a new process in ms, as reported by python -X importtime"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            check=True, capture_output=True, text=True)
+    for line in result.stderr.splitlines():
+        # eg: "import time:       701 |      32818 | roam_orbit"
+        _, cumulative, name = line.split("|")
+        if name.strip()==module:
+            return int(cumulative) / 1e3
+
+
+def bench_startup(n=10):
+    "Time to import roam_orbit and to respond to a block from the command line, the per-click path"
+    imported = min(import_time("roam_orbit") for _ in range(n))
+    start = time.perf_counter()
+    for _ in range(n):
+        subprocess.run([sys.executable, "roam_orbit.py", SHORT_BLOCK, "add_response", "0"], 
+                       check=True, capture_output=True)
+    click = (time.perf_counter() - start) / n
+    check = "import sys, roam_orbit; print(' '.join(m for m in ['numpy', 'logging'] if m in sys.modules))"
+    eager = subprocess.run([sys.executable, "-c", check], check=True, capture_output=True, text=True).stdout.split()
+    print(f"startup: import roam_orbit {imported:6.1f}ms  respond from the command line {click*1e3:6.1f}ms  "\
+          f"imported on startup: {', '.join(eager) or 'neither numpy nor logging'}")
+
+
+def bench_async(blocks=20, clicks=10):
+    """Time for bursts of clicks on the same blocks, blocking the event loop vs with AsyncOrbiter,
+    and the number of responses the blocks end up with"""
+    import asyncio
+    from roam_orbit import main
+    from roam.content import BlockContentKV
+    from async_orbit import AsyncOrbiter
+    async def measure(click):
+        # How late a task which wakes up every millisecond gets to run
+        lags = []
+        async def tick():
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lags.append(time.perf_counter() - start - 0.001)
+        ticker = asyncio.create_task(tick())
+        await asyncio.sleep(0.01)
+        start = time.perf_counter()
+        # Every click is on the block string the user sees, from before the others
+        results = await asyncio.gather(*[click(LONG_BLOCK, i % 2, f"uid{b}") 
+                                         for b in range(blocks) for i in range(clicks)])
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0.01)
+        ticker.cancel()
+        # The last write to each block is the one which is kept
+        kept = sum(BlockContentKV.from_string(results[b*clicks + clicks-1]).get_kv("total_count").value
+                   for b in range(blocks))
+        return elapsed, max(lags), kept
+    async def blocking(text, response_num, uid):
+        return main(text, "add_response", response_num, uid)
+    orbiter = AsyncOrbiter()
+    for name, click in [("blocking", blocking), ("AsyncOrbiter", orbiter.process_response)]:
+        elapsed, lag, kept = asyncio.run(measure(click))
+        print(f"async {blocks} blocks x {clicks} clicks: {name:12} {elapsed*1e3:8.1f}ms  "\
+              f"longest event loop stall {lag*1e3:6.1f}ms  responses kept {kept}/{blocks*clicks}")
+
+
+def bench_simulate(cards=100_000, years=5):
+    "Time to simulate the review load of a deck, vectorized vs a Python loop over the due cards"
+    import random
+    from simulator import simulate
+    from schedule_handlers import ExpVarFactor
+    handler = ExpVarFactor(init_interval=2, factor_short=2, factor_long=3)
+    days = int(years*365)
+    start = time.perf_counter()
+    simulate(handler, [0.5, 0.5], days, cards)
+    vectorized = time.perf_counter() - start
+
+    def simulate_loop(days):
+        random.seed(0)
+        deck = [[handler.init_interval, handler.init_interval] for _ in range(cards)]
+        for today in range(days):
+            for card in deck:
+                if card[1]<=today:
+                    factor = [handler.factor_short, handler.factor_long][random.random()<0.5]
+                    card[0] = handler.get_next_interval(card[0], factor)
+                    card[1] = today + card[0]
+    loop_days = 30
+    start = time.perf_counter()
+    simulate_loop(loop_days)
+    loop = (time.perf_counter() - start) / loop_days
+    print(f"simulate {cards} cards: {years} years vectorized {vectorized:6.2f}s  "\
+          f"per day vectorized {vectorized/days*1e3:7.2f}ms  python loop {loop*1e3:7.2f}ms")
+
+
+def bench_load(n=5000, days=365):
+    "Daily review counts of n blocks with and without load-aware scheduling, and its cost"
+    import random
+    import statistics
+    import datetime as dt
+    from schedule_handlers import ExpVarFactor
+    from load_histogram import LoadHistogram
+    start = dt.date(2020, 1, 1)
+
+    def simulate(load):
+        rng = random.Random(0)
+        handler = ExpVarFactor(init_interval=2, factor_short=2, factor_long=3, rng=rng)
+        dues = [start.toordinal() + rng.randint(1, 30) for _ in range(n)]
+        intervals = [rng.randint(1, 30) for _ in range(n)]
+        if load:
+            handler.load = LoadHistogram.from_dues(dues, start)
+        reviews = []
+        for today in range(start.toordinal(), start.toordinal() + days):
+            due = [i for i in range(n) if dues[i]==today]
+            for i in due:
+                intervals[i] = handler.get_balanced_interval(intervals[i], [2, 3][rng.random()<0.5], 
+                                                            today=dt.date.fromordinal(today))
+                if load:
+                    handler.load.move(dues[i], today + intervals[i])
+                dues[i] = today + intervals[i]
+            reviews.append(len(due))
+        return reviews[60:]
+    for load in [False, True]:
+        reviews = simulate(load)
+        # The number of reviews falls as the intervals grow, so the spikes are 
+        # the changes from one day to the next
+        change = statistics.mean(abs(a - b) for a, b in zip(reviews, reviews[1:]))
+        print(f"load {n} blocks, {'load-aware' if load else 'noise only'}: reviews per day "\
+              f"mean {statistics.mean(reviews):6.1f}  max {max(reviews):4d}  mean change from the day before {change:6.1f}")
+    load = LoadHistogram.from_dues([start.toordinal() + i % 3650 for i in range(100_000)], start)
+    day = start.toordinal() + 1000
+    query = time_per_call(lambda: load.least_loaded(day, day + 60, day + 30))
+    move = time_per_call(lambda: load.move(day, day + 1) or load.move(day + 1, day))
+    print(f"load 100000 blocks over 10 years: least loaded day {query:6.1f}us  2 moves {move:6.1f}us")
+
+
+def bench_queue(n=10000):
+    "Time to order n due blocks after a response, sorting them again vs the review queue's heap"
+    import random
+    import heapq
+    from review_queue import ReviewQueue
+    rng = random.Random(0)
+    blocks = [{"uid": f"uid{i}", "page": "Page", "string": "", "due": f"2020-08-{rng.randint(1, 31):02d}",
+               "feed": rng.choice(["ToReview", "ToThink"]), "total_count": rng.randint(0, 20)} for i in range(n)]
+    queue = ReviewQueue(blocks, today="2020-08-31")
+    keys = list(queue.heap)
+    resort = time_per_call(lambda: sorted(keys))
+    # The block at the front is rescheduled and still due
+    def respond():
+        key = heapq.heappop(queue.heap)
+        heapq.heappush(queue.heap, key)
+    heap = time_per_call(respond)
+    page = time_per_call(lambda: queue.page(4, size=20))
+    print(f"queue {n} due blocks: sort after a response {resort:8.1f}us  heap {heap:6.2f}us  "\
+          f"5th page of 20 {page:6.1f}us")
+
+
+benchmarks = {
+    "parse": bench_parse,
+    "orbit": bench_orbit,
+    "equality": bench_equality,
+    "migrate": bench_migrate,
+    "collapse": bench_collapse,
+    "dates": bench_dates,
+    "scan": bench_scan,
+    "due": bench_due,
+    "memory": bench_memory,
+    "batch": bench_batch,
+    "startup": bench_startup,
+    "async": bench_async,
+    "simulate": bench_simulate,
+    "load": bench_load,
+    "queue": bench_queue,
+}
+
+if __name__=="__main__":
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        benchmarks[name]()
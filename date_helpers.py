@@ -1,11 +1,16 @@
 import re
 from datetime import datetime
+from functools import lru_cache
 
 ROAM_FORMAT = '%B %d, %Y'
+RE_DAY_SUFFIX = re.compile(r"\b(\d{1,2})(st|nd|rd|th)\b")
+# Directives which only depend on the date, not the time
+DATE_DIRECTIVES = set("aAbBdjmUwWyY")
 
 def remove_day_suffix(dt): 
-    return re.sub(r"\b(\d{1,2})(st|nd|rd|th)\b", "\g<1>", dt)
+    return RE_DAY_SUFFIX.sub("\g<1>", dt)
 
+@lru_cache(maxsize=4096)
 def strptime_day_suffix(date_string, format=ROAM_FORMAT):
     # Parse datetime from date string with day suffix 
     date_string = remove_day_suffix(date_string)
@@ -14,9 +19,22 @@ def strptime_day_suffix(date_string, format=ROAM_FORMAT):
 def get_day_suffix(d):
     return 'th' if 11<=d<=13 else {1:'st',2:'nd',3:'rd'}.get(d%10, 'th')
 
+@lru_cache(maxsize=None)
+def is_date_format(format):
+    # Whether a datetime formats the same as its date. Not for "%%d", which
+    # becomes another directive when the day suffix is added
+    return "%%" not in format and set(re.findall("%(.)", format)) <= DATE_DIRECTIVES
+
+@lru_cache(maxsize=4096)
+def _strftime_day_suffix(dt, format):
+    return dt.strftime(format.replace('%d', str(dt.day) + get_day_suffix(dt.day)))
+
 def strftime_day_suffix(dt, format=ROAM_FORMAT):
     # Datetime to date string with day suffix 
-    return dt.strftime(format.replace('%d', str(dt.day) + get_day_suffix(dt.day)))
+    if is_date_format(format) and isinstance(dt, datetime):
+        # Cache on the date, the time of day changes on every call
+        dt = dt.date()
+    return _strftime_day_suffix(dt, format)
 
 def add_day_suffix(dt, format=ROAM_FORMAT):
     # Date string to date string with day suffix added 
@@ -0,0 +1,328 @@
+"""
+Index of when roam orbiter blocks are due
+
+Keeps the orbit metadata of every orbiter block in a SQLite file, so finding
+the blocks which are due doesn't need the whole graph to be parsed:
+
+    python due_index.py build export.json orbit.db
+    python due_index.py due orbit.db --date 2020-08-10 --feed ToReview
+
+Building the index again from a newer export only parses the blocks whose
+string changed. The index is also updated a block at a time with 
+DueIndex.update, eg: after responding to a block with `process_response`.
+
+DueIndex.load_histogram counts the blocks due on each day, for the load-aware
+schedule handlers.
+"""
+import json
+import hashlib
+import sqlite3
+import argparse
+import datetime as dt
+from roam_orbit import RoamOrbiterManager, convert_legacy_formats, find_feed
+from roam.content import BlockContentKV, KeyValue
+from roam.export import iter_export_blocks, iter_blocks
+from load_histogram import LoadHistogram
+
+# Orbiter blocks have a due date. Cheap check before parsing a block
+DUE_MARKER = "[[due"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    uid TEXT PRIMARY KEY,
+    page TEXT,
+    due TEXT,
+    feed TEXT,
+    schedule TEXT,
+    interval NUMERIC,
+    counters TEXT
+);
+CREATE INDEX IF NOT EXISTS blocks_feed_due ON blocks (feed, due);
+CREATE INDEX IF NOT EXISTS blocks_due ON blocks (due);
+CREATE TABLE IF NOT EXISTS block_hashes (
+    uid TEXT PRIMARY KEY,
+    page TEXT,
+    hash BLOB
+);
+"""
+# Keeps the page of an indexed block if it isn't given
+UPSERT = """
+INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (uid) DO UPDATE SET page=COALESCE(excluded.page, page), due=excluded.due,
+    feed=excluded.feed, schedule=excluded.schedule, interval=excluded.interval, 
+    counters=excluded.counters
+"""
+
+
+def orbit_metadata(block_content):
+    """Read the orbit metadata of a block
+
+    Args:
+        block_content (BlockContentKV): in the latest format
+    Returns:
+        dict: {"due", "feed", "schedule", "interval", "counters"} or None if
+            the block doesn't have a due date. "due" is a YYYY-MM-DD string, 
+            "feed" is the feed RoamOrbiterManager would put the block in and 
+            "counters" maps the *_count keys to their values
+    """
+    due = block_content.get_kv("due")
+    if not due or type(due.value)!=dt.datetime:
+        return None
+    feed = find_feed(block_content)
+    schedule = block_content.get_kv("schedule")
+    metadata = {
+        "due": due.value.strftime("%Y-%m-%d"), 
+        "feed": feed if type(feed)==str else None,
+        "schedule": schedule.value if schedule and type(schedule.value)==str else None,
+    }
+    interval = block_content.get_kv("interval")
+    metadata["interval"] = interval.value if interval and type(interval.value) in (int, float) else None
+    metadata["counters"] = {
+        item.key: item.value for item in block_content.block_items
+        if type(item)==KeyValue and type(item.key)==str and item.key.endswith("_count")}
+    return metadata
+
+
+def export_blocks(export, stream=True):
+    "Iterate over the blocks of a Roam json export which might be orbiter blocks"
+    if stream:
+        return iter_export_blocks(export, contains=DUE_MARKER)
+    with open(export, encoding="utf-8") as f:
+        return iter_blocks(json.load(f), contains=DUE_MARKER)
+
+
+def content_hash(string):
+    "Hash of a block string, which identifies the version of the block"
+    return hashlib.blake2b(string.encode("utf-8"), digest_size=16).digest()
+
+
+def parse_orbit_metadata(string):
+    "Parse a block string and read its orbit metadata. See orbit_metadata"
+    if DUE_MARKER not in string:
+        return None
+    block_content = BlockContentKV.from_string(string)
+    return orbit_metadata(convert_legacy_formats(block_content, string))
+
+
+class DueIndex:
+    """SQLite index of the orbit metadata of orbiter blocks
+
+    Args:
+        path (str): SQLite file. Created if it doesn't exist
+    """
+    def __init__(self, path=":memory:"):
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def build(self, blocks):
+        """Replace the index with the orbiter blocks in `blocks`
+
+        Args:
+            blocks (iterable): (page_title, block_uid, block_string) tuples, eg:
+                from roam.export.iter_export_blocks
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM blocks")
+            self.connection.execute("DELETE FROM block_hashes")
+        return self.sync(blocks)
+
+    def build_from_export(self, export, stream=True):
+        "Replace the index with the orbiter blocks in a Roam json export file. See sync_from_export"
+        return self.build(export_blocks(export, stream))
+
+    def sync(self, blocks):
+        """Update the index to match `blocks`
+
+        Only parses the blocks whose string changed since they were indexed.
+        Indexed blocks which aren't in `blocks` are removed.
+
+        Args:
+            blocks (iterable): (page_title, block_uid, block_string) tuples of 
+                the whole graph, eg: from roam.export.iter_export_blocks
+        Returns:
+            dict: number of blocks "parsed", "unchanged" and "removed"
+        """
+        hashes = {uid: (page, h) for uid, page, h in 
+                  self.connection.execute("SELECT uid, page, hash FROM block_hashes")}
+        counts = {"parsed": 0, "unchanged": 0, "removed": 0}
+        with self.connection:
+            for page, uid, string in blocks:
+                if DUE_MARKER not in string:
+                    continue
+                h = content_hash(string)
+                old_page, old_hash = hashes.pop(uid, (None, None))
+                if h==old_hash:
+                    counts["unchanged"] += 1
+                    if page!=old_page:
+                        self._set_page(uid, page)
+                    continue
+                counts["parsed"] += 1
+                self._update(uid, parse_orbit_metadata(string), page, h)
+            # Blocks which were deleted or aren't orbiter blocks any more
+            for uid in hashes:
+                self._delete(uid)
+            counts["removed"] = len(hashes)
+        return counts
+
+    def sync_from_export(self, export, stream=True):
+        """Update the index to match a Roam json export file. See sync
+
+        Args:
+            export (str): path to the export
+            stream (bool): stream the export instead of loading it. Loading it is
+                faster but needs memory for the whole export
+        """
+        return self.sync(export_blocks(export, stream))
+
+    def update(self, uid, block, page=None):
+        """Update the entry of one block
+
+        Args:
+            uid (str): block uid
+            block (str or BlockContentKV): the new block. The block is removed
+                from the index if it isn't an orbiter block any more
+            page (str): title of the block's page
+        """
+        if type(block)==str:
+            string, metadata = block, parse_orbit_metadata(block)
+        else:
+            string, metadata = block.to_string(), orbit_metadata(block)
+        with self.connection:
+            self._update(uid, metadata, page, content_hash(string))
+
+    def remove(self, uid):
+        with self.connection:
+            self._delete(uid)
+
+    def _update(self, uid, metadata, page, h):
+        if metadata is None:
+            self.connection.execute("DELETE FROM blocks WHERE uid=?", (uid,))
+        else:
+            self.connection.execute(UPSERT, self._row(uid, page, metadata))
+        # Remember the hash of blocks which aren't orbiter blocks too, so they
+        # aren't parsed again
+        self.connection.execute(
+            "INSERT INTO block_hashes VALUES (?, ?, ?) ON CONFLICT (uid) DO UPDATE SET "\
+            "page=COALESCE(excluded.page, page), hash=excluded.hash", (uid, page, h))
+
+    def _set_page(self, uid, page):
+        self.connection.execute("UPDATE blocks SET page=? WHERE uid=?", (page, uid))
+        self.connection.execute("UPDATE block_hashes SET page=? WHERE uid=?", (page, uid))
+
+    def _delete(self, uid):
+        self.connection.execute("DELETE FROM blocks WHERE uid=?", (uid,))
+        self.connection.execute("DELETE FROM block_hashes WHERE uid=?", (uid,))
+
+    def get(self, uid):
+        "Return the entry of a block as a dict, or None if it isn't indexed"
+        row = self.connection.execute("SELECT * FROM blocks WHERE uid=?", (uid,)).fetchone()
+        return self._entry(row) if row else None
+
+    def due(self, date=None, feed=None, limit=None):
+        """Find the blocks which are due on or before `date`
+
+        Uses the (feed, due) index, so only the due blocks are read.
+
+        Args:
+            date (datetime or str): defaults to today. A str is YYYY-MM-DD
+            feed (str): only blocks in this feed
+            limit (int): at most this many blocks
+        Returns:
+            list of dict: entries, in order of due date
+        """
+        date = date or dt.datetime.now()
+        if type(date)!=str:
+            date = date.strftime("%Y-%m-%d")
+        query, params = "SELECT * FROM blocks WHERE due<=?", [date]
+        if feed is not None:
+            query, params = query + " AND feed=?", params + [feed]
+        query += " ORDER BY due, uid"
+        if limit is not None:
+            query, params = query + " LIMIT ?", params + [limit]
+        return [self._entry(row) for row in self.connection.execute(query, params)]
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM blocks").fetchone()[0]
+
+    def load_histogram(self, feed=None, start=None):
+        """Histogram of the number of indexed blocks due on each day
+
+        Args:
+            feed (str): only blocks in this feed
+            start (date): first day of the histogram. Defaults to today, or 
+                the earliest due date if it's before today
+        Returns:
+            LoadHistogram
+        """
+        query, params = "SELECT due, COUNT(*) FROM blocks", []
+        if feed is not None:
+            query, params = query + " WHERE feed=?", [feed]
+        counts = dict(self.connection.execute(query + " GROUP BY due", params).fetchall())
+        return LoadHistogram.from_counts(counts, start)
+
+    @staticmethod
+    def _row(uid, page, metadata):
+        return (uid, page, metadata["due"], metadata["feed"], metadata["schedule"],
+                metadata["interval"], json.dumps(metadata["counters"], ensure_ascii=False))
+
+    @staticmethod
+    def _entry(row):
+        entry = dict(row)
+        entry["counters"] = json.loads(entry["counters"])
+        return entry
+
+
+def process_response(index, uid, string, response_num, page=None, load=None):
+    """Respond to an orbiter block and update its entry in the index
+
+    Args:
+        load (LoadHistogram): if given, the block is scheduled on the least
+            loaded day its noise allows and moved to that day in the histogram
+    Returns:
+        str: the new block string
+    """
+    orbiter = RoamOrbiterManager.from_string(string)
+    if load is not None:
+        orbiter.schedule_handler.load = load
+    orbiter.process_response(response_num)
+    string = orbiter.to_string()
+    index.update(uid, orbiter.block_content, page)
+    return string
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Index when roam orbiter blocks are due")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="build or update the index from a Roam json export")
+    build_parser.add_argument("export")
+    build_parser.add_argument("index")
+    build_parser.add_argument("--rebuild", action="store_true", help="parse every block, not just the changed ones")
+    build_parser.add_argument("--load", action="store_true", help="load the export instead of streaming it. "\
+                              "Faster, but needs memory for the whole export")
+    due_parser = subparsers.add_parser("due", help="list the blocks which are due")
+    due_parser.add_argument("index")
+    due_parser.add_argument("--date", default=None, help="YYYY-MM-DD. Defaults to today")
+    due_parser.add_argument("--feed", default=None)
+    due_parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    with DueIndex(args.index) as index:
+        if args.command=="build":
+            if args.rebuild:
+                counts = index.build_from_export(args.export, stream=not args.load)
+            else:
+                counts = index.sync_from_export(args.export, stream=not args.load)
+            print(f"Indexed {len(index)} orbiter blocks. Parsed {counts['parsed']}, "\
+                  f"unchanged {counts['unchanged']}, removed {counts['removed']}")
+        else:
+            for entry in index.due(args.date, args.feed, args.limit):
+                print(json.dumps(entry, ensure_ascii=False))
@@ -1,9 +1,10 @@
 from schedule_handlers import *
 from feedback_handlers import *
+from handler_registry import register
 
+@register("feed")
 class ToReview:
-    def __init__(self):
-        self.keys = ["feed"]
+    keys = ["feed"]
 
     def update_metadata(self, block_content):
         block_content.set_kv("feed", self.__class__.__name__)
@@ -15,9 +16,9 @@ class ToReview:
         return Vote()
     
 
+@register("feed")
 class ToThink:
-    def __init__(self):
-        self.keys = ["feed"]
+    keys = ["feed"]
 
     def update_metadata(self, block_content):
         block_content.set_kv("feed", self.__class__.__name__)
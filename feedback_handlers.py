@@ -1,9 +1,26 @@
 from roam.content import *
+from handler_registry import register
+
+def get_counter_keys(responses):
+    "Keys of the counter of each response, and of the total count"
+    return [f"{r}_count" for r in responses] + ["total_count"]
+
 
 class FeedbackHandler:
-    def __init__(self, responses):
-        self.responses = responses
-        self.counter_keys = [f"{r}_count" for r in self.responses] + ["total_count"]
+    # Responses of the handler, set by each subclass. The keys a subclass adds
+    # to a block are set on the class from them, so they're known without 
+    # making a handler
+    responses = []
+    keys = ["feedback"] + get_counter_keys(responses)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.keys = ["feedback"] + get_counter_keys(cls.responses)
+
+    def __init__(self, responses=None):
+        if responses is not None:
+            self.responses = responses
+        self.counter_keys = get_counter_keys(self.responses)
         self.response_buttons = [Button(r) for r in self.responses]
         self.keys = ["feedback"] + self.counter_keys 
 
@@ -54,19 +71,16 @@ class FeedbackHandler:
             block_content.set_default_kv(key, 0)
 
 
+@register("feedback")
 class Vote(FeedbackHandler):
-    def __init__(self):
-        responses = ["↑","↓"]
-        super().__init__(responses)
+    responses = ["↑","↓"]
 
 
+@register("feedback")
 class ThoughtProvoking(FeedbackHandler):
-    def __init__(self):
-        responses = ["thoughts", "none"]
-        super().__init__(responses)
+    responses = ["thoughts", "none"]
 
 
+@register("feedback")
 class OldThoughtProvoking(FeedbackHandler):
-    def __init__(self):
-        responses = ["thought-provoking", "not"]
-        super().__init__(responses)
\ No newline at end of file
+    responses = ["thought-provoking", "not"]
@@ -0,0 +1,223 @@
+"""
+Registry of the feed, schedule and feedback handlers
+
+Handlers are registered with a class decorator:
+
+    @register("feed")
+    class ToReview:
+        keys = ["feed"]
+        ...
+
+Handlers in other packages are found through entry points, eg: in the
+package's pyproject.toml
+
+    [project.entry-points."roam_orbit.feeds"]
+    MyFeed = "my_package.feeds:MyFeed"
+
+The entry point name is the name the handler is looked up by, so it should be
+the class name, which is the one written to blocks. The groups are
+roam_orbit.feeds, roam_orbit.schedules and roam_orbit.feedbacks.
+
+The keys and response buttons of all the handlers, the manifest, are listed
+once and cached on disk with the entry points. Looking through the installed
+packages for entry points is slower than the rest of a response, so it's only
+done when the cache is invalidated: when a registered handler's version, keys
+or responses change, the module of a handler of another package is changed,
+or packages are installed or removed. Handlers of other packages are imported
+the first time they're looked up.
+
+    python handler_registry.py           # list the handlers
+    python handler_registry.py --refresh # look for entry points again
+"""
+import os
+import sys
+import json
+import importlib
+from functools import lru_cache
+
+ENTRY_POINT_GROUPS = {"feed": "roam_orbit.feeds", "schedule": "roam_orbit.schedules",
+                      "feedback": "roam_orbit.feedbacks"}
+CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                          "roam_orbit", "handler_manifest.json")
+
+
+def find_entry_points():
+    "Return {kind: {name: 'module:attr'}} of the handlers of the installed packages"
+    from importlib.metadata import entry_points
+    return {kind: {ep.name: ep.value for ep in entry_points(group=group)}
+            for kind, group in ENTRY_POINT_GROUPS.items()}
+
+
+def load_entry_point(value):
+    "Import the object an entry point value, eg: 'my_package.feeds:MyFeed', refers to"
+    module, _, attrs = value.partition(":")
+    obj = importlib.import_module(module)
+    for attr in filter(None, attrs.split(".")):
+        obj = getattr(obj, attr)
+    return obj
+
+
+class Handlers(dict):
+    """Handlers of one kind by name
+
+    Handlers of other packages are imported when they're first looked up
+    """
+    def __init__(self, registry, kind):
+        super().__init__()
+        self.registry = registry
+        self.kind = kind
+
+    def __missing__(self, name):
+        value = self.registry.manifest()["entry_points"][self.kind].get(name)
+        if value is None:
+            raise KeyError(name)
+        self[name] = load_entry_point(value)
+        return self[name]
+
+
+class HandlerRegistry:
+    """Feed, schedule and feedback handlers
+
+    Attributes:
+        handlers (dict): kind -> Handlers, ie: {name: handler class}
+    Args:
+        cache_path (str): where the manifest is cached. None to not cache it
+    """
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.handlers = {kind: Handlers(self, kind) for kind in ENTRY_POINT_GROUPS}
+        self._manifest = None
+        self._cached = []
+
+    def register(self, kind):
+        """Class decorator which registers a handler under its class name
+
+        Args:
+            kind (str): feed, schedule or feedback
+        """
+        def decorator(cls):
+            self.handlers[kind][cls.__name__] = cls
+            self._set_manifest(None)
+            return cls
+        return decorator
+
+    def cached(self, func):
+        "Decorator which caches a function of the manifest until the manifest changes"
+        func = lru_cache(maxsize=None)(func)
+        self._cached.append(func)
+        return func
+
+    def manifest(self, refresh=False):
+        """Return the manifest of the handlers, from the cache if it's up to date
+
+        Args:
+            refresh (bool): look for entry points even if the cache is up to date
+        Returns:
+            dict: "keys" of all the handlers, "responses" of the feedback
+                handlers, both in order and without duplicates, the
+                "entry_points" of each kind, and the "external" handlers,
+                [kind, name, version, module files], of other packages
+        """
+        if self._manifest is not None and not refresh:
+            return self._manifest
+        cached = None if refresh else self._read_cache()
+        if cached is not None and cached.get("fingerprint")==self._fingerprint(cached.get("entry_points", {}),
+                                                                               cached.get("external", [])):
+            self._set_manifest(cached)
+            return cached
+        entry_points = find_entry_points()
+        manifest = {"entry_points": entry_points, "external": [], "keys": [], "responses": []}
+        for kind, handlers in self.handlers.items():
+            classes = list(handlers.values())
+            for name, value in entry_points[kind].items():
+                if name in handlers:
+                    continue
+                cls = load_entry_point(value)
+                classes.append(cls)
+                # The modules of the entry point and the class, so changes to them are
+                # noticed even when the package isn't re-installed, eg: editable installs
+                modules = {value.partition(":")[0], cls.__module__}
+                files = sorted(filter(None, (getattr(sys.modules.get(module), "__file__", None) for module in modules)))
+                manifest["external"].append([kind, name, getattr(cls, "version", None), files])
+            for cls in classes:
+                manifest["keys"] += [key for key in cls.keys if key not in manifest["keys"]]
+                if kind=="feedback":
+                    manifest["responses"] += [r for r in cls.responses if r not in manifest["responses"]]
+        manifest["fingerprint"] = self._fingerprint(entry_points, manifest["external"])
+        self._write_cache(manifest)
+        self._set_manifest(manifest)
+        return manifest
+
+    def load_entry_points(self):
+        "Import all the handlers of other packages, eg: to list every handler"
+        for kind, handlers in self.handlers.items():
+            for name in self.manifest()["entry_points"][kind]:
+                handlers[name]
+
+    def _set_manifest(self, manifest):
+        self._manifest = manifest
+        for func in self._cached:
+            func.cache_clear()
+
+    def _fingerprint(self, entry_points, external):
+        """Changes when a registered handler's version, keys or responses change,
+        the module of an external handler is changed, or packages are installed
+        or removed
+
+        Args:
+            external (list): [kind, name, version, module files] of the handlers
+                of other packages, see `manifest`
+        """
+        handlers = [(kind, name, getattr(cls, "version", None), list(cls.keys), list(getattr(cls, "responses", [])))
+                    for kind, handlers in self.handlers.items() for name, cls in handlers.items()
+                    if name not in entry_points.get(kind, {})]
+        # External handlers aren't imported to check them, their modules are checked instead
+        modules = []
+        for *_, files in external:
+            for path in files:
+                try:
+                    modules.append((path, os.stat(path).st_mtime_ns))
+                except OSError:
+                    modules.append((path, None))
+        # Installing a package adds its metadata, and so its entry points, to site-packages
+        packages = [(path, os.stat(path).st_mtime_ns) for path in sys.path
+                    if os.path.basename(path) in ("site-packages", "dist-packages") and os.path.isdir(path)]
+        return json.dumps([handlers, modules, packages], ensure_ascii=False)
+
+    def _read_cache(self):
+        if self.cache_path is None:
+            return None
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cached if type(cached)==dict else None
+
+    def _write_cache(self, manifest):
+        if self.cache_path is None:
+            return
+        # Written to a temporary file first so other processes never read half of it
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            pass
+
+
+registry = HandlerRegistry(CACHE_PATH)
+register = registry.register
+
+
+if __name__=="__main__":
+    # The handlers are registered with the imported module, not this script
+    from roam_orbit import registry
+    manifest = registry.manifest(refresh="--refresh" in sys.argv)
+    registry.load_entry_points()
+    for kind, handlers in registry.handlers.items():
+        print(f"{kind}: {', '.join(handlers)}")
+    print(f"keys: {', '.join(manifest['keys'])}")
+    print(f"responses: {', '.join(manifest['responses'])}")
@@ -0,0 +1,186 @@
+"""
+Histogram of the number of blocks due on each day
+
+Used by the load-aware schedule handlers to spread reviews across days: within
+the noise window of a block's next interval they pick the day with the fewest
+blocks due. Both updates and queries are O(log n) in the number of days, so the
+histogram can be updated on every response.
+
+    load = LoadHistogram.from_dues(due for due in dues)
+    handler = ExpVarFactor(load=load)
+"""
+import datetime as dt
+
+
+def to_day(value):
+    "Day number of a date, datetime, YYYY-MM-DD string or day number"
+    if type(value)==str:
+        value = dt.date.fromisoformat(value)
+    return value if type(value)==int else value.toordinal()
+
+
+class LoadHistogram:
+    """Number of blocks due on each day
+
+    A segment tree over a range of days. Each leaf is the count of a day and
+    each node is the lowest count of the days below it, so the least loaded
+    day in a range is found without scanning it. The range grows to fit the
+    days which are added or queried.
+
+    Args:
+        start (date or int): first day of the range
+        days (int): number of days in the range
+    """
+    def __init__(self, start=None, days=1024):
+        self.start = to_day(start or dt.date.today())
+        self.size = 1
+        while self.size < days:
+            self.size *= 2
+        self.tree = [0] * (2*self.size)
+        self.total = 0
+
+    @classmethod
+    def from_dues(cls, dues, start=None):
+        """Histogram of due dates
+
+        Args:
+            dues (iterable): due date of each block, as accepted by to_day
+        """
+        counts = {}
+        for due in dues:
+            day = to_day(due)
+            counts[day] = counts.get(day, 0) + 1
+        return cls.from_counts(counts, start)
+
+    @classmethod
+    def from_counts(cls, counts, start=None):
+        """Histogram from a {day: count} dict
+
+        Args:
+            counts (dict): day as accepted by to_day -> number of blocks due
+            start (date or int): first day of the range. Defaults to today, or
+                the earliest day if it's before that
+        """
+        counts = {to_day(day): count for day, count in counts.items()}
+        start = min([to_day(start or dt.date.today()), *counts])
+        histogram = cls(start, max(counts, default=start) - start + 1)
+        for day, count in counts.items():
+            histogram.tree[histogram.size + day - histogram.start] = count
+        histogram.total = sum(counts.values())
+        histogram._build()
+        return histogram
+
+    def __len__(self):
+        return self.total
+
+    def count(self, day):
+        "Number of blocks due on a day"
+        i = to_day(day) - self.start
+        return self.tree[self.size + i] if 0 <= i < self.size else 0
+
+    def add(self, day, count=1):
+        "Add `count` blocks due on a day"
+        day = to_day(day)
+        self._grow(day, day)
+        i = self.size + day - self.start
+        if self.tree[i] + count < 0:
+            raise ValueError(f"only {self.tree[i]} blocks are due on day {day}")
+        self.tree[i] += count
+        self.total += count
+        i //= 2
+        while i:
+            self.tree[i] = min(self.tree[2*i], self.tree[2*i+1])
+            i //= 2
+
+    def remove(self, day, count=1):
+        "Remove `count` blocks due on a day"
+        self.add(day, -count)
+
+    def move(self, old_day, new_day):
+        """Move a block from one due day to another
+
+        The old day is ignored if it has no blocks, eg: the block was new or
+        wasn't counted
+        """
+        if old_day is not None and self.count(old_day) > 0:
+            self.remove(old_day)
+        self.add(new_day)
+
+    def least_loaded(self, first, last, target=None):
+        """Find the day in [first, last] with the fewest blocks due
+
+        Args:
+            first (date or int): first day
+            last (date or int): last day, included
+            target (date or int): among the least loaded days, the one closest
+                to this day is picked. Defaults to the first day
+        Returns:
+            int: day number
+        """
+        first, last = to_day(first), to_day(last)
+        if last < first:
+            raise ValueError("last is before first")
+        target = first if target is None else min(max(to_day(target), first), last)
+        self._grow(first, last)
+        lo, hi = first - self.start, last - self.start
+        lowest = self._min(lo, hi)
+        t = target - self.start
+        after = self._first(1, 0, self.size-1, t, hi, lowest)
+        before = self._last(1, 0, self.size-1, lo, t, lowest)
+        if after is None or (before is not None and t - before <= after - t):
+            return self.start + before
+        return self.start + after
+
+    def _min(self, lo, hi):
+        "Lowest count of the leaves lo..hi"
+        lowest = None
+        lo, hi = lo + self.size, hi + self.size + 1
+        while lo < hi:
+            if lo % 2:
+                lowest = self.tree[lo] if lowest is None else min(lowest, self.tree[lo])
+                lo += 1
+            if hi % 2:
+                hi -= 1
+                lowest = self.tree[hi] if lowest is None else min(lowest, self.tree[hi])
+            lo //= 2
+            hi //= 2
+        return lowest
+
+    def _first(self, node, node_lo, node_hi, lo, hi, value):
+        "First leaf in lo..hi with a count of at most value, or None"
+        if node_hi < lo or hi < node_lo or self.tree[node] > value:
+            return None
+        if node_lo==node_hi:
+            return node_lo
+        mid = (node_lo + node_hi) // 2
+        leaf = self._first(2*node, node_lo, mid, lo, hi, value)
+        return leaf if leaf is not None else self._first(2*node+1, mid+1, node_hi, lo, hi, value)
+
+    def _last(self, node, node_lo, node_hi, lo, hi, value):
+        "Last leaf in lo..hi with a count of at most value, or None"
+        if node_hi < lo or hi < node_lo or self.tree[node] > value:
+            return None
+        if node_lo==node_hi:
+            return node_lo
+        mid = (node_lo + node_hi) // 2
+        leaf = self._last(2*node+1, mid+1, node_hi, lo, hi, value)
+        return leaf if leaf is not None else self._last(2*node, node_lo, mid, lo, hi, value)
+
+    def _grow(self, first, last):
+        "Make the range include the days first..last"
+        if self.start <= first and last < self.start + self.size:
+            return
+        counts = self.tree[self.size:]
+        start = min(self.start, first)
+        size = self.size
+        while start + size <= max(last, self.start + self.size - 1):
+            size *= 2
+        self.tree = [0] * (2*size)
+        offset = self.start - start
+        self.tree[size + offset:size + offset + len(counts)] = counts
+        self.start, self.size = start, size
+        self._build()
+
+    def _build(self):
+        for i in range(self.size - 1, 0, -1):
+            self.tree[i] = min(self.tree[2*i], self.tree[2*i+1])
@@ -0,0 +1,164 @@
+"""
+Long-lived roam orbit server
+
+Keeps the handler registries and compiled patterns loaded so that each request
+only pays for processing the block. Requests are the same records as the batch
+mode of roam_orbit.py, POSTed as json:
+
+    POST /        {"text": ..., "action": ..., "arg": ...}  ->  {"text": ..., "error": ...}
+    POST /batch   newline-delimited records                 ->  one result line per record
+    GET  /health  -> {"status": "ok"}
+
+Run on a localhost port or on a Unix domain socket:
+
+    python orbit_server.py --port 8765 --workers 4
+    python orbit_server.py --socket /tmp/roam_orbit.sock
+"""
+import io
+import os
+import json
+import logging
+import argparse
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from roam_orbit import process_record, run_batch
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = 4
+MAX_REQUEST_SIZE = 10 * 1024 * 1024
+
+
+class OrbitRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path!="/health":
+            return self.send_json(404, {"text": None, "error": f"no such path: {self.path}"})
+        self.send_json(200, {"status": "ok"})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length<0:
+                raise ValueError(f"negative Content-Length: {length}")
+        except ValueError as e:
+            return self.send_json(400, {"text": None, "error": f"invalid Content-Length: {e}"})
+        if length>MAX_REQUEST_SIZE:
+            return self.send_json(413, {"text": None, "error": "request too large"})
+        try:
+            body = self.rfile.read(length).decode("utf-8")
+        except UnicodeDecodeError as e:
+            return self.send_json(400, {"text": None, "error": f"request body isn't valid utf-8: {e}"})
+        if self.path=="/":
+            self.send_json(200, process_record(body))
+        elif self.path=="/batch":
+            out = io.StringIO()
+            run_batch(body.splitlines(), out)
+            self.send_body(200, out.getvalue(), "application/x-ndjson")
+        else:
+            self.send_json(404, {"text": None, "error": f"no such path: {self.path}"})
+
+    def send_json(self, status, obj):
+        self.send_body(status, json.dumps(obj, ensure_ascii=False), "application/json")
+
+    def send_body(self, status, body, content_type):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix domain sockets have no client address
+        return self.client_address[0] if self.client_address else self.server.server_address
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+class WorkerPoolMixIn:
+    """Handle each request on a fixed size pool of worker threads
+
+    Like socketserver.ThreadingMixIn, but without spawning a thread per request.
+    """
+    workers = DEFAULT_WORKERS
+
+    def process_request(self, request, client_address):
+        if not hasattr(self, "executor"):
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="orbit-worker")
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        if hasattr(self, "executor"):
+            self.executor.shutdown(wait=True)
+
+
+class OrbitHTTPServer(WorkerPoolMixIn, HTTPServer):
+    pass
+
+
+class OrbitUnixServer(WorkerPoolMixIn, socketserver.UnixStreamServer):
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def make_server(host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None, workers=DEFAULT_WORKERS):
+    """Create an orbit server
+
+    Args:
+        host (str): interface to listen on. Ignored if socket_path is given
+        port (int): port to listen on. 0 picks a free port
+        socket_path (str): listen on this Unix domain socket instead of a port
+        workers (int): number of requests handled concurrently
+    Returns:
+        socketserver.BaseServer: call serve_forever() to start handling requests
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        cls = OrbitUnixServer
+        address = socket_path
+    else:
+        cls = OrbitHTTPServer
+        address = (host, port)
+    server = cls(address, OrbitRequestHandler, bind_and_activate=False)
+    server.workers = workers
+    server.allow_reuse_address = True
+    try:
+        server.server_bind()
+        server.server_activate()
+    except Exception:
+        server.server_close()
+        raise
+    return server
+
+
+if __name__=="__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Serve roam orbit requests")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--socket", dest="socket_path", help="listen on a Unix domain socket instead")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.socket_path, args.workers)
+    logging.info("Serving roam orbit on %s with %d workers", server.server_address, args.workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
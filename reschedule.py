@@ -0,0 +1,226 @@
+"""
+Re-schedule every roam orbiter block in a Roam json export
+
+Streams the blocks tagged with #[[Roam Orbiter]] out of the export, runs them through roam_orbit.main
+(which parses the block and converts old formats to the latest one) and writes
+the blocks whose string changed as newline-delimited json:
+
+    {"page": ..., "uid": ..., "string": <new block string>, "error": null}
+
+The blocks are processed in chunks on a pool of processes. Results come out in
+the order of the export, and the random number generator is seeded per block
+from (seed, uid), so the output is the same as a serial run with the same seed.
+With --hash-noise the noise is derived from (seed, uid, review count) instead,
+so it's also the same with --bulk, and a block gets new noise on each review.
+
+    python reschedule.py export.json > updates.ndjson
+    python reschedule.py export.json --action add_response --arg 0 --seed 1 --workers 8
+
+With --bulk, the blocks are parsed one at a time but their next intervals and
+due dates are computed together, with one vectorized schedule_many call per
+schedule handler, eg: to change factor_long for the whole ToReview feed:
+
+    python reschedule.py export.json --bulk --feed ToReview --set factor_long=4 --arg 1
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import datetime as dt
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from roam_orbit import main, ROAM_ORBIT_TAG, RoamOrbiterManager, find_feed
+from roam.content import KeyValue
+from schedule_handlers import make_rng, HashNoise
+from roam.export import iter_export_blocks
+
+DEFAULT_CHUNKSIZE = 256
+
+
+def reschedule_block(page, uid, string, action="update", arg=None, seed=0, hash_noise=False):
+    """Run one block through roam_orbit.main
+
+    Returns:
+        dict: {"page", "uid", "string", "error"}. "string" is None if it failed
+    """
+    try:
+        if hash_noise:
+            string = main(string, action, arg, uid, seed)
+        else:
+            random.seed(f"{seed}:{uid}")
+            string = main(string, action, arg)
+        return {"page": page, "uid": uid, "string": string, "error": None}
+    except Exception as e:
+        return {"page": page, "uid": uid, "string": None, "error": f"{type(e).__name__}: {e}"}
+
+
+def reschedule_chunk(chunk, action="update", arg=None, seed=0, hash_noise=False):
+    return [reschedule_block(*block, action=action, arg=arg, seed=seed, hash_noise=hash_noise) for block in chunk]
+
+
+def reschedule(blocks, action="update", arg=None, seed=0, workers=None, chunksize=DEFAULT_CHUNKSIZE, 
+               hash_noise=False):
+    """Re-schedule blocks, in parallel if workers!=1
+
+    Args:
+        blocks (iterable): (page_title, block_uid, block_string) tuples
+        action (str): action passed to roam_orbit.main
+        arg (str): arg passed to roam_orbit.main
+        seed (int): seed for the per block random number generators
+        workers (int): number of processes. None uses one per cpu. 1 runs serially
+        chunksize (int): number of blocks sent to a process at a time
+        hash_noise (bool): derive the noise from (seed, uid, review count)
+            instead of seeding the random module with (seed, uid)
+    Yields:
+        dict: the result of reschedule_block for each block, in the order of `blocks`
+    """
+    blocks = iter(blocks)
+    if workers==1:
+        for block in blocks:
+            yield reschedule_block(*block, action=action, arg=arg, seed=seed, hash_noise=hash_noise)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as executor:
+        # Keep a bounded number of chunks in flight so the input can be streamed
+        max_pending = 2 * workers
+        pending = deque()
+        while True:
+            while len(pending)<max_pending:
+                chunk = list(islice(blocks, chunksize))
+                if not chunk:
+                    break
+                pending.append(executor.submit(reschedule_chunk, chunk, action, arg, seed, hash_noise))
+            if not pending:
+                break
+            yield from pending.popleft().result()
+
+
+def reschedule_export(blocks, **kwargs):
+    """Re-schedule the orbiter blocks in a Roam export
+
+    Args:
+        blocks (iterable): (page_title, block_uid, block_string) tuples, eg: 
+            from roam.export.iter_export_blocks
+        **kwargs: passed to reschedule
+    Yields:
+        dict: result for each orbiter block whose string changed or which failed
+    """
+    # Results come back in order, so the input strings only need to be kept
+    # until their result arrives
+    strings = deque()
+    def orbiter_blocks():
+        for page, uid, string in blocks:
+            if f"[[{ROAM_ORBIT_TAG}]]" in string:
+                strings.append(string)
+                yield page, uid, string
+    for result in reschedule(orbiter_blocks(), **kwargs):
+        if result["string"]!=strings.popleft():
+            yield result
+
+
+def as_number(value):
+    "Convert a float which is a whole number to an int, so it's written without a decimal point"
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def reschedule_many(blocks, response_num, kvs=None, feed=None, seed=0, hash_noise=False):
+    """Respond to many orbiter blocks and schedule them all at once
+
+    Like reschedule_export with action="add_response", but the next intervals
+    and due dates of the blocks with the same schedule handler are computed by 
+    one schedule_many call. The noise comes from one random number generator 
+    seeded with `seed`, so it differs from reschedule's, unless hash_noise is
+    used for both.
+
+    Args:
+        blocks (iterable): (page_title, block_uid, block_string) tuples
+        response_num (int): response added to every block
+        kvs (dict): key-values set on every block before it's scheduled, eg:
+            {"factor_long": 4}
+        feed (str): only the blocks in this feed
+        seed (int): seed for the random number generator
+        hash_noise (bool): derive the noise from (seed, uid, review count)
+    Returns:
+        list of dict: {"page", "uid", "string", "error"} for each block, in 
+            the order of `blocks`
+    """
+    now = dt.datetime.now()
+    results, groups = [], {}
+    for page, uid, string in blocks:
+        if f"[[{ROAM_ORBIT_TAG}]]" not in string:
+            continue
+        result = {"page": page, "uid": uid, "string": None, "error": None}
+        try:
+            orbiter = RoamOrbiterManager.from_string(string)
+            if feed is not None and find_feed(orbiter.block_content)!=feed:
+                continue
+            for key, value in (kvs or {}).items():
+                orbiter.block_content.set_kv(key, value)
+            orbiter.feedback_handler.add_response(orbiter.block_content, response_num)
+            handler, block_content = orbiter.schedule_handler, orbiter.block_content
+            schedule = (
+                uid, block_content.get_kv("total_count").value,
+                float(block_content.get_kv("interval").value),
+                [float(block_content.get_kv(key).value) for key in handler.factor_keys],
+                (block_content.get_kv("due").value - now) / dt.timedelta(days=1))
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        else:
+            groups.setdefault(type(handler), (handler, []))[1].append((result, orbiter, schedule))
+        results.append(result)
+
+    rng = make_rng(seed)
+    for handler, members in groups.values():
+        uids, review_counts, intervals, factors, dues = zip(*[schedule for _, _, schedule in members])
+        if hash_noise:
+            rng = HashNoise(uids, review_counts, seed)
+        try:
+            intervals, dues = handler.schedule_many(intervals, factors, dues, [response_num]*len(members), 0, rng)
+        except Exception as e:
+            for result, _, _ in members:
+                result["error"] = f"{type(e).__name__}: {e}"
+            continue
+        for (result, orbiter, _), interval, due in zip(members, intervals, dues):
+            orbiter.block_content.get_kv("interval").value = as_number(interval)
+            orbiter.block_content.get_kv("due").value = now + dt.timedelta(days=float(due))
+            result["string"] = orbiter.to_string()
+    return results
+
+
+def parse_kv(string):
+    "Parse a key-value given as key=value"
+    key, value = string.split("=", 1)
+    return key, KeyValue.parse_value(value)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Re-schedule the roam orbiter blocks in a Roam json export")
+    parser.add_argument("export", help="path to the Roam json export")
+    parser.add_argument("--action", default="update")
+    parser.add_argument("--arg", default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument("--bulk", action="store_true", help="add the response --arg to every block "\
+                        "and schedule them all at once")
+    parser.add_argument("--set", action="append", type=parse_kv, default=[],
+                        help="with --bulk, key-value set on every block, eg: factor_long=4")
+    parser.add_argument("--feed", default=None, help="with --bulk, only the blocks in this feed")
+    parser.add_argument("--hash-noise", action="store_true", help="derive the interval noise from "\
+                        "(seed, uid, review count)")
+    args = parser.parse_args()
+    if args.bulk and (args.arg is None or not args.arg.isdigit()):
+        parser.error("--bulk needs the response number as --arg, eg: --arg 0")
+
+    blocks = iter_export_blocks(args.export, contains=f"[[{ROAM_ORBIT_TAG}]]")
+    if args.bulk:
+        results = reschedule_many(blocks, int(args.arg), dict(args.set), args.feed, args.seed, args.hash_noise)
+    else:
+        results = reschedule_export(blocks, action=args.action, arg=args.arg, seed=args.seed,
+                                    workers=args.workers, chunksize=args.chunksize, hash_noise=args.hash_noise)
+    for result in results:
+        sys.stdout.write(json.dumps(result, ensure_ascii=False) + "\n")
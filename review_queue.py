@@ -0,0 +1,155 @@
+"""
+Queue of the orbiter blocks due for review
+
+The due blocks are kept in a heap, most overdue first, then by feed priority
+and then fewest reviews first. Responding to the block at the front of the
+queue schedules it and puts it back in the queue if it's still due, or drops
+it. Nothing is sorted again after a response, and the queue can be paged
+through in order without sorting it:
+
+    queue = ReviewQueue.from_blocks(iter_export_blocks("export.json"))
+    block = queue.next()
+    new_string = queue.respond(0)
+    first_page = queue.page(0, size=20)
+"""
+import heapq
+import datetime as dt
+from itertools import islice
+from roam_orbit import RoamOrbiterManager
+from due_index import orbit_metadata, parse_orbit_metadata
+
+# Lower is reviewed first. Other feeds come after these
+FEED_PRIORITY = {"ToReview": 0, "ToThink": 1}
+
+
+def iter_heap(heap):
+    """Iterate over a heap in order without changing it
+
+    Keeps a second heap of the nodes whose parents were yielded, so the k-th
+    item costs O(log k) instead of sorting the whole heap.
+    """
+    if not heap:
+        return
+    frontier = [(heap[0], 0)]
+    while frontier:
+        item, i = heapq.heappop(frontier)
+        yield item
+        for child in (2*i + 1, 2*i + 2):
+            if child < len(heap):
+                heapq.heappush(frontier, (heap[child], child))
+
+
+class ReviewQueue:
+    """Orbiter blocks due for review, in the order they should be reviewed
+
+    Args:
+        blocks (iterable): dicts with the keys "uid", "page", "string", "due"
+            (YYYY-MM-DD), "feed" and "total_count"
+        today (date or str): blocks due on or before this day are in the 
+            queue. A str is YYYY-MM-DD. Defaults to today
+        feed_priority (dict): feed -> priority. Lower is reviewed first
+        index (DueIndex): updated with the blocks which are responded to
+        load (LoadHistogram): for load-aware scheduling of the blocks which
+            are responded to
+    """
+    def __init__(self, blocks, today=None, feed_priority=None, index=None, load=None):
+        today = today or dt.date.today()
+        self.today = today if type(today)==str else today.strftime("%Y-%m-%d")
+        self.feed_priority = FEED_PRIORITY if feed_priority is None else feed_priority
+        self.index = index
+        self.load = load
+        self.blocks = {}
+        self.heap = []
+        for block in blocks:
+            if block["due"] <= self.today:
+                self.blocks[block["uid"]] = block
+                self.heap.append(self._key(block))
+        heapq.heapify(self.heap)
+
+    @classmethod
+    def from_blocks(cls, blocks, **kwargs):
+        """Queue of the due orbiter blocks among `blocks`
+
+        Args:
+            blocks (iterable): (page_title, block_uid, block_string) tuples, eg:
+                from roam.export.iter_export_blocks
+            **kwargs: passed to ReviewQueue
+        """
+        def due_blocks():
+            for page, uid, string in blocks:
+                metadata = parse_orbit_metadata(string)
+                if metadata is not None:
+                    yield cls._block(uid, page, string, metadata)
+        return cls(due_blocks(), **kwargs)
+
+    @classmethod
+    def from_index(cls, index, strings, today=None, feed=None, **kwargs):
+        """Queue of the due blocks in a DueIndex
+
+        Args:
+            index (DueIndex)
+            strings (dict): block uid -> block string, for the due blocks
+            feed (str): only blocks in this feed
+            **kwargs: passed to ReviewQueue. The index is updated after each
+                response unless index=None is passed
+        """
+        # Entries have the same keys as orbit metadata
+        blocks = (cls._block(entry["uid"], entry["page"], strings[entry["uid"]], entry)
+                  for entry in index.due(today, feed))
+        kwargs.setdefault("index", index)
+        return cls(blocks, today, **kwargs)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self):
+        "Iterate over the blocks in order"
+        return (self.blocks[key[-1]] for key in iter_heap(self.heap))
+
+    def next(self):
+        "Return the block to review next, or None if there isn't one"
+        return self.blocks[self.heap[0][-1]] if self.heap else None
+
+    def page(self, number, size=20):
+        "Return the blocks on a page of the queue, in order"
+        return list(islice(iter(self), number*size, (number + 1)*size))
+
+    def respond(self, response_num):
+        """Respond to the block returned by `next`
+
+        The block is scheduled and stays in the queue if it's still due.
+
+        Returns:
+            str: the new block string
+        """
+        if not self.heap:
+            raise IndexError("the review queue is empty")
+        uid = self.heap[0][-1]
+        block = self.blocks[uid]
+        orbiter = RoamOrbiterManager.from_string(block["string"])
+        if self.load is not None:
+            orbiter.schedule_handler.load = self.load
+        orbiter.process_response(response_num)
+        string = orbiter.to_string()
+        # Only taken off the queue once the response is processed, so an
+        # invalid response leaves the block in the queue
+        heapq.heappop(self.heap)
+        del self.blocks[uid]
+        if self.index is not None:
+            self.index.update(uid, orbiter.block_content, block["page"])
+        metadata = orbit_metadata(orbiter.block_content)
+        if metadata is not None and metadata["due"] <= self.today:
+            block = self._block(uid, block["page"], string, metadata)
+            self.blocks[uid] = block
+            heapq.heappush(self.heap, self._key(block))
+        return string
+
+    def _key(self, block):
+        feed = self.feed_priority.get(block["feed"], len(self.feed_priority))
+        return (block["due"], feed, block["total_count"], block["uid"])
+
+    @staticmethod
+    def _block(uid, page, string, metadata):
+        total_count = metadata["counters"].get("total_count", 0)
+        return {"uid": uid, "page": page, "string": string, "due": metadata["due"],
+                "feed": metadata["feed"], "total_count": total_count if type(total_count)==int else 0}
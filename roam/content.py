@@ -1,12 +1,29 @@
 import os
 import re
-import logging
-from functools import reduce
-from itertools import zip_longest
-
-logger = logging.getLogger(__name__)
+import bisect
+from functools import reduce, lru_cache
+from itertools import zip_longest, count
 
 RE_SPLIT_OR = "(?<!\\\)\|"
+RE_BRACKET_PAIR = re.compile(r"\[\[|\]\]")
+RE_PAGE_TAG_WORD = re.compile(r"#[\w\-_@]+")
+RE_ALIAS_URL_DESTINATION = re.compile(r"[^\(\)\[\]]+\)")
+RE_DIGITS = re.compile(r"\d+")
+RE_IMAGE = re.compile(r"!\[([^\[\]]*)\]\(([^\)\n]+)\)")
+RE_ALIAS = re.compile(r"^\[([^\[]+)\]\(([\W\w]+)\)$")
+RE_PAGE_REF_STRING = re.compile(r"^\[\[.*\]\]$")
+RE_BLOCK_REF_STRING = re.compile(r"^\(\(.*\)\)$")
+RE_CODE_LANGUAGE = re.compile("^```(clojure|html|css|javascript)\n([^`]*)```")
+RE_CODE = re.compile("```([^`]*)```")
+RE_VIEW = re.compile("{{([^:]*):(.*)}}")
+RE_BUTTON = re.compile(r"([^:]*):(.*)")
+
+# Compiled patterns for the roam object types whose pattern doesn't depend
+# on the string being parsed. Keyed by (type, anchored).
+PATTERNS = {}
+# Number of compiled patterns to keep for types whose pattern is built from
+# the page refs in the string being parsed
+PAGE_REF_PATTERN_CACHE_SIZE = 256
 
 class BlockContent(list):
     def __init__(self, roam_objects=[]):
@@ -19,9 +36,64 @@ class BlockContent(list):
 
     @classmethod
     def find_and_replace(cls, string, *args, **kwargs):
-        roam_object_types_in_parse_order = [
+        """Parse a string into a sequence of BlockContentItems in a single scan
+
+        The string is walked once from left to right. At each character which
+        can start an item, the item types are tried in the order given by
+        `get_parse_order`, and the first one which matches wins. A match is
+        only accepted if no higher priority item starts inside of it, and each
+        type pairs page ref brackets within the run of text left by the higher
+        priority items before it. This gives the same result as applying each
+        type to the whole string in turn (see `find_and_replace_multipass`),
+        except for the copies of page refs described in
+        `PageRefIndex.copy_end_at`.
+        """
+        scan_table = cls._get_scan_table()
+        re_triggers = scan_table["triggers"]
+        priority = scan_table["priority"]
+        # Each type is matched in the runs of text left by the higher priority
+        # types, so the types which match page refs each have an index of the
+        # page refs in their run
+        page_ref_types = scan_table["page_ref_types"]
+        page_refs = dict.fromkeys(page_ref_types, PageRefIndex(string))
+        roam_objects = []
+        start = pos = 0
+        endpos = len(string)
+        while True:
+            m = re_triggers.search(string, pos)
+            if not m:
+                break
+            pos = m.start()
+            rm_obj_type, end = cls._match_at(string, pos, endpos, page_refs)
+            if rm_obj_type is None:
+                pos += 1
+                continue
+            roam_objects += cls._split_attribute(string[start:pos], *args, **kwargs)
+            roam_objects.append(rm_obj_type.from_span(string, pos, end, page_refs.get(rm_obj_type), *args, **kwargs))
+            start = pos = end
+            # The item splits the runs of the lower priority types
+            rank = priority[rm_obj_type]
+            for other_type in page_ref_types:
+                if priority[other_type] > rank:
+                    page_refs[other_type] = page_refs[other_type].from_position(end)
+        roam_objects += cls._split_attribute(string[start:], *args, **kwargs)
+        Cloze._assign_cloze_ids([o for o in roam_objects if type(o)==Cloze])
+        return cls(roam_objects)
+
+    @classmethod
+    def find_and_replace_multipass(cls, string, *args, **kwargs):
+        "Reference parser which applies each item type to the whole string in turn"
+        roam_objects = BlockContent([String(string)])
+        for rm_obj_type in cls.get_parse_order() + [Attribute]:
+            roam_objects = rm_obj_type.find_and_replace(roam_objects, *args, **kwargs)
+        return cls(roam_objects)
+
+    @staticmethod
+    def get_parse_order():
+        "Item types which can appear anywhere in a string, highest priority first"
+        return [
             CodeBlock,
-            Cloze, 
+            Cloze,
             Image,
             Alias,
             Checkbox,
@@ -30,13 +102,100 @@ class BlockContent(list):
             PageTag,
             PageRef,
             BlockRef,
-            Attribute,
             #Url, #TODO: don't have a good regex for this right now
         ]
-        roam_objects = BlockContent([String(string)])
-        for rm_obj_type in roam_object_types_in_parse_order:
-            roam_objects = rm_obj_type.find_and_replace(roam_objects, *args, **kwargs)
-        return cls(roam_objects)
+
+    @classmethod
+    def _get_scan_table(cls):
+        """Index the item types by the characters they can start with
+
+        Returns:
+            dict: 'triggers' is a compiled pattern matching any start character,
+                'types' maps a start character to the candidate types in
+                priority order, 'preempt' maps a type to a compiled pattern
+                matching the start characters of higher priority types and
+                'page_ref_types' are the types which match page refs.
+        """
+        try:
+            return BlockContent._scan_table
+        except AttributeError:
+            pass
+        parse_order = cls.get_parse_order()
+        types = {}
+        preempt = {}
+        higher_chars = ""
+        for rm_obj_type in parse_order:
+            for c in rm_obj_type.start_chars:
+                types.setdefault(c, []).append(rm_obj_type)
+            if higher_chars:
+                preempt[rm_obj_type] = re.compile("[%s]" % re.escape(higher_chars))
+            higher_chars += rm_obj_type.start_chars
+        BlockContent._scan_table = {
+            "triggers": re.compile("[%s]" % re.escape("".join(types))),
+            "types": types,
+            "priority": {t: i for i, t in enumerate(parse_order)},
+            "preempt": preempt,
+            "page_ref_types": [t for t in parse_order if t.page_ref_pattern],
+        }
+        return BlockContent._scan_table
+
+    @classmethod
+    def _match_at(cls, string, pos, endpos, page_refs, max_priority=None):
+        """Find the highest priority item type which starts at `pos`
+
+        Args:
+            page_refs (dict): Maps each type which matches page refs to the
+                PageRefIndex of the run of text it's matched in
+        Returns:
+            tuple: (item type, end of the match) or (None, None)
+        """
+        scan_table = cls._get_scan_table()
+        priority = scan_table["priority"]
+        for rm_obj_type in scan_table["types"].get(string[pos], []):
+            if max_priority is not None and priority[rm_obj_type] >= max_priority:
+                break
+            end = rm_obj_type.match_at(string, pos, endpos, page_refs.get(rm_obj_type))
+            while end is not None:
+                preempt_pos = cls._find_preempting_item(string, pos, end, rm_obj_type, page_refs)
+                if preempt_pos is None:
+                    return rm_obj_type, end
+                # A higher priority item would have been split out first, so
+                # nothing starting at `pos` can extend past it
+                endpos = preempt_pos
+                end = rm_obj_type.match_at(string, pos, endpos, page_refs.get(rm_obj_type))
+        return None, None
+
+    @classmethod
+    def _find_preempting_item(cls, string, start, end, rm_obj_type, page_refs):
+        "Return the start of the first higher priority item inside string[start:end]"
+        scan_table = cls._get_scan_table()
+        re_preempt = scan_table["preempt"].get(rm_obj_type)
+        if re_preempt is None:
+            return None
+        max_priority = scan_table["priority"][rm_obj_type]
+        pos = start + 1
+        while True:
+            m = re_preempt.search(string, pos, end)
+            if not m:
+                return None
+            pos = m.start()
+            preempting_type, _ = cls._match_at(string, pos, len(string), page_refs, max_priority)
+            if preempting_type is not None:
+                return pos
+            pos += 1
+
+    @staticmethod
+    def _split_attribute(string, *args, **kwargs):
+        "Convert a run of plain text into String objects, splitting out a leading Attribute"
+        if not string:
+            return []
+        m = Attribute.get_pattern().match(string)
+        if not m:
+            return [String(string)]
+        roam_objects = [Attribute.from_string(m.group(), validate=False, *args, **kwargs)]
+        if string[m.end():]:
+            roam_objects.append(String(string[m.end():]))
+        return roam_objects
 
     @classmethod
     def from_string(cls, string, *args, **kwargs):
@@ -80,16 +239,56 @@ class BlockContent(list):
 
 
 class BlockContentItem:
+    # Characters which can start a sub-string of this type
+    start_chars = ""
+    # Whether create_pattern is built from the page refs in the string
+    page_ref_pattern = False
+    # Attributes which __eq__ compares. Items without any compare to_string()
+    identity_attrs = ()
+    __slots__ = ("_identity_key",)
+
+    @property
+    def identity(self):
+        """Hashable key which is equal for equal items
+
+        Computed on first use and kept until an attribute of the item is set.
+        Changes made inside a nested BlockContent (eg: the title of a PageRef)
+        aren't noticed.
+        """
+        key = self._identity_key
+        if key is None:
+            key = self._create_identity()
+            object.__setattr__(self, "_identity_key", key)
+        return key
+
+    def _create_identity(self):
+        if not self.identity_attrs:
+            return (type(self), self.to_string())
+        return (type(self),) + tuple([getattr(self, a) for a in self.identity_attrs])
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # Also initialises the slot, __init__ always sets an attribute
+        object.__setattr__(self, "_identity_key", None)
+
     @classmethod
     def from_string(cls, string, validate=True):
         if validate and not cls.validate_string(string):
             raise ValueError(f"Invalid string '{string}' for {cls.__name__}")
 
+    @classmethod
+    def from_span(cls, string, start, end, page_refs=None, *args, **kwargs):
+        """Create the object from string[start:end] without validating it
+
+        Args:
+            page_refs (PageRefIndex): Index of the page refs in `string`
+        """
+        return cls.from_string(string[start:end], validate=False, *args, **kwargs)
+
     @classmethod
     def validate_string(cls, string):
-        pat = cls.create_pattern(string)
-        pat = "|".join([f"^{p}$" for p in re.split(RE_SPLIT_OR, pat)])
-        if re.match(re.compile(pat), string):
+        pat = cls.get_pattern(string, anchored=True)
+        if pat and pat.match(string):
             return True
         return False
 
@@ -98,6 +297,50 @@ class BlockContentItem:
         "Return regex pattern for sub-strings representing this roam object type"
         raise NotImplementedError
 
+    @classmethod
+    def get_pattern(cls, string=None, anchored=False):
+        """Return the compiled pattern from `create_pattern`
+
+        Patterns which don't depend on the string are compiled once per type.
+        Patterns built from the page refs in the string are kept in a bounded
+        LRU cache keyed by those page refs.
+
+        Args:
+            anchored (bool): Whether the pattern must match the whole string
+
+        Returns:
+            re.Pattern or None if the string can't contain this type
+        """
+        if cls.page_ref_pattern:
+            page_refs = tuple(PageRef.extract_page_ref_strings(string))
+            return _compile_page_ref_pattern(cls, page_refs, anchored)
+        try:
+            return PATTERNS[(cls, anchored)]
+        except KeyError:
+            pat = cls.anchor_pattern(cls.create_pattern()) if anchored else cls.create_pattern()
+            PATTERNS[(cls, anchored)] = re.compile(pat)
+            return PATTERNS[(cls, anchored)]
+
+    @classmethod
+    def anchor_pattern(cls, pat):
+        "Return the pattern changed to only match a whole string"
+        return "|".join([f"^{p}$" for p in re.split(RE_SPLIT_OR, pat)])
+
+    @classmethod
+    def match_at(cls, string, pos, endpos=None, page_refs=None):
+        """Match this roam object type at the start of string[pos:endpos]
+
+        Args:
+            page_refs (PageRefIndex): Index of the run of plain text which
+                `pos` is in. If None, any "[[" can start a page ref.
+
+        Returns:
+            int: End of the match or None if there isn't one
+        """
+        if endpos is None: endpos = len(string)
+        m = cls.get_pattern().match(string, pos, endpos)
+        return m.end() if m else None
+
     def to_string(self):
         raise NotImplementedError
 
@@ -109,12 +352,12 @@ class BlockContentItem:
     
     @classmethod
     def _find_and_replace(cls, string, *args, **kwargs):
-        pat = cls.create_pattern(string)
+        pat = cls.get_pattern(string)
         if not pat:
             return [String(string)]
         "See the find_and_replace method"
-        roam_objects = [cls.from_string(s, validate=False, *args, **kwargs) for s in re.findall(pat, string)]
-        string_split = [String(s) for s in re.split(pat, string)]
+        roam_objects = [cls.from_string(s, validate=False, *args, **kwargs) for s in pat.findall(string)]
+        string_split = [String(s) for s in pat.split(string)]
         # Weave strings and roam objects together 
         roam_objects = [a for b in zip_longest(string_split, roam_objects) for a in b if a]
         roam_objects = [o for o in roam_objects if o.to_string()]
@@ -151,11 +394,32 @@ class BlockContentItem:
         return "<%s(string='%s')>" % (
             self.__class__.__name__, self.to_string())
 
-    def __eq__(self, b):
-        return self.to_string()==b.to_string()
+    def __eq__(self, other):
+        if type(self)!=type(other):
+            return False
+        a, b = self._identity_key, other._identity_key
+        return (a or self.identity)==(b or other.identity)
+
+    def __hash__(self):
+        return hash(self._identity_key or self.identity)
+
+
+@lru_cache(maxsize=PAGE_REF_PATTERN_CACHE_SIZE)
+def _compile_page_ref_pattern(roam_object_type, page_refs, anchored=False):
+    "Compile the pattern for a roam object type given the page refs in a string"
+    pat = roam_object_type.create_page_ref_pattern(page_refs)
+    if not pat:
+        return None
+    if anchored:
+        pat = roam_object_type.anchor_pattern(pat)
+    return re.compile(pat)
 
 
 class Cloze(BlockContentItem):
+    start_chars = "{["
+    identity_attrs = ("text",)
+    __slots__ = ("_id", "text", "string")
+
     def __init__(self, id, text, string=None):
         self._id = id
         self.text = text
@@ -169,7 +433,7 @@ class Cloze(BlockContentItem):
     def from_string(cls, string, validate=True, **kwargs):
         super().from_string(string, validate)
         open, text, close = cls.split_string(string)
-        m = re.search("\d+", open)
+        m = RE_DIGITS.search(open)
         id = int(m.group()) if m else None
         return cls(id, text, string)
 
@@ -181,13 +445,22 @@ class Cloze(BlockContentItem):
 
     @classmethod
     def split_string(cls, string):
-        for pat in cls.create_grouped_patterns(string):
-            groups = re.findall(pat, string)
+        for pat in cls.get_grouped_patterns():
+            groups = pat.findall(string)
             if groups: 
                 return groups[0]
 
     @classmethod
-    def create_grouped_patterns(cls, string):
+    def get_grouped_patterns(cls):
+        try:
+            return PATTERNS[(cls, "grouped")]
+        except KeyError:
+            pats = [re.compile(p) for p in cls.create_grouped_patterns()]
+            PATTERNS[(cls, "grouped")] = pats
+            return pats
+
+    @classmethod
+    def create_grouped_patterns(cls, string=None):
         pat_groups = cls._create_patterns()
         return ["".join([f"({g})" for g in groups]) for groups in pat_groups]
 
@@ -273,10 +546,11 @@ class Cloze(BlockContentItem):
         return "<%s(id=%s, string='%s')>" % (
             self.__class__.__name__, self._id, self.string)
 
-    def __eq__(self, other):
-        return type(self)==type(other) and self.text == other.text
-
 class Image(BlockContentItem):
+    start_chars = "!"
+    identity_attrs = ("src", "alt")
+    __slots__ = ("src", "alt", "string")
+
     def __init__(self, src, alt="", string=None):
         self.src = src
         self.alt = alt
@@ -285,7 +559,7 @@ class Image(BlockContentItem):
     @classmethod
     def from_string(cls, string, validate=True, **kwargs):
         super().from_string(string, validate)
-        alt, src = re.search("!\[([^\[\]]*)\]\(([^\)\n]+)\)", string).groups()
+        alt, src = RE_IMAGE.search(string).groups()
         return cls(src, alt)
 
     @classmethod
@@ -300,10 +574,12 @@ class Image(BlockContentItem):
     def to_html(self, *arg, **kwargs):
         return f'<img src="{self.src}" alt="{self.alt}" draggable="false" class="rm-inline-img">'
 
-    def __eq__(self, other):
-        return type(self)==type(other) and self.src==other.src and self.alt==other.alt
-
 class Alias(BlockContentItem):
+    start_chars = "["
+    page_ref_pattern = True
+    identity_attrs = ("alias", "destination")
+    __slots__ = ("alias", "destination", "string")
+
     def __init__(self, alias, destination, string=None):
         self.alias = alias
         self.destination = destination
@@ -312,15 +588,21 @@ class Alias(BlockContentItem):
     @classmethod
     def from_string(cls, string, validate=True, **kwargs):
         super().from_string(string, validate)
-        alias, destination = re.search(r"^\[([^\[]+)\]\(([\W\w]+)\)$", string).groups()
-        if re.match("^\[\[.*\]\]$", destination):
-            destination = PageRef.from_string(destination)
-        elif re.match("^\(\(.*\)\)$", destination):
+        return cls.from_span(string, 0, len(string))
+
+    @classmethod
+    def from_span(cls, string, start, end, page_refs=None, *args, **kwargs):
+        alias, destination = RE_ALIAS.search(string[start:end]).groups()
+        if RE_PAGE_REF_STRING.match(destination):
+            dest_start = end - len(destination) - 1
+            if page_refs is None: page_refs = PageRefIndex(string, dest_start)
+            destination = PageRef.from_span(string, dest_start, end-1, page_refs)
+        elif RE_BLOCK_REF_STRING.match(destination):
             destination = BlockRef.from_string(destination)
         else:
             # TODO: should this be a Url object?
             destination = String(destination)
-        return cls(alias, destination, string)
+        return cls(alias, destination, string[start:end])
 
     def to_string(self):
         if self.string:
@@ -341,21 +623,55 @@ class Alias(BlockContentItem):
     def get_tags(self):
         return self.destination.get_tags()
     
+    @classmethod
+    def match_at(cls, string, pos, endpos=None, page_refs=None):
+        if endpos is None: endpos = len(string)
+        if not string.startswith("[", pos, endpos):
+            return None
+        # The alias text can't contain "[", so the "](" closing it must come
+        # before the next one. Try the last candidate first, like a greedy regex.
+        alias_end = string.find("[", pos+1, endpos)
+        if alias_end == -1: alias_end = endpos
+        close = string.rfind("](", pos+2, alias_end)
+        while close != -1:
+            end = cls._match_destination(string, close+2, endpos, page_refs)
+            if end is not None:
+                return end
+            close = string.rfind("](", pos+2, close)
+        return None
+
+    @classmethod
+    def _match_destination(cls, string, pos, endpos, page_refs=None):
+        "Match a destination and the closing parenthesis at string[pos:endpos]"
+        ends = [
+            PageRef.match_at(string, pos, endpos, page_refs),
+            BlockRef.match_at(string, pos, endpos)]
+        for end in ends:
+            if end is not None and string.startswith(")", end, endpos):
+                return end + 1
+        m = RE_ALIAS_URL_DESTINATION.match(string, pos, endpos)
+        return m.end() if m else None
+
     @classmethod
     def create_pattern(cls, string=None):
+        return cls.create_page_ref_pattern(PageRef.extract_page_ref_strings(string))
+
+    @classmethod
+    def create_page_ref_pattern(cls, page_refs):
+        "Return the pattern for sub-strings of this type given the page refs in the string"
         re_template = r"\[[^\[]+\]\(%s\)"
         destination_pats = []
-        for o in [PageRef, BlockRef]:
-            dest_pat = o.create_pattern(string)
+        for dest_pat in [PageRef.create_page_ref_pattern(page_refs), BlockRef.create_pattern()]:
             destination_pats += re.split(RE_SPLIT_OR, dest_pat) if dest_pat else []
         destination_pats.append("[^\(\)\[\]]+") # TODO: replace this with a real url regex
 
         return  "|".join([re_template % pat for pat in destination_pats])
 
-    def __eq__(self, other):
-        return type(self)==type(other) and self.alias==other.alias and other.destination==other.destination
-
 class CodeBlock(BlockContentItem):
+    start_chars = "`"
+    identity_attrs = ("language", "code")
+    __slots__ = ("code", "language", "string")
+
     def __init__(self, code, language=None, string=None):
         self.code = code
         self.language = language
@@ -364,16 +680,12 @@ class CodeBlock(BlockContentItem):
     @classmethod
     def from_string(cls, string, **kwargs):
         super().from_string(string)
-        supported_languages = ["clojure", "html", "css", "javascript"]
-        pat_lang = "^```(%s)\n" % "|".join(supported_languages)
-        match_lang = re.search(pat_lang, string)
+        match_lang = RE_CODE_LANGUAGE.search(string)
         if match_lang:
-            language = match_lang.group(1)
-            pat = re.compile(f"```{language}\n([^`]*)```")
+            language, code = match_lang.groups()
         else:
             language = None
-            pat = re.compile("```([^`]*)```")
-        code = re.search(pat, string).group(1)
+            code = RE_CODE.search(string).group(1)
         return cls(code, language, string) 
 
     @classmethod
@@ -391,10 +703,11 @@ class CodeBlock(BlockContentItem):
         code = self.code.replace("\n","<br>")
         return f'<pre>{code}</pre>'
 
-    def __eq__(self, other):
-        return type(self)==type(other) and self.language==other.language and self.code==other.code
-
 class Checkbox(BlockContentItem):
+    start_chars = "{"
+    identity_attrs = ("checked",)
+    __slots__ = ("checked",)
+
     def __init__(self, checked=False):
         self.checked = checked
 
@@ -419,11 +732,12 @@ class Checkbox(BlockContentItem):
         else:
             return '<span><label class="check-container"><input type="checkbox"><span class="checkmark"></span></label></span>'
 
-    def __eq__(self, other):
-        return type(self)==type(other) and self.checked==other.checked
-
 
 class View(BlockContentItem):
+    start_chars = "{"
+    identity_attrs = ("name", "text")
+    __slots__ = ("name", "text", "string")
+
     def __init__(self, name: BlockContentItem, text, string=None):
         if type(name)==str:
             name = String(name)
@@ -434,8 +748,8 @@ class View(BlockContentItem):
     @classmethod
     def from_string(cls, string, validate=True, **kwargs):
         super().from_string(string, validate)
-        name, text = re.search("{{([^:]*):(.*)}}", string).groups()
-        if re.match("^\[\[.*\]\]$", name):
+        name, text = RE_VIEW.search(string).groups()
+        if RE_PAGE_REF_STRING.match(name):
             name = PageRef.from_string(name)
         else:
             name = String(name)
@@ -461,11 +775,12 @@ class View(BlockContentItem):
             return self.string
         return "{{%s:%s}}" % (self.name.to_string(), self.text)
 
-    def __eq__(self, other):
-        return type(self)==type(other) and self.name==other.name and self.text==other.text
-
 
 class Button(BlockContentItem):
+    start_chars = "{"
+    identity_attrs = ("name", "text")
+    __slots__ = ("name", "text", "string")
+
     def __init__(self, name, text="", string=None):
         self.name = name
         self.text = text
@@ -476,7 +791,7 @@ class Button(BlockContentItem):
         super().from_string(string, validate)
         contents = string[2:-2]
         if ":" in contents:
-            m = re.search(r"([^:]*):(.*)", contents)
+            m = RE_BUTTON.search(contents)
             name, text = m.groups()
         else:
             name, text = contents, ""
@@ -499,33 +814,73 @@ class Button(BlockContentItem):
     def create_pattern(cls, string=None):
         return "{{.(?:(?<!{{).)*}}" 
 
-    def __eq__(self, other):
-        return type(self)==type(other) and self.name==other.name and self.text==other.text
-
 class PageRef(BlockContentItem):
+    start_chars = "["
+    page_ref_pattern = True
+    identity_attrs = ("title",)
+    __slots__ = ("_title_content", "uid", "string")
+
     def __init__(self, title, uid="", string=None):
         """
         Args:
-            title (str or BlockContent)
+            title (str or BlockContent): A str title is kept as is unless it 
+                contains page refs
         """
-        if type(title)==str: title = PageRef.find_and_replace(title)
         self._title = title
         self.uid = uid
         self.string = string
 
+    @property
+    def _title(self):
+        "The title as a BlockContent of Strings and nested PageRefs"
+        return PageRef.expand_title(self)
+
+    @_title.setter
+    def _title(self, title):
+        if type(title)==str and "[[" in title: 
+            title = PageRef.parse_title(title)
+        self._title_content = title
+
+    @staticmethod
+    def expand_title(item):
+        "Replace the plain str title of a PageRef or PageTag with a BlockContent"
+        title = item._title_content
+        if type(title)==str:
+            title = BlockContent([String(title)])
+            # Same title, so the identity is still valid
+            object.__setattr__(item, "_title_content", title)
+        return title
+
     @property
     def title(self):
-        return self._title.to_string()
+        return self.identity[1]
+
+    def _create_identity(self):
+        title = self._title_content
+        return (type(self), title if type(title)==str else title.to_string())
 
     @classmethod
     def from_string(cls, string, validate=True, **kwargs):
         super().from_string(string, validate)
-        roam_objects = PageRef.find_and_replace(string[2:-2])
-        return cls(roam_objects, string=string)
+        return cls.from_span(string, 0, len(string))
+
+    @classmethod
+    def from_span(cls, string, start, end, page_refs=None, *args, **kwargs):
+        if page_refs is None: page_refs = PageRefIndex(string, start)
+        return cls(page_refs.get_title(start, end), string=string[start:end])
+
+    @staticmethod
+    def parse_title(title):
+        "Split a title into Strings and nested PageRefs"
+        return PageRefIndex(title).get_content(0, len(title))
 
     @classmethod
     def create_pattern(cls, string, groups=False):
-        page_refs = PageRef.extract_page_ref_strings(string)
+        return cls.create_page_ref_pattern(PageRef.extract_page_ref_strings(string), groups)
+
+    @classmethod
+    def create_page_ref_pattern(cls, page_refs, groups=False):
+        "Return the pattern for sub-strings of this type given the page refs in the string"
         if not page_refs:
             return None
         if groups:
@@ -535,6 +890,8 @@ class PageRef(BlockContentItem):
             return "|".join([re.escape(p) for p in page_refs])
 
     def get_tags(self):
+        if type(self._title_content)==str:
+            return [self.title]
         tags_in_title = [o.get_tags() for o in self._title]
         tags_in_title = list(set(reduce(lambda x,y: x+y, tags_in_title)))
         return [self.title] + tags_in_title
@@ -559,59 +916,204 @@ class PageRef(BlockContentItem):
             f'<span class="rm-page-ref-brackets">]]</span>'\
             f'</span>'
 
+    @classmethod
+    def match_at(cls, string, pos, endpos=None, page_refs=None):
+        if endpos is None: endpos = len(string)
+        if not string.startswith("[[", pos, endpos):
+            return None
+        if page_refs is None: page_refs = PageRefIndex(string, pos)
+        end = page_refs.end_at(pos)
+        if end is None:
+            end = page_refs.copy_end_at(pos)
+        if end is None or end > endpos:
+            return None
+        return end
+
     @staticmethod
     def extract_page_ref_strings(string):
-        # https://stackoverflow.com/questions/524548/regular-expression-to-detect-semi-colon-terminated-c-for-while-loops/524624#524624
-        bracket_count = 0
-        pages = []
-        page = ""
-        prev_char = ""
-        for j,c in enumerate(string):
-            # Track page opening and closing
-            if prev_char+c == "[[":
-                if not page:
-                    page = string[j-1]
-                bracket_count += 1
-                prev_char = ""
-            elif prev_char+c == "]]":
-                bracket_count -= 1
-                prev_char = ""
-            else:
-                prev_char = c
-            if page:
-                page += c
-            # End of page
-            if bracket_count == 0 and page:
-                pages.append(page)
-                page = ""
+        "Return the top level page refs in the string"
+        return [string[start:end] for start, end, depth in PageRefIndex(string).spans if depth == 0]
+
+class PageRefIndex:
+    """Index of the page ref brackets in a string, built in one pass
+
+    "[[" and "]]" are paired from left to right starting at `start`, and a
+    "]]" without an open "[[" is ignored.
+
+    Attributes:
+        spans (list): (start, end, depth) of every closed [[ ]] pair ordered
+            by start, where depth is the number of pairs enclosing it.
+        opens (dict): Maps the start of every "[[" to its (end, depth). End is
+            None if it's never closed.
+    """
+    def __init__(self, string, start=0):
+        self.string = string
+        self.start = start
+        self.opens = {}
+        self._pair_starts = []
+        self._pair_depths = []
+        spans = []
+        stack = []
+        for m in RE_BRACKET_PAIR.finditer(string, start):
+            self._pair_starts.append(m.start())
+            self._pair_depths.append(len(stack))
+            if m.group()=="[[":
+                span = [m.start(), None, len(stack)]
+                spans.append(span)
+                stack.append(span)
+            elif stack:
+                stack.pop()[1] = m.end()
+        self._final_depth = len(stack)
+        self.spans = [tuple(span) for span in spans if span[1] is not None]
+        self._span_starts = [span[0] for span in self.spans]
+        self.opens = {span[0]: (span[1], span[2]) for span in spans}
+        self._top_level_strings = None
+
+    def depth_at(self, pos):
+        "Return the number of open pairs at `pos` or None if it's inside a bracket pair"
+        k = bisect.bisect_left(self._pair_starts, pos)
+        if k > 0 and self._pair_starts[k-1] + 2 > pos:
+            return None
+        return self._pair_depths[k] if k < len(self._pair_starts) else self._final_depth
 
-        return pages
+    def from_position(self, start):
+        """Return an index for a run of plain text starting at `start`
 
-    def __eq__(self, other):
-        return type(self)==type(other) and self.title==other.title
+        The pairs of this index are reused unless `start` is inside of an
+        unclosed page ref.
+        """
+        if self.depth_at(start) != 0:
+            return PageRefIndex(self.string, start)
+        if start == self.start:
+            return self
+        index = PageRefIndex.__new__(PageRefIndex)
+        index.__dict__.update(self.__dict__, start=start, _top_level_strings=None)
+        return index
+
+    def is_top_level(self, pos):
+        "Return True if a top level '[[' starts at `pos`"
+        span = self.opens.get(pos)
+        return span is not None and span[1] == 0
+
+    def end_at(self, pos):
+        "Return the end of the top level page ref starting at `pos` or None"
+        span = self.opens.get(pos)
+        if span is None or span[1] != 0:
+            return None
+        return span[0]
+
+    def copy_end_at(self, pos):
+        """Return the end of a copy of a top level page ref starting at `pos` or None
+
+        The multipass parser matches the text of the top level page refs
+        anywhere in the run of text it parses, so a copy of one nested in an
+        unclosed "[[", eg: the second "[[a]]" of "[[a]] [[b [[a]]", is a page
+        ref too.
+
+        The one difference from the multipass parser: brackets are paired from
+        `start` to the end of the string, not only to the end of the run. So a
+        "]]" in a later, higher priority item can close a "[[" and make a page
+        ref top level, and a copy of it before that item is a page ref, eg:
+        the first "[[a]]" of "[[b [[a]] {{c]]}} [[a]]", which the multipass
+        parser leaves in a String.
+        """
+        if self._top_level_strings is None:
+            i = bisect.bisect_left(self._span_starts, self.start)
+            self._top_level_strings = {self.string[start:end] for start, end, depth in self.spans[i:] if depth == 0}
+        for page_ref in self._top_level_strings:
+            if self.string.startswith(page_ref, pos):
+                return pos + len(page_ref)
+        return None
+
+    def get_title(self, start, end):
+        """Return the title of the page ref string[start:end]
+
+        Returns:
+            str if the title doesn't contain page refs, otherwise the BlockContent
+            of Strings and nested PageRefs
+        """
+        span = self.opens.get(start)
+        if span is None or span[0] != end:
+            return self.string[start+2:end-2]
+        return self.get_content(start+2, end-2, span[1]+1, plain_as_str=True)
+
+    def get_content(self, start, end, depth=0, plain_as_str=False):
+        """Split string[start:end] into Strings and the PageRefs at `depth`
+
+        Args:
+            plain_as_str (bool): Return a str, not a BlockContent, if there are
+                no PageRefs
+        """
+        roam_objects = []
+        pos = start
+        i = bisect.bisect_left(self._span_starts, start)
+        while i < len(self.spans) and self.spans[i][0] < end:
+            span_start, span_end, span_depth = self.spans[i]
+            i += 1
+            if span_depth != depth or span_end > end:
+                continue
+            if span_start > pos:
+                roam_objects.append(String(self.string[pos:span_start]))
+            title = self.get_content(span_start+2, span_end-2, depth+1, plain_as_str=True)
+            roam_objects.append(PageRef(title, string=self.string[span_start:span_end]))
+            pos = span_end
+        if not roam_objects:
+            if plain_as_str:
+                return self.string[start:end]
+            return BlockContent([String(self.string[start:end])])
+        if end > pos:
+            roam_objects.append(String(self.string[pos:end]))
+        return BlockContent(roam_objects)
 
 class PageTag(BlockContentItem):
+    start_chars = "#"
+    page_ref_pattern = True
+    identity_attrs = ("title",)
+    __slots__ = ("_title_content", "string")
+
     def __init__(self, title, string=None):
         """
         Args:
-            title (str or BlockContent)
+            title (str or BlockContent): A str title is kept as is unless it 
+                contains page refs
         """
-        if type(title)==str: title = PageRef.find_and_replace(title)
         self._title = title
         self.string = string
 
+    @property
+    def _title(self):
+        "The title as a BlockContent of Strings and nested PageRefs"
+        return PageRef.expand_title(self)
+
+    @_title.setter
+    def _title(self, title):
+        if type(title)==str and "[[" in title: 
+            title = PageRef.parse_title(title)
+        self._title_content = title
+
     @classmethod
     def from_string(cls, string, validate=True, **kwargs):
         super().from_string(string, validate)
-        title = re.sub("\[\[([\W\w]*)\]\]", "\g<1>", string[1:])
-        roam_objects = PageRef.find_and_replace(title)
-        return cls(roam_objects, string)
+        return cls.from_span(string, 0, len(string))
+
+    @classmethod
+    def from_span(cls, string, start, end, page_refs=None, *args, **kwargs):
+        if not string.startswith("[[", start+1, end):
+            return cls(string[start+1:end], string[start:end])
+        if page_refs is None: page_refs = PageRefIndex(string, start+1)
+        return cls(page_refs.get_title(start+1, end), string[start:end])
 
     @property
     def title(self):
-        return self._title.to_string()
+        return self.identity[1]
+
+    def _create_identity(self):
+        title = self._title_content
+        return (type(self), title if type(title)==str else title.to_string())
 
     def get_tags(self):
+        if type(self._title_content)==str:
+            return [self.title]
         tags_in_title = [o.get_tags() for o in self._title]
         tags_in_title = list(set(reduce(lambda x,y: x+y, tags_in_title)))
         return [self.title] + tags_in_title
@@ -625,20 +1127,36 @@ class PageTag(BlockContentItem):
         return f'<span tabindex="-1" data-tag="{self.title}" '\
                f'class="rm-page-ref rm-page-ref-tag">#{self.title}</span>'
 
+    @classmethod
+    def match_at(cls, string, pos, endpos=None, page_refs=None):
+        if endpos is None: endpos = len(string)
+        m = RE_PAGE_TAG_WORD.match(string, pos, endpos)
+        if m:
+            return m.end()
+        if not string.startswith("#", pos, endpos):
+            return None
+        return PageRef.match_at(string, pos+1, endpos, page_refs)
+
     @classmethod
     def create_pattern(cls, string):
+        return cls.create_page_ref_pattern(PageRef.extract_page_ref_strings(string))
+
+    @classmethod
+    def create_page_ref_pattern(cls, page_refs):
+        "Return the pattern for sub-strings of this type given the page refs in the string"
         pats = ["#[\w\-_@]+"]
         # Create pattern for page refs which look like tags
-        page_ref_pat = PageRef.create_pattern(string)
+        page_ref_pat = PageRef.create_page_ref_pattern(page_refs)
         if page_ref_pat:
             pats += ["#"+pat for pat in re.split(RE_SPLIT_OR, page_ref_pat)]
 
         return "|".join(pats)
 
-    def __eq__(self, other):
-        return type(self)==type(other) and self.title == other.title
-
 class BlockRef(BlockContentItem):
+    start_chars = "("
+    identity_attrs = ("uid",)
+    __slots__ = ("uid", "roam_db", "string")
+
     def __init__(self, uid, roam_db=None, string=None):
         self.uid = uid
         self.roam_db = roam_db
@@ -674,11 +1192,11 @@ class BlockRef(BlockContentItem):
     def get_referenced_block(self):
         return self.roam_db.get(self.uid)
 
-    def __eq__(self, other):
-        return type(self)==type(other) and self.uid==other.uid
-
 
 class Url(BlockContentItem):
+    identity_attrs = ("text",)
+    __slots__ = ("text",)
+
     def __init__(self, text):
         self.text = text
 
@@ -693,10 +1211,9 @@ class Url(BlockContentItem):
     def to_html(self, *arg, **kwargs):
         return f'<span><a href="{self.text}">{self.text}</a></span>'
 
-    def __eq__(self, other):
-        return type(self)==type(other) and self.text==other.text
-
 class String(BlockContentItem):
+    __slots__ = ("string",)
+
     def __init__(self, string):
         self.string = string
 
@@ -718,10 +1235,24 @@ class String(BlockContentItem):
     def to_string(self):
         return self.string
 
+    # Strings are created and compared against String(" ") in loops, so they 
+    # compare their string directly instead of caching an identity
+    __setattr__ = object.__setattr__
+
+    @property
+    def identity(self):
+        return (String, self.string)
+
     def __eq__(self, other):
         return type(self)==type(other) and self.string==other.string
 
+    def __hash__(self):
+        return hash(self.string)
+
 class Attribute(BlockContentItem):
+    identity_attrs = ("title",)
+    __slots__ = ("title", "string")
+
     def __init__(self, title, string=None):
         self.title = title
         self.string = string
@@ -732,11 +1263,8 @@ class Attribute(BlockContentItem):
         return cls(string[:-2], string)
 
     @classmethod
-    def validate_string(cls, string):
-        pat = re.compile(cls.create_pattern(string)+"$")
-        if re.match(pat, string):
-            return True
-        return False
+    def anchor_pattern(cls, pat):
+        return pat+"$"
 
     @classmethod
     def create_pattern(cls, string=None):
@@ -753,31 +1281,202 @@ class Attribute(BlockContentItem):
             return self.string
         return self.title+"::"
 
-    def __eq__(self, other):
-        return type(self)==type(other) and self.title==other.title
-
 # --------------------
 # Added for Roam Orbit
 # --------------------
 import datetime as dt
 from date_helpers import strftime_day_suffix, strptime_day_suffix
 
+RE_ISO_DATE = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}$")
+
+
+@lru_cache(maxsize=None)
+def _compile_sep_patterns(sep):
+    "Compile the patterns which find `sep` anywhere, at the end, at the start and on its own"
+    return tuple(re.compile(pat) for pat in [f"{sep}\s*", f"{sep}\s*$", f"^{sep}\s*", f"^{sep}\s*$"])
+
+class BlockItems(BlockContent):
+    """The block items of a BlockContentKV
+
+    Tells the BlockContentKV which items were added or removed so that it can
+    keep its lookup index up to date.
+
+    Attributes:
+        version (int): changes whenever items are added, removed or moved. 
+            Unique across all BlockItems
+    """
+    _versions = count()
+
+    def __init__(self, items=(), owner=None):
+        list.__init__(self, items)
+        self.owner = owner
+        self.version = next(self._versions)
+
+    def _is_indexed(self):
+        return self.owner is not None and self.owner._index is not None
+
+    def append(self, item):
+        super().append(item)
+        self.version = next(self._versions)
+        if type(item)!=String and self._is_indexed(): self.owner._index_item(item)
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self.version = next(self._versions)
+        if self._is_indexed(): self.owner._index_item(item, at_end=self[-1] is item)
+
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self.version = next(self._versions)
+        if self._is_indexed(): self.owner._unindex_item(item)
+        return item
+
+    def __setitem__(self, key, value):
+        self.version = next(self._versions)
+        if not self._is_indexed():
+            return super().__setitem__(key, value)
+        old = self[key]
+        super().__setitem__(key, value)
+        if isinstance(key, slice):
+            self.owner._invalidate_index()
+        else:
+            self.owner._unindex_item(old)
+            self.owner._index_item(value, at_end=False)
+
+    def __delitem__(self, key):
+        self.version = next(self._versions)
+        if not self._is_indexed():
+            return super().__delitem__(key)
+        old = self[key]
+        super().__delitem__(key)
+        if isinstance(key, slice):
+            self.owner._invalidate_index()
+        else:
+            self.owner._unindex_item(old)
+
+    def __iadd__(self, other):
+        result = super().__iadd__(other)
+        self.version = next(self._versions)
+        if self.owner is not None: self.owner._invalidate_index()
+        return result
+
+    def _changes_order(method):
+        def wrapper(self, *args, **kwargs):
+            result = method(self, *args, **kwargs)
+            self.version = next(self._versions)
+            if self.owner is not None: self.owner._invalidate_index()
+            return result
+        return wrapper
+
+    extend = _changes_order(list.extend)
+    remove = _changes_order(list.remove)
+    clear = _changes_order(list.clear)
+    sort = _changes_order(list.sort)
+    reverse = _changes_order(list.reverse)
+    __imul__ = _changes_order(list.__imul__)
+    del _changes_order
+
+
 class BlockContentKV:
     def __init__(self, block_items):
+        self._index = None
         self.block_items = block_items
+        # layout_version when the items were last put in a canonical layout,
+        # eg: by roam_orbit.collapse_roam_orbit
+        self.canonical_version = None
+
+    @property
+    def block_items(self):
+        return self._block_items
+
+    @block_items.setter
+    def block_items(self, block_items):
+        self._block_items = BlockItems(block_items, owner=self)
+        self._invalidate_index()
 
     @classmethod
     def from_string(cls, text):
-        import inspect
         block_items = BlockContent.from_string(text)
         # Replace tags with key-value objects
         for i, item in enumerate(block_items):
+            # Only page refs and tags with a separator can be key-values
+            if type(item) not in (PageRef, PageTag) or ": " not in item.to_string():
+                continue
             try:
                 block_items[i] = KeyValue.from_item(item)
             except ValueError:
                 continue
         return cls(block_items)
 
+    @staticmethod
+    def _index_key(item):
+        """Return the key `item` is indexed under
+
+        KeyValues are indexed by their key. Buttons, PageRefs and PageTags by 
+        their identity. Other items aren't indexed.
+        """
+        if type(item)==KeyValue:
+            return (KeyValue, item._key) if type(item._key)==str else None
+        if type(item) in (Button, PageRef, PageTag):
+            return item.identity
+        return None
+
+    @property
+    def layout_version(self):
+        """Changes whenever items are added, removed or moved, or a key changes
+
+        Changes to the text of items, eg: a String, aren't noticed
+        """
+        return (self._block_items.version, KeyValue.key_version)
+
+    def _invalidate_index(self):
+        self._index = None
+
+    def _build_index(self):
+        self._index = {}
+        self._index_key_version = KeyValue.key_version
+        for item in self._block_items:
+            self._index_item(item)
+
+    def _index_item(self, item, at_end=True):
+        if self._index is None or type(item)==String:
+            return
+        key = self._index_key(item)
+        if key is None:
+            return
+        items = self._index.get(key)
+        if items is None:
+            self._index[key] = [item]
+        elif at_end:
+            items.append(item)
+        else:
+            # Keeping the items in block order would need their positions
+            self._invalidate_index()
+
+    def _unindex_item(self, item):
+        if self._index is None or type(item)==String:
+            return
+        key = self._index_key(item)
+        if key is None:
+            return
+        items = self._index.get(key, [])
+        for i, b in enumerate(items):
+            if b is item:
+                del items[i]
+                return
+        # The item changed after it was indexed
+        self._invalidate_index()
+
+    def _get_index(self):
+        if self._index is None or self._index_key_version!=KeyValue.key_version:
+            self._build_index()
+        return self._index
+
+    def _position(self, item):
+        for i, b in enumerate(self._block_items):
+            if b is item:
+                return i
+
     def set_default_kv(self, key, default_value):
         kv = self.get_kv(key)
         if kv:
@@ -792,29 +1491,43 @@ class BlockContentKV:
         return default_item
 
     def get(self, item):
-        for b in self.block_items:
+        key = self._index_key(item)
+        if key is None:
+            for b in self._block_items:
+                if b==item:
+                    return b
+            return None
+        for b in self._get_index().get(key, []):
             if b==item:
                 return b
+            if type(b)!=KeyValue:
+                # The item changed after it was indexed. Rebuild and try again.
+                self._build_index()
+                return self.get(item)
+        return None
 
     def remove(self, item):
-        self.block_items.remove(item)
+        b = self.get(item)
+        if b is None:
+            raise ValueError(f"{item!r} is not in the block")
+        del self._block_items[self._position(b)]
 
     def index(self, item):
-        for i, b in enumerate(self.block_items):
-            if b==item:
-                return i
+        b = self.get(item)
+        if b is not None:
+            return self._position(b)
 
     def insert(self, index, item):
-        self.block_items.insert(index, item)
+        self._block_items.insert(index, item)
 
     def append(self, item):
-        self.block_items.append(item)
+        self._block_items.append(item)
 
     def add(self, item, add_whitespace=True, allow_duplicate=False):
         if not self.get(item) or allow_duplicate:
             if add_whitespace and not self.end_in_whitespace():
-                self.block_items.append(String(" "))
-            self.block_items.append(item)
+                self._block_items.append(String(" "))
+            self._block_items.append(item)
 
     def set_kv(self, key, value):
         kv = self.get_kv(key)
@@ -826,35 +1539,95 @@ class BlockContentKV:
     def get_kv(self, key):
         # TODO: this is unintuitive. I expect it to return the value, not the
         # key/value pair.
-        for item in self.block_items:
-            if type(item)==KeyValue and item.key==key:
-                return item
+        if type(key)!=str:
+            for item in self._block_items:
+                if type(item)==KeyValue and item.key==key:
+                    return item
+            return None
+        # Changing a key invalidates the index, so the indexed keys are current
+        index = self._index
+        if index is None or self._index_key_version!=KeyValue.key_version:
+            index = self._get_index()
+        items = index.get((KeyValue, key))
+        return items[0] if items else None
 
     def add_kv(self, key, value):
         # TODO: do I need this? Can't it just be part of set_kv?
         if not self.end_in_whitespace():
-            self.block_items.append(String(" "))
-        self.block_items.append(KeyValue(key, value))
+            self._block_items.append(String(" "))
+        self._block_items.append(KeyValue(key, value))
 
     def delete_kv(self, key):
         item = self.get_kv(key)
         self.remove(item)
 
     def end_in_whitespace(self):
-        last_item = self.block_items[-1]
+        last_item = self._block_items[-1]
         return type(last_item)==String and last_item.to_string()[-1]==" "
 
     def to_string(self):
-        return "".join([b.to_string() for b in self.block_items])
+        return "".join([b.to_string() for b in self._block_items])
 
     def __len__(self):
-        return len(self.block_items)
+        return len(self._block_items)
+
+class KeyValue(BlockContentItem):
+    identity_attrs = ("key", "value")
+    __slots__ = ("_key", "_value", "_raw_value", "_sep", "string")
+
+    # Incremented whenever the key of any KeyValue changes, so that the
+    # BlockContentKV indexes know to rebuild
+    key_version = 0
+
+    def __init__(self, key, value=None, sep=": ", string=None, raw_value=None):
+        """
+        Args:
+            key (str or PageRef)
+            value (int, float, datetime, str or PageRef)
+            sep (str or PageRef)
+            string (str): the text the KeyValue was parsed from. Returned by 
+                to_string until the key, sep or value is changed
+            raw_value (str, String or PageRef): unparsed value, parsed into
+                `value` when it's first read
+        """
+        self._key = key
+        self._value = value
+        self._raw_value = raw_value
+        self._sep = sep
+        self.string = string
 
-class KeyValue:
-    def __init__(self, key, value, sep=": "):
-        self.key = key
-        self.value = value
-        self.sep = sep
+    @property
+    def key(self):
+        return self._key
+
+    @key.setter
+    def key(self, key):
+        self._key = key
+        self.string = None
+        KeyValue.key_version += 1
+
+    @property
+    def value(self):
+        if self._raw_value is not None:
+            # Parsing doesn't change the KeyValue, so keep its identity and string
+            object.__setattr__(self, "_value", self.parse_value(self._raw_value))
+            object.__setattr__(self, "_raw_value", None)
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self._raw_value = None
+        self.string = None
+
+    @property
+    def sep(self):
+        return self._sep
+
+    @sep.setter
+    def sep(self, sep):
+        self._sep = sep
+        self.string = None
 
     @classmethod
     def from_item(cls, item, sep=": "):
@@ -862,58 +1635,57 @@ class KeyValue:
         RE_FLOAT = "^([1-9]\d*|0).\d+$"
         if not (type(item) in (PageRef, PageTag)):
             raise ValueError("item must be PageRef or PageTag")
+        re_sep, re_sep_end, re_sep_start, re_sep_only = _compile_sep_patterns(sep)
 
-        block_content = item._title
+        # Don't expand a plain title into a BlockContent just to read it
+        title = item._title_content
+        block_content = [String(title)] if type(title)==str else title
 
         # Case - [[key:value]]
         if len(block_content)==1 and type(block_content[0])==String:
             string = block_content[0].string
-            m = re.search(f"{sep}\s*", string)
+            m = re_sep.search(string)
             if not m: 
                 raise ValueError("item is not a KeyValue")
             key, sep, value = string[:m.start()], m.group(), string[m.end():]
-            value = cls.parse_value(value)
 
         # Case - [[key:[[value]]]]
         elif len(block_content)==2 and type(block_content[0])==String:
             string = block_content[0].string
-            m = re.search(f"{sep}\s*$", string) # string ends with separator
+            m = re_sep_end.search(string) # string ends with separator
             if not m: 
                 raise ValueError("item is not a KeyValue")
-            key, sep = string[:m.start()], m.group()
-            value = cls.parse_value(value)
+            key, sep, value = string[:m.start()], m.group(), block_content[1]
 
         # Case - [[[[key]]:value]]
         elif len(block_content)==2 and type(block_content[1])==String:
             string = block_content[1].string
-            m = re.search(f"^{sep}\s*", string) # string ends with separator
+            m = re_sep_start.search(string) # string ends with separator
             if not m: 
                 raise ValueError("item is not a KeyValue")
             key, sep, value = block_content[0], m.group(), string[m.end():]
-            value = cls.parse_value(value)
 
         # Case - [[[[key]]:[[value]]]]
         elif len(block_content)==3 and type(block_content[1])==String:
             string = block_content[1].string
-            m = re.search(f"^{sep}\s*$", string) 
+            m = re_sep_only.search(string) 
             if not m: 
                 raise ValueError("item is not a KeyValue")
             key, sep, value = block_content[0], m.group(), block_content[-1]
-            value = cls.parse_value(value)
 
         # Case - [[[[key]][[:]]value]] or [[[[key]][[:]][[value]]]]
         elif len(block_content)==3 and type(block_content[1])==PageRef:
             string = block_content[1].title
-            m = re.search(f"^{sep}\s*$", string) 
+            m = re_sep_only.search(string) 
             if not m: 
                 raise ValueError("item is not a KeyValue")
             key, sep, value = block_content
-            value = cls.parse_value(value)
         
         else:
             raise ValueError("item is not a KeyValue")
 
-        return cls(key, value, sep)
+        # The value is only parsed if it's read
+        return cls(key, sep=sep, string=item.to_string(), raw_value=value)
 
     @classmethod
     def parse_value(cls, obj):
@@ -937,13 +1709,20 @@ class KeyValue:
     
     @classmethod
     def parse_date(cls, string):
-        try: return dt.datetime.strptime(string, "%Y-%m-%d")
-        except ValueError: pass
-        try: return strptime_day_suffix(string, format="%B %d, %Y")
-        except ValueError: pass
+        # Most values aren't dates, so only try the formats the string could be in
+        if RE_ISO_DATE.match(string):
+            try: return dt.datetime(int(string[:4]), int(string[5:7]), int(string[8:]))
+            except ValueError: return string
+        if string[:4].isdigit() and string[4:5]=="-":
+            try: return dt.datetime.strptime(string, "%Y-%m-%d")
+            except ValueError: pass
+        if string[:1].isalpha() and "," in string:
+            try: return strptime_day_suffix(string, format="%B %d, %Y")
+            except ValueError: pass
         return string
 
     def to_string(self):
+        if self.string: return self.string
         # key to string
         key = self.key.to_string() if type(self.key)==PageRef else self.key
         # sep to string
@@ -965,8 +1744,5 @@ class KeyValue:
 
         return f"#[[{key}{sep}{value}]]"
 
-    def __eq__(self, other):
-        return type(self)==type(other) and self.key==other.key and self.value==other.value
-
     def __repr__(self):
         return f"<KeyValue(key={self.key}, value={self.value})>"
@@ -0,0 +1,218 @@
+"""
+Read the blocks of a Roam json export
+
+`iter_export_blocks` streams the export file instead of loading it, so memory
+is bounded by the read buffer and the depth of the deepest block, not by the
+size of the file.
+"""
+import os
+import re
+import json
+
+CHUNK_SIZE = 1 << 16
+
+RE_TOKEN = re.compile(r'\s*(?:("(?:[^"\\]|\\.)*")|([{}\[\]:,])|(-?[\d.eE+\-]+|true|false|null))')
+LITERALS = {"true": True, "false": False, "null": None}
+
+
+class ExportReader:
+    """Pull tokens from a json file one at a time
+
+    Reads the file in chunks of `chunk_size` characters. A token which straddles
+    two chunks is re-matched after the next chunk is read.
+    """
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.token = self._next_token()
+
+    def _next_token(self):
+        while True:
+            m = RE_TOKEN.match(self.buffer, self.pos)
+            # The token might continue in the next chunk
+            if (m is None or m.end()==len(self.buffer)) and not self.eof:
+                chunk = self.f.read(self.chunk_size)
+                self.buffer = self.buffer[self.pos:] + chunk
+                self.pos = 0
+                self.eof = not chunk
+                continue
+            if m is None:
+                if self.buffer[self.pos:].strip():
+                    raise ValueError(f"Invalid json near: {self.buffer[self.pos:self.pos+20]!r}")
+                return None
+            self.pos = m.end()
+            return m.groups()
+
+    def next(self):
+        token = self.token
+        if token is None:
+            raise ValueError("Unexpected end of json")
+        self.token = self._next_token()
+        return token
+
+    def expect(self, punctuation):
+        string, punct, literal = self.next()
+        if punct!=punctuation:
+            raise ValueError(f"Expected '{punctuation}' but got {string or punct or literal!r}")
+
+    def peek_punctuation(self):
+        return self.token[1] if self.token else None
+
+    def read_scalar(self):
+        "Read a string, number, true, false or null"
+        string, punct, literal = self.next()
+        if string is not None:
+            return json.loads(string) if "\\" in string else string[1:-1]
+        if literal is not None:
+            return LITERALS[literal] if literal in LITERALS else json.loads(literal)
+        raise ValueError(f"Expected a scalar but got {punct!r}")
+
+    def skip_value(self):
+        "Skip a value, including any nested objects and arrays"
+        depth = 0
+        while True:
+            string, punct, literal = self.next()
+            if punct in ("{", "["):
+                depth += 1
+            elif punct in ("}", "]"):
+                depth -= 1
+            if depth==0:
+                return
+
+    def object_keys(self):
+        """Iterate over the keys of an object
+
+        The caller has to read or skip each value before asking for the next key.
+        """
+        self.expect("{")
+        if self.peek_punctuation()=="}":
+            self.next()
+            return
+        while True:
+            key = self.read_scalar()
+            self.expect(":")
+            yield key
+            string, punct, literal = self.next()
+            if punct=="}":
+                return
+            if punct!=",":
+                raise ValueError(f"Expected ',' or '}}' but got {string or punct or literal!r}")
+
+    def array_items(self):
+        """Iterate over the items of an array
+
+        The caller has to read or skip each item before asking for the next one.
+        """
+        self.expect("[")
+        if self.peek_punctuation()=="]":
+            self.next()
+            return
+        while True:
+            yield
+            string, punct, literal = self.next()
+            if punct=="]":
+                return
+            if punct!=",":
+                raise ValueError(f"Expected ',' or ']' but got {string or punct or literal!r}")
+
+
+def _matches(string, contains):
+    if contains is None:
+        return True
+    if type(contains)==str:
+        return contains in string
+    return any(s in string for s in contains)
+
+
+def _read_blocks(reader, page_title, contains):
+    "Yield the blocks of a 'children' array"
+    for _ in reader.array_items():
+        if reader.peek_punctuation()!="{":
+            reader.skip_value()
+            continue
+        uid, string, read, yielded = None, "", set(), False
+        for key in reader.object_keys():
+            if key=="uid":
+                uid = reader.read_scalar()
+                read.add(key)
+            elif key=="string":
+                string = reader.read_scalar()
+                read.add(key)
+            elif key=="children" and reader.peek_punctuation()=="[":
+                # Yield the block before its children if we already can.
+                # Otherwise it's yielded after them, once its object is read
+                if not yielded and len(read)==2:
+                    if _matches(string, contains):
+                        yield page_title, uid, string
+                    yielded = True
+                yield from _read_blocks(reader, page_title, contains)
+            else:
+                reader.skip_value()
+        if not yielded and _matches(string, contains):
+            yield page_title, uid, string
+
+
+def iter_export_blocks(export, contains=None, chunk_size=CHUNK_SIZE):
+    """Stream the blocks of a Roam json export
+
+    Blocks are yielded in document order: a block comes before its children
+    as long as its "string" and "uid" come before its "children", as they do
+    in Roam exports. Otherwise it comes after its children. The blocks of a 
+    page whose "title" comes after its "children" are held until the title 
+    is read.
+
+    Args:
+        export (str or file): path to the export, or a file opened in text mode
+        contains (str or list of str): only yield blocks whose string contains
+            this, or any of these, substrings. A cheap filter to apply before
+            parsing the blocks
+        chunk_size (int): number of characters read from the file at a time
+    Yields:
+        tuple: (page_title, block_uid, block_string)
+    """
+    if isinstance(export, (str, os.PathLike)):
+        with open(export, encoding="utf-8") as f:
+            yield from iter_export_blocks(f, contains, chunk_size)
+        return
+
+    reader = ExportReader(export, chunk_size)
+    for _ in reader.array_items():
+        if reader.peek_punctuation()!="{":
+            reader.skip_value()
+            continue
+        title, has_title, held = None, False, []
+        for key in reader.object_keys():
+            if key=="title":
+                title = reader.read_scalar()
+                has_title = True
+            elif key=="children" and reader.peek_punctuation()=="[":
+                if has_title:
+                    yield from _read_blocks(reader, title, contains)
+                else:
+                    held += [uid_string for _, *uid_string in _read_blocks(reader, None, contains)]
+            else:
+                reader.skip_value()
+        for uid, string in held:
+            yield title, uid, string
+
+
+def iter_blocks(pages, contains=None):
+    """Iterate over the blocks of an already loaded Roam json export
+
+    Args:
+        pages (list): the loaded export. A list of pages with nested "children" blocks
+        contains (str or list of str): see iter_export_blocks
+    Yields:
+        tuple: (page_title, block_uid, block_string)
+    """
+    for page in pages:
+        stack = list(reversed(page.get("children", [])))
+        while stack:
+            block = stack.pop()
+            string = block.get("string", "")
+            if _matches(string, contains):
+                yield page.get("title"), block.get("uid"), string
+            stack.extend(reversed(block.get("children", [])))
@@ -35,14 +35,12 @@ import sys
 import re
 import json
 import datetime as dt
-import logging
 from date_helpers import strftime_day_suffix, strptime_day_suffix
 from feed_handlers import *
 from feedback_handlers import *
 from schedule_handlers import *
 from roam.content import *
-
-logging.basicConfig(level=logging.INFO)
+from handler_registry import registry
 
 TO_THINK_FACTOR = 2
 TO_THINK_FIRST_INTERVAL = 2
@@ -55,21 +53,31 @@ TO_REVIEW_FIRST_INTERVAL = 2
 DEFAULT_FEED = "ToReview"
 ROAM_ORBIT_TAG = "Roam Orbiter"
 
-scheduler_handlers = {o.__name__: o for o in [ExpDefault, ExpReset, ExpVarFactor, Periodically]}
-feed_handlers = {o.__name__: o for o in [ToReview, ToThink]}
-feedback_handlers = {o.__name__: o for o in [Vote, ThoughtProvoking, OldThoughtProvoking]}
+# Handler classes by name, including those of other packages. See handler_registry
+scheduler_handlers = registry.handlers["schedule"]
+feed_handlers = registry.handlers["feed"]
+feedback_handlers = registry.handlers["feedback"]
+
+
+@registry.cached
+def get_roam_orbit_keys():
+    "Return the keys used by roam orbit, from the manifest of the handlers"
+    return registry.manifest()["keys"]
+
 
-roam_orbit_keys = []
-for handlers in [feed_handlers, scheduler_handlers, feedback_handlers]:
-    for cls in handlers.values():
-        for key in cls().keys:
-            if key not in roam_orbit_keys:
-                roam_orbit_keys.append(key)
-roam_orbit_btns = []
-for cls in feedback_handlers.values():
-    for btn in cls().response_buttons:
-        if btn not in roam_orbit_btns:
-            roam_orbit_btns.append(btn)
+@registry.cached
+def get_roam_orbit_btns():
+    "Return the response buttons of every feedback handler"
+    return [Button(r) for r in registry.manifest()["responses"]]
+
+
+def __getattr__(name):
+    # roam_orbit_keys and roam_orbit_btns are only listed when they're first used
+    if name=="roam_orbit_keys":
+        return get_roam_orbit_keys()
+    if name=="roam_orbit_btns":
+        return get_roam_orbit_btns()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def convert_review_history(block_content):
@@ -87,11 +95,7 @@ def convert_review_history(block_content):
     for item in items_remove:
         block_content.block_items.remove(item)
 
-    # Remove trailing whitespace
-    while block_content.block_items[-1]==String(" "):
-        del block_content.block_items[-1]
-
-    return block_content
+    return remove_trailing_whitespace(block_content)
 
 
 def convert_old_roam_orbit(block_content):
@@ -107,12 +111,7 @@ def convert_old_roam_orbit(block_content):
      block_content.delete_kv("count0")
      block_content.delete_kv("count1")
      block_content.delete_kv("count2")
-     # Remove trailing whitespace
-     while block_content.block_items[-1]==String(" "):
-         del block_content.block_items[-1]
-
-
-     return block_content
+     return remove_trailing_whitespace(block_content)
 
 
 def convert_old_key_values(block_content):
@@ -121,7 +120,7 @@ def convert_old_key_values(block_content):
         if type(item)!=KeyValue:
             continue
         key = item.key.title if type(item.key)==PageRef else item.key 
-        if key not in set(roam_orbit_keys):
+        if key not in set(get_roam_orbit_keys()):
             continue
 
         if type(item.key)==PageRef:
@@ -169,46 +168,125 @@ def convert_toreview_scheduler(block_content):
     return block_content
 
 
+def remove_trailing_whitespace(block_content):
+    while block_content.block_items[-1]==String(" "):
+        del block_content.block_items[-1]
+    return block_content
+
+
+# Converters from old formats to the latest one, in the order they're applied.
+# Each maps to substrings of which a block in that old format contains at least one.
+legacy_format_markers = {
+    convert_review_history: ["SomedayMaybe", "Review History"],
+    convert_old_roam_orbit: ["type"],
+    # Old roam orbit keys and values are page refs, eg: #[[[[feed]]: ToReview]] 
+    convert_old_key_values: ["[[[[", "]]]]"],
+    # The feedback name is always reset by the feedback handler afterwards, so
+    # only the old buttons and counters need converting
+    convert_old_thought_provoking_names: ["thought-provoking", "{{not}}", "not_count"],
+    convert_toreview_scheduler: ["ExpDefault"],
+}
+
+
+def convert_legacy_formats(block_content, string):
+    """Convert old formats to the latest one
+
+    Only runs the converters of the old formats whose markers are in `string`, 
+    so a block which is already in the latest format skips them all.
+
+    Args:
+        block_content (BlockContentKV): parsed from `string`
+        string (str): the block string
+    Returns:
+        BlockContentKV
+    """
+    # The review history converter also removes trailing whitespace, which 
+    # every block needs
+    block_content = remove_trailing_whitespace(block_content)
+    for convert, markers in legacy_format_markers.items():
+        for marker in markers:
+            if marker in string:
+                block_content = convert(block_content)
+                break
+    return block_content
+
+
+@registry.cached
+def roam_orbit_layout():
+    "Return the position of each roam orbit key and button identity, and the identity of the roam orbit tag"
+    return ({key: i for i, key in enumerate(get_roam_orbit_keys())},
+            {btn.identity: i for i, btn in enumerate(get_roam_orbit_btns())},
+            PageTag.from_string(f"#[[{ROAM_ORBIT_TAG}]]").identity)
+
+
 def collapse_roam_orbit(block_content):
-    # Collect roam orbit items
-    kvs, btns = [], []
-    for key in roam_orbit_keys:
-        kv = block_content.get_kv(key)
-        if kv:
-            kvs.append(kv)
-            block_content.remove(kv)
-    for btn in roam_orbit_btns:
-        btn = block_content.get(btn)
-        if btn:
-            btns.append(btn)
-            block_content.remove(btn)
-    roam_orbit_tag = block_content.get(PageTag.from_string(f"#[[{ROAM_ORBIT_TAG}]]"))
-    if roam_orbit_tag:
-        block_content.remove(roam_orbit_tag)
+    """Move the roam orbit items to the end of a block
+
+    The block becomes its content, then the roam orbit buttons, tag and 
+    key-values, in the order of roam_orbit_btns and roam_orbit_keys. Runs of
+    spaces in the content are collapsed and trailing whitespace is removed.
 
-    # Remove extra whitespace
+    Takes one pass over the items, and nothing is done if the block wasn't
+    changed since it was last collapsed.
+    """
+    if block_content.canonical_version==block_content.layout_version:
+        return block_content
+    key_positions, btn_positions, tag_identity = roam_orbit_layout()
     items = block_content.block_items
-    for i in list(range(len(items[:-1])))[::-1]:
-        if items[i]==String(" ") and items[i+1]==String(" "):
-            del items[i+1]
+    # The first of each roam orbit item is moved, like get and get_kv find
+    kvs, btns, roam_orbit_tag, content = {}, {}, None, []
+    for item in items:
+        item_type = type(item)
+        if item_type==KeyValue:
+            key = item._key
+            if type(key)==str and key in key_positions and key not in kvs:
+                kvs[key] = item
+                continue
+        elif item_type==Button:
+            identity = item.identity
+            if identity in btn_positions and identity not in btns:
+                btns[identity] = item
+                continue
+        elif item_type==PageTag and roam_orbit_tag is None and item.identity==tag_identity:
+            roam_orbit_tag = item
+            continue
+        # Remove extra whitespace
+        if item_type==String and item.string==" " and content and content[-1]==item:
+            continue
+        content.append(item)
     # Remove trailing whitespace
-    items = block_content.block_items
-    while len(items)>0 and items[-1]==String(" "):
-        del items[-1]
-    if len(items)>0 and type(items[-1])==String:
-        items[-1].string = re.sub("\s*$","", items[-1].string)
-
-    for btn in btns:
-        block_content.append(String(" "))
-        block_content.append(btn)
+    while content and content[-1]==String(" "):
+        content.pop()
+    if content and type(content[-1])==String:
+        content[-1].string = re.sub("\s*$","", content[-1].string)
+
+    for identity in sorted(btns, key=btn_positions.get):
+        content.append(String(" "))
+        content.append(btns[identity])
     if roam_orbit_tag:
-        block_content.append(roam_orbit_tag)
-    for kv in kvs:
-        block_content.append(kv)
-
+        content.append(roam_orbit_tag)
+    for key in sorted(kvs, key=key_positions.get):
+        content.append(kvs[key])
+
+    # Keep the items, and their index, if nothing moved
+    if len(content)!=len(items) or any(a is not b and a!=b for a, b in zip(content, items)):
+        items[:] = content
+    block_content.canonical_version = block_content.layout_version
     return block_content
 
 
+def find_feed(block_content):
+    "Return the name of the feed specified in a block, or the default for the block"
+    if block_content.get_kv("feed"):
+        return block_content.get_kv("feed").value
+    elif block_content.get(PageRef("To-Write")) or \
+            block_content.get(PageRef("To-Think")) or \
+            block_content.get(PageTag("To-Write")) or \
+            block_content.get(PageTag("To-Think")):
+        return "ToThink"
+    return DEFAULT_FEED
+
+
 class RoamOrbiterManager:
     def __init__(self, block_content, feed_handler, schedule_hander=None, feedback_handler=None):
         self.block_content = block_content
@@ -217,9 +295,21 @@ class RoamOrbiterManager:
         self.set_feedback_handler(feedback_handler or feed_handler.get_feedback_handler())
         self.block_content.set_default(PageTag.from_string(f"#[[{ROAM_ORBIT_TAG}]]"))
     
-    def process_response(self, response_num):
+    def process_response(self, response_num, rng=None, uid=None, seed=0):
+        """Add a response to the block and schedule it
+
+        Args:
+            response_num (int)
+            rng: for the interval noise. Defaults to the schedule handler's
+            uid (str): the block's uid. If given, the noise is derived from 
+                (seed, uid, review count) with HashNoise
+            seed (int)
+        """
         self.feedback_handler.add_response(self.block_content, response_num)
-        self.schedule_handler.schedule(self.block_content, response_num)
+        if uid is not None:
+            # The review count includes this response
+            rng = HashNoise.for_block(uid, self.block_content, seed)
+        self.schedule_handler.schedule(self.block_content, response_num, rng)
 
     def set_feedback_handler(self, feedback_handler):
         if hasattr(self, "feedback_handler"):
@@ -238,32 +328,18 @@ class RoamOrbiterManager:
     @classmethod
     def from_string(cls, string, feed=None, sched=None, feedback=None):
         block_content = BlockContentKV.from_string(string)
+        block_content = convert_legacy_formats(block_content, string)
 
-        # Convert old formats to the latest one
-
-        block_content = convert_review_history(block_content)
-        block_content = convert_old_roam_orbit(block_content)
-        block_content = convert_old_key_values(block_content)
-        block_content = convert_old_thought_provoking_names(block_content)
-        block_content = convert_toreview_scheduler(block_content)
         # If a handler was specified, use that.
         # If not, check if one is specified in the string and use that if it is.
         # Otherwise, set to a default. 
 
         if not feed:
-            if block_content.get_kv("feed"):
-                feed = block_content.get_kv("feed").value
-            elif block_content.get(PageRef("To-Write")) or \
-                    block_content.get(PageRef("To-Think")) or \
-                    block_content.get(PageTag("To-Write")) or \
-                    block_content.get(PageTag("To-Think")):
-                feed = "ToThink"
-            else:
-                feed = DEFAULT_FEED
+            feed = find_feed(block_content)
         feed_handler = feed_handlers[feed]()
 
         if sched:
-            schedule_handler = schedule_handlers[sched]()
+            schedule_handler = scheduler_handlers[sched]()
         else:
             schedule_handler = None
 
@@ -280,7 +356,12 @@ class RoamOrbiterManager:
         return self.block_content.to_string()
 
 
-def main(text, action, arg):
+def main(text, action, arg, uid=None, seed=0):
+    """Run an action on a block string and return the new string
+
+    If the block's uid is given, the interval noise is derived from (seed, 
+    uid, review count) instead of coming from the random module. See HashNoise
+    """
 
     if action=="init":
         if arg=="ToReview":
@@ -306,13 +387,89 @@ def main(text, action, arg):
     elif action=="change_feedback_type":
         orbiter_manager.set_feedback_type_handler(feedback_handlers[arg]())
     elif action=="add_response":
-        orbiter_manager.process_response(int(arg))
+        orbiter_manager.process_response(int(arg), uid=uid, seed=seed)
     else:
         raise ValueError(f"'{action}' isn't a supported action")
 
     return orbiter_manager.to_string()
 
+
+def process_responses(text, response_nums, uid=None, seed=0):
+    """Add several responses to a block, in order, with one parse and one render
+
+    The same as running main(text, "add_response", response_num) on each 
+    result in turn, without parsing and rendering the block in between
+
+    Returns:
+        str: the new block string
+    """
+    orbiter_manager = RoamOrbiterManager.from_string(text)
+    for response_num in response_nums:
+        orbiter_manager.process_response(int(response_num), uid=uid, seed=seed)
+    return orbiter_manager.to_string()
+
+
+def process_record(record):
+    """Run main on a single batch record
+
+    Args:
+        record (str): json object with the keys "text", "action" and optionally 
+            "arg", and "uid" and "seed" for noise derived from the block uid
+    Returns:
+        dict: {"text": <updated block string>, "error": None} or, if the 
+            record failed, {"text": None, "error": <error message>}
+    """
+    try:
+        record = parse_record(record)
+        text = main(record["text"], record["action"], record.get("arg"), record.get("uid"), record.get("seed", 0))
+        return {"text": text, "error": None}
+    except Exception as e:
+        return record_error(record, e)
+
+
+def parse_record(record):
+    "Parse a batch record. Raises ValueError if it isn't a json object"
+    record = json.loads(record)
+    if type(record)!=dict:
+        raise ValueError("record must be a json object")
+    return record
+
+
+def record_error(record, e):
+    "Return the result of a record which failed with the exception `e`"
+    import logging
+    logging.debug("Failed to process record %r", record, exc_info=True)
+    error = f"missing key {e}" if type(e)==KeyError else str(e)
+    return {"text": None, "error": f"{type(e).__name__}: {error}"}
+
+
+def run_batch(lines, out):
+    """Process newline-delimited json records
+
+    Writes one json line to `out` for every line in `lines`, in the same order. 
+    A record which fails gets an error instead of aborting the batch.
+
+    Args:
+        lines (iterable): lines of json records eg: {"text": ..., "action": ..., "arg": ...}
+        out (file): where the results are written
+    """
+    for line in lines:
+        result = process_record(line.rstrip("\r\n"))
+        out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        out.flush()
+
+
 if __name__=="__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1]=="--batch":
+        path = sys.argv[2] if len(sys.argv)>2 else "-"
+        if path=="-":
+            run_batch(sys.stdin, sys.stdout)
+        else:
+            with open(path, encoding="utf-8") as f:
+                run_batch(f, sys.stdout)
+        sys.exit(0)
     text = sys.argv[1]
     action = sys.argv[2]
     arg = sys.argv[3] if len(sys.argv)>3 else None 
@@ -1,11 +1,100 @@
+import copy
 import random
+import hashlib
 import datetime as dt
+from handler_registry import register
+
+# Intervals are randomly adjusted by up to this fraction, so that blocks 
+# scheduled together don't stay together
+INTERVAL_NOISE = 0.125
+
+def load_numpy():
+    """Import numpy as the module's `np` the first time it's needed
+
+    numpy takes longer to import than the rest of roam_orbit and scheduling
+    a single block doesn't use it, so it isn't imported with the module.
+
+    Returns:
+        the numpy module, or None if it isn't installed
+    """
+    global np
+    if "np" not in globals():
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+    return np
+
+def __getattr__(name):
+    if name=="np":
+        return load_numpy()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def make_rng(seed=None):
+    "Random number generator for schedule_many. A random.Random if numpy isn't installed"
+    return np.random.default_rng(seed) if load_numpy() is not None else random.Random(seed)
+
+def hash_uniform(key):
+    "Number in [0, 1) derived from a hash of a string"
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2**64
+
+class HashNoise:
+    """Noise derived from a hash of (seed, block uid, review count)
+
+    A block gets the same noise on the same review whatever order the blocks
+    are scheduled in, and however they're split across threads or processes.
+    Can be used as the rng of a schedule handler or of schedule_many: 
+    random() returns a number in [0, 1) for a single block and random(n) 
+    returns one for each of the n blocks.
+
+    Args:
+        uids (list of str): uid of each block
+        review_counts (list of int): number of reviews of each block
+        seed (int)
+    """
+    def __init__(self, uids, review_counts, seed=0):
+        self.keys = [f"{seed}:{uid}:{count}" for uid, count in zip(uids, review_counts)]
+        self.draws = 0
+
+    @classmethod
+    def for_block(cls, uid, block_content, seed=0):
+        "HashNoise of a block whose response was added. Its total_count is the review count"
+        return cls([uid], [block_content.get_kv("total_count").value], seed)
+
+    def random(self, size=None):
+        if (1 if size is None else size)!=len(self.keys):
+            raise ValueError(f"HashNoise has {len(self.keys)} blocks, not {size}")
+        values = [hash_uniform(f"{key}:{self.draws}") for key in self.keys]
+        self.draws += 1
+        if size is None:
+            return values[0]
+        return np.array(values) if load_numpy() is not None else values
+
+    def split(self):
+        "Return a HashNoise for each block"
+        noises = []
+        for key in self.keys:
+            noise = copy.copy(self)
+            noise.keys = [key]
+            noises.append(noise)
+        return noises
 
 class ScheduleHandler:
-    def __init__(self, name, init_interval=1):
+    # Keys the handler adds to a block, and the keys of the factors used to 
+    # schedule. Declared on the class so they're known without making a handler
+    keys = ["schedule","interval","due"]
+    factor_keys = []
+
+    def __init__(self, name, init_interval=1, rng=None):
         self.name = name
         self.init_interval = init_interval 
-        self.keys = ["schedule","interval","due"]
+        # Random number generator for the interval noise
+        self.rng = rng or random
+        # LoadHistogram of the blocks due on each day. See get_balanced_interval
+        self.load = None
+        # Initial values of the factors
+        self.init_factors = []
 
     def update_metadata(self, block_content, btn_loc="before kvs"):
         block_content.set_kv("schedule", self.__class__.__name__)
@@ -15,50 +104,134 @@ class ScheduleHandler:
 
         return block_content
 
-    def schedule(self, block_content):
+    def schedule(self, block_content, response_num, rng=None):
         raise NotImplementedError
 
+    def schedule_many(self, intervals, factors, dues, responses, today, rng=None):
+        """Schedule many blocks at once, like `schedule` does for one
+
+        Vectorized with numpy if it's installed, otherwise a loop over the blocks.
+
+        Args:
+            intervals (sequence): interval of each block in days
+            factors (sequence): shape (len(intervals), len(self.factor_keys)).
+                The factors of each block
+            dues (sequence): due day of each block, as a number of days
+            responses (sequence): response number of each block
+            today (number): day of the responses
+            rng (np.random.Generator, random.Random without numpy or HashNoise):
+                for the interval noise. Defaults to a new unseeded one
+        Returns:
+            tuple: the next intervals and due days. np.ndarray, or lists 
+                without numpy
+        """
+        rng = rng if rng is not None else make_rng()
+        if load_numpy() is None:
+            rngs = rng.split() if type(rng)==HashNoise else [rng]*len(intervals)
+            scheduled = [self._schedule_one(*block, today, block_rng) 
+                         for *block, block_rng in zip(intervals, factors, dues, responses, rngs)]
+            return [s[0] for s in scheduled], [s[1] for s in scheduled]
+        factors = np.asarray(factors, dtype=float).reshape(len(intervals), len(self.factor_keys))
+        return self._schedule_arrays(np.asarray(intervals, dtype=float), factors, np.asarray(dues, dtype=float),
+                                     np.asarray(responses, dtype=int), today, rng)
+
+    def _schedule_one(self, interval, factors, due, response, today, rng):
+        raise NotImplementedError
 
+    def _schedule_arrays(self, intervals, factors, dues, responses, today, rng):
+        raise NotImplementedError
+
+    def get_balanced_interval(self, interval, factor, rng=None, today=None):
+        """get_next_interval, but on the least loaded day of the noise window
+
+        Without a load histogram it's the same as get_next_interval. With one,
+        the interval is the one within INTERVAL_NOISE of interval*factor whose
+        day has the fewest blocks due, the closest to the noisy interval if 
+        several days have the fewest.
+
+        Args:
+            today (date): defaults to today
+        """
+        next_interval = self.get_next_interval(interval, factor, rng)
+        if self.load is None or interval == 0:
+            return next_interval
+        exact = interval * factor
+        shortest = max(1, round(exact * (1 - INTERVAL_NOISE)))
+        longest = max(shortest, round(exact * (1 + INTERVAL_NOISE)))
+        today = (today or dt.date.today()).toordinal()
+        return self.load.least_loaded(today + shortest, today + longest, today + next_interval) - today
+
+    def move_load(self, old_due, new_due):
+        "Move a block from its old due date to its new one in the load histogram"
+        if self.load is not None:
+            self.load.move(old_due if type(old_due)==dt.datetime else None, new_due)
+
+    def get_next_intervals(self, intervals, factors, rng):
+        "Vectorized get_next_interval"
+        load_numpy()
+        next_intervals = intervals * factors
+        noise = next_intervals * (INTERVAL_NOISE * (2*rng.random(len(intervals)) - 1))
+        return np.where(intervals==0, 1, np.rint(next_intervals + noise))
+
+
+@register("schedule")
 class ExpDefault(ScheduleHandler):
-    def __init__(self, init_interval=1, init_factor=2):
-        super().__init__("ExpSpacer", init_interval)
+    factor_keys = ["factor"]
+    keys = ScheduleHandler.keys + factor_keys
+
+    def __init__(self, init_interval=1, init_factor=2, rng=None):
+        super().__init__("ExpSpacer", init_interval, rng)
         self.init_factor = init_factor
-        self.keys += ["factor"]
+        self.init_factors = [init_factor]
 
     def update_metadata(self, block_content):
         super().update_metadata(block_content)
         block_content.set_default_kv("factor", self.init_factor)
 
-    def schedule(self, block_content, response):
+    def schedule(self, block_content, response, rng=None):
         interval = block_content.get_kv("interval")
         factor = block_content.get_kv("factor")
         due = block_content.get_kv("due")
 
-        interval.value = self.get_next_interval(interval.value, factor.value)
+        interval.value = self.get_next_interval(interval.value, factor.value, rng)
         due.value = dt.datetime.now() + dt.timedelta(days=interval.value)
 
         return block_content
 
-    def get_next_interval(self, interval, factor):
+    def _schedule_one(self, interval, factors, due, response, today, rng):
+        interval = self.get_next_interval(interval, factors[0], rng)
+        return interval, today + interval
+
+    def _schedule_arrays(self, intervals, factors, dues, responses, today, rng):
+        intervals = self.get_next_intervals(intervals, factors[:,0], rng)
+        return intervals, today + intervals
+
+    def get_next_interval(self, interval, factor, rng=None):
         if interval == 0:
             return 1 
+        rng = rng or self.rng
         next_interval = interval * factor
-        noise = next_interval * (0.125 * (2*random.random() - 1))
+        noise = next_interval * (INTERVAL_NOISE * (2*rng.random() - 1))
         next_interval = round(next_interval + noise)
         return next_interval
 
 
+@register("schedule")
 class ExpReset(ScheduleHandler):
-    def __init__(self, init_interval=1, init_factor=2):
-        super().__init__("ExpSpacer", init_interval)
+    factor_keys = ["factor"]
+    keys = ScheduleHandler.keys + factor_keys
+
+    def __init__(self, init_interval=1, init_factor=2, rng=None, load=None):
+        super().__init__("ExpSpacer", init_interval, rng)
+        self.load = load
         self.init_factor = init_factor
-        self.keys += ["factor"]
+        self.init_factors = [init_factor]
 
     def update_metadata(self, block_content):
         super().update_metadata(block_content)
         block_content.set_default_kv("factor", self.init_factor)
 
-    def schedule(self, block_content, response_num):
+    def schedule(self, block_content, response_num, rng=None):
         interval = block_content.get_kv("interval")
         factor = block_content.get_kv("factor")
         due = block_content.get_kv("due")
@@ -66,66 +239,109 @@ class ExpReset(ScheduleHandler):
         if response_num==0:
             pass # leave the interval the same
         else:
-            interval.value = self.get_next_interval(interval.value, factor.value)
+            interval.value = self.get_balanced_interval(interval.value, factor.value, rng)
+        old_due = due.value
         due.value = dt.datetime.now() + dt.timedelta(days=interval.value)
+        self.move_load(old_due, due.value)
 
         return block_content
 
-    def get_next_interval(self, interval, factor):
+    def _schedule_one(self, interval, factors, due, response, today, rng):
+        if response!=0:
+            interval = self.get_next_interval(interval, factors[0], rng)
+        return interval, today + interval
+
+    def _schedule_arrays(self, intervals, factors, dues, responses, today, rng):
+        next_intervals = self.get_next_intervals(intervals, factors[:,0], rng)
+        # Leave the interval the same for response 0
+        intervals = np.where(responses==0, intervals, next_intervals)
+        return intervals, today + intervals
+
+    def get_next_interval(self, interval, factor, rng=None):
         if interval == 0:
             return 1 
+        rng = rng or self.rng
         next_interval = interval * factor
-        noise = next_interval * (0.125 * (2*random.random() - 1))
+        noise = next_interval * (INTERVAL_NOISE * (2*rng.random() - 1))
         next_interval = round(next_interval + noise)
         return next_interval
 
 
+@register("schedule")
 class ExpVarFactor(ScheduleHandler):
     """
     TODO: this scheduler feels like it should be encapsulated 
     with the feedback interface.
     """
-    def __init__(self, init_interval=1, factor_short=2, factor_long=3):
-        super().__init__("ExpSpacer", init_interval)
+    factor_keys = ["factor_short","factor_long"]
+    keys = ScheduleHandler.keys + factor_keys
+
+    def __init__(self, init_interval=1, factor_short=2, factor_long=3, rng=None, load=None):
+        super().__init__("ExpSpacer", init_interval, rng)
+        self.load = load
         self.factor_short = factor_short
         self.factor_long = factor_long
-        self.keys += ["factor_short","factor_long"]
+        self.init_factors = [factor_short, factor_long]
 
     def update_metadata(self, block_content):
         super().update_metadata(block_content)
         block_content.set_default_kv("factor_short", self.factor_short)
         block_content.set_default_kv("factor_long", self.factor_long)
 
-    def schedule(self, block_content, response_num):
+    def schedule(self, block_content, response_num, rng=None):
         interval = block_content.get_kv("interval")
         due = block_content.get_kv("due")
         factor_short = block_content.get_kv("factor_short")
         factor_long = block_content.get_kv("factor_long")
 
         if response_num==0:
-            interval.value = self.get_next_interval(interval.value, factor_short.value)
+            interval.value = self.get_balanced_interval(interval.value, factor_short.value, rng)
         elif response_num==1:
-            interval.value = self.get_next_interval(interval.value, factor_long.value)
+            interval.value = self.get_balanced_interval(interval.value, factor_long.value, rng)
         else:
             raise ValueError(f"ExpVarFactor doesn't support response_num={response_num}")
+        old_due = due.value
         due.value = dt.datetime.now() + dt.timedelta(days=interval.value)
+        self.move_load(old_due, due.value)
 
         return block_content
 
-    def get_next_interval(self, interval, factor):
+    def _schedule_one(self, interval, factors, due, response, today, rng):
+        if response not in (0, 1):
+            raise ValueError(f"ExpVarFactor doesn't support response_num={response}")
+        interval = self.get_next_interval(interval, factors[response], rng)
+        return interval, today + interval
+
+    def _schedule_arrays(self, intervals, factors, dues, responses, today, rng):
+        if ((responses!=0) & (responses!=1)).any():
+            raise ValueError("ExpVarFactor only supports response_num 0 and 1")
+        # factor_short for response 0 and factor_long for response 1
+        factors = factors[np.arange(len(responses)), responses]
+        intervals = self.get_next_intervals(intervals, factors, rng)
+        return intervals, today + intervals
+
+    def get_next_interval(self, interval, factor, rng=None):
         if interval == 0:
             return 1 
+        rng = rng or self.rng
         next_interval = interval * factor
-        noise = next_interval * (0.125 * (2*random.random() - 1))
+        noise = next_interval * (INTERVAL_NOISE * (2*rng.random() - 1))
         next_interval = round(next_interval + noise)
         return next_interval
 
 
+@register("schedule")
 class Periodically(ScheduleHandler):
-    def __init__(self, days=7):
-        super().__init__("Periodically", init_interval=days)
+    def __init__(self, days=7, rng=None):
+        super().__init__("Periodically", init_interval=days, rng=rng)
 
-    def schedule(self, block_content):
+    def schedule(self, block_content, response_num=None, rng=None):
         due = block_content.get_kv("due")
         interval = block_content.get_kv("interval")
         due.value = due.value + dt.timedelta(days=interval.value)
+
+    def _schedule_one(self, interval, factors, due, response, today, rng):
+        return interval, due + interval
+
+    def _schedule_arrays(self, intervals, factors, dues, responses, today, rng):
+        return intervals, dues + intervals
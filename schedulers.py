@@ -1,9 +1,37 @@
-import random 
+import random
+from schedule_handlers import load_numpy
 
-def sm2(interval, factor, first_interval=1):
+def sm2(interval, factor, first_interval=1, rng=random):
     if interval == 0:
-        return first_interval 
+        return first_interval
     next_interval = interval * factor
-    noise = int(next_interval * (0.125 * (random.randint(0,3) - 1)))
+    # Same as random.randint(0,3), but only needs rng.random()
+    noise = int(next_interval * (0.125 * (int(4*rng.random()) - 1)))
     next_interval = next_interval + noise
-    return next_interval
\ No newline at end of file
+    return next_interval
+
+def sm2_many(intervals, factors, first_interval=1, rng=None):
+    """sm2 for many intervals at once
+
+    Vectorized with numpy if it's installed, otherwise a loop over sm2.
+
+    Args:
+        intervals (sequence): current intervals
+        factors (sequence or number): factor of each interval
+        rng (np.random.Generator, random.Random without numpy or 
+            schedule_handlers.HashNoise): for the noise
+    Returns:
+        np.ndarray or list without numpy: the next intervals
+    """
+    np = load_numpy()
+    if np is None:
+        rng = rng or random.Random()
+        if type(factors) in (int, float):
+            factors = [factors]*len(intervals)
+        rngs = rng.split() if hasattr(rng, "split") else [rng]*len(intervals)
+        return [sm2(i, f, first_interval, r) for i, f, r in zip(intervals, factors, rngs)]
+    rng = rng if rng is not None else np.random.default_rng()
+    intervals = np.asarray(intervals, dtype=float)
+    next_intervals = intervals * factors
+    noise = np.trunc(next_intervals * (0.125 * (np.floor(4*rng.random(len(intervals))) - 1)))
+    return np.where(intervals==0, first_interval, next_intervals + noise)
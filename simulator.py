@@ -0,0 +1,148 @@
+"""
+Simulate the daily review load of a deck of orbiter blocks
+
+The deck is a set of numpy arrays with one entry per card. Every simulated day,
+the cards which are due get a random response and are rescheduled all at once
+by the schedule handler's `schedule_many`, so the rules are the same ones used
+on real blocks.
+
+    python simulator.py --feed ToReview --cards 100000 --years 5
+    python simulator.py --schedule ExpVarFactor --param factor_long=4 --new-per-day 20
+"""
+import inspect
+import argparse
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from roam_orbit import feed_handlers, scheduler_handlers, registry
+
+
+class Deck:
+    """Cards as numpy arrays
+
+    Attributes:
+        interval (np.ndarray): interval of each card in days
+        due (np.ndarray): day each card is due
+        factors (np.ndarray): shape (cards, len(handler.factor_keys))
+        counters (np.ndarray): shape (cards, responses). Number of each response
+    """
+    def __init__(self, handler, num_responses, capacity):
+        self.handler = handler
+        self.size = 0
+        self.interval = np.zeros(capacity)
+        self.due = np.zeros(capacity)
+        self.factors = np.zeros((capacity, len(handler.factor_keys)))
+        self.counters = np.zeros((capacity, num_responses), dtype=np.int64)
+
+    def add(self, n, today):
+        "Add n new cards, set up the way update_metadata sets up a new block"
+        new = slice(self.size, self.size + n)
+        self.interval[new] = self.handler.init_interval
+        self.due[new] = today + self.handler.init_interval
+        self.factors[new] = self.handler.init_factors
+        self.size += n
+
+    def get_due(self, today):
+        "Return the indices of the cards due by today, most overdue first"
+        due = np.flatnonzero(self.due[:self.size] <= today)
+        return due[np.argsort(self.due[due], kind="stable")]
+
+    def respond(self, cards, responses, today, rng):
+        self.counters[cards, responses] += 1
+        self.interval[cards], self.due[cards] = self.handler.schedule_many(
+            self.interval[cards], self.factors[cards], self.due[cards], responses, today, rng)
+
+
+def simulate(handler, response_probs, days, cards=0, new_per_day=0, review_seconds=10,
+             max_reviews_per_day=None, seed=0):
+    """Simulate reviewing a deck every day
+
+    Args:
+        handler (ScheduleHandler): schedules the cards
+        response_probs (list of float): probability of each response
+        days (int): number of days to simulate
+        cards (int): number of cards on the first day
+        new_per_day (int): number of cards added every day
+        review_seconds (float): time to review a card
+        max_reviews_per_day (int): at most this many cards are reviewed a day,
+            the most overdue first. The rest are the backlog. None for no limit
+        seed (int): seed for the random number generator
+    Returns:
+        dict: arrays with a value per day of the number of "reviews", the
+            "review_minutes" and the "backlog" of due cards left unreviewed
+    """
+    if np is None:
+        raise ImportError("the simulator needs numpy")
+    rng = np.random.default_rng(seed)
+    response_probs = np.asarray(response_probs, dtype=float)
+    deck = Deck(handler, len(response_probs), cards + new_per_day*days)
+    deck.add(cards, 0)
+    reviews = np.zeros(days, dtype=np.int64)
+    backlog = np.zeros(days, dtype=np.int64)
+    for today in range(days):
+        deck.add(new_per_day, today)
+        due = deck.get_due(today)
+        reviewed = due[:max_reviews_per_day]
+        responses = rng.choice(len(response_probs), size=len(reviewed), p=response_probs)
+        deck.respond(reviewed, responses, today, rng)
+        reviews[today] = len(reviewed)
+        backlog[today] = len(due) - len(reviewed)
+    return {"reviews": reviews, "review_minutes": reviews * review_seconds / 60, "backlog": backlog}
+
+
+def make_handler(feed, schedule=None, params=()):
+    """Return the schedule handler of a feed with some parameters changed
+
+    Args:
+        feed (ToReview or ToThink)
+        schedule (str): name of a schedule handler to use instead of the feed's
+        params (list): (name, value) pairs of handler parameters. The others 
+            are the feed's, or the handler's defaults for another schedule
+    """
+    default = feed.get_schedule_handler()
+    cls = scheduler_handlers[schedule] if schedule else type(default)
+    kwargs = {}
+    if cls==type(default):
+        kwargs = {name: getattr(default, name) for name in inspect.signature(cls).parameters 
+                  if hasattr(default, name)}
+    kwargs.update(params)
+    return cls(**kwargs)
+
+
+def parse_param(string):
+    "Parse a handler parameter given as key=value"
+    key, value = string.split("=", 1)
+    return key, float(value) if "." in value else int(value)
+
+
+if __name__=="__main__":
+    # So the handlers of other packages are choices too
+    registry.load_entry_points()
+    parser = argparse.ArgumentParser(description="Simulate the daily review load of a deck of orbiter blocks")
+    parser.add_argument("--feed", default="ToReview", choices=list(feed_handlers))
+    parser.add_argument("--schedule", choices=list(scheduler_handlers),
+                        help="schedule handler. Defaults to the feed's")
+    parser.add_argument("--param", action="append", type=parse_param, default=[],
+                        help="schedule handler parameter, eg: factor_long=4")
+    parser.add_argument("--responses", type=float, nargs="+",
+                        help="probability of each response. Defaults to all equally likely")
+    parser.add_argument("--cards", type=int, default=100000, help="cards on the first day")
+    parser.add_argument("--new-per-day", type=int, default=0)
+    parser.add_argument("--years", type=float, default=5)
+    parser.add_argument("--review-seconds", type=float, default=10)
+    parser.add_argument("--max-reviews-per-day", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    feed = feed_handlers[args.feed]()
+    handler = make_handler(feed, args.schedule, args.param)
+    num_responses = len(feed.get_feedback_handler().responses)
+    response_probs = args.responses or [1/num_responses]*num_responses
+
+    result = simulate(handler, response_probs, int(args.years*365), args.cards, args.new_per_day,
+                      args.review_seconds, args.max_reviews_per_day, args.seed)
+    minutes = result["review_minutes"]
+    print(f"review minutes per day: mean {minutes.mean():.1f}  median {np.median(minutes):.1f}  "\
+          f"95th percentile {np.percentile(minutes, 95):.1f}  max {minutes.max():.1f}")
+    print(f"backlog at the end: {result['backlog'][-1]} cards")
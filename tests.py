@@ -1,7 +1,28 @@
+import os
+import tempfile
 import unittest
 import datetime as dt
 from roam_orbit import *
 from date_helpers import strftime_roam
+from handler_registry import registry, CACHE_PATH
+
+CACHE_DIR = tempfile.TemporaryDirectory()
+XDG_CACHE_HOME = os.environ.get("XDG_CACHE_HOME")
+
+def setUpModule():
+    # Keep the handler manifest of the tests out of the user's cache, in this
+    # process and the ones the tests start
+    os.environ["XDG_CACHE_HOME"] = CACHE_DIR.name
+    registry.cache_path = os.path.join(CACHE_DIR.name, "roam_orbit", "handler_manifest.json")
+    registry.manifest(refresh=True)
+
+def tearDownModule():
+    if XDG_CACHE_HOME is None:
+        os.environ.pop("XDG_CACHE_HOME", None)
+    else:
+        os.environ["XDG_CACHE_HOME"] = XDG_CACHE_HOME
+    registry.cache_path = CACHE_PATH
+    CACHE_DIR.cleanup()
 
 class TestRoamOrbiterManager(unittest.TestCase):
     def setUp(self):
@@ -59,6 +80,43 @@ class TestConverters(unittest.TestCase):
         orbiter = RoamOrbiterManager.from_string(text)
         orbiter.process_response(0)
 
+    def test_legacy_formats(self):
+        texts = [
+            "Some thing {{↑}} {{↓}}#[[Roam Orbiter]]#[[feed: ToReview]]#[[schedule: ExpVarFactor]] ",
+            "Some thing {{cool}} {{meh}} {{boring}} #[[type: x]] #[[interval: 3]] #[[factor: 2]] "\
+                "#[[due: 2020-01-01]] #[[count0: 1]] #[[count1: 1]] #[[count2: 0]]",
+            "Some thing #SomedayMaybe {{Review History: {\"Interval\": 4, \"Next Review\": \"[[due: 2020-06-30]]\"}}}",
+            "Some thing {{thought-provoking}} {{not}} #[[[[feed]]: ToThink]] #[[[[not_count]]: 2]]",
+            "Some thing #[[feed: ToReview]] #[[schedule: ExpDefault]] #[[factor: 2]]",
+        ]
+        converters = [convert_review_history, convert_old_roam_orbit, convert_old_key_values,
+                      convert_old_thought_provoking_names, convert_toreview_scheduler]
+        for text in texts:
+            expected = BlockContentKV.from_string(text)
+            for convert in converters:
+                expected = convert(expected)
+            output = convert_legacy_formats(BlockContentKV.from_string(text), text)
+            # The feedback name is left to the feedback handler
+            for block_content in (expected, output):
+                kv = block_content.get_kv("feedback")
+                if kv: block_content.remove(kv)
+            self.assertEqual(output.to_string(), expected.to_string())
+
+
+    def test_collapse(self):
+        text = "Some #[[interval: 3]] thing {{↓}} #[[Roam Orbiter]] with #[[feed: ToReview]] {{↑}} prose #[[other: 1]] "
+        block_content = collapse_roam_orbit(BlockContentKV.from_string(text))
+        collapsed = "Some  thing   with   prose #[[other: 1]] {{↑}} {{↓}}#[[Roam Orbiter]]#[[feed: ToReview]]#[[interval: 3]]"
+        self.assertEqual(block_content.to_string(), collapsed)
+        items = list(block_content.block_items)
+        self.assertEqual(collapse_roam_orbit(block_content).to_string(), collapsed)
+        self.assertTrue(all(a is b for a, b in zip(items, block_content.block_items)))
+        # Changes after it was collapsed are collapsed again
+        block_content.insert(0, KeyValue("factor", 2))
+        block_content.get_kv("other").key = "total_count"
+        self.assertEqual(collapse_roam_orbit(block_content).to_string(), "Some  thing   with   prose {{↑}} {{↓}}"\
+                         "#[[Roam Orbiter]]#[[feed: ToReview]]#[[interval: 3]]#[[factor: 2]]#[[total_count: 1]]")
+
 
 class TestKeyValue(unittest.TestCase):
     def test(self):
@@ -88,6 +146,729 @@ class TestKeyValue(unittest.TestCase):
         kv = KeyValue.from_item(item)
         self.assertEqual(item.to_string(), kv.to_string())
 
+    def test_lazy_value(self):
+        text = "Some thing [[interval: 2.50]] #[[due: 2020-8-1]] #[[due: [[August 1st, 2020]]]]"
+        block_content = BlockContentKV.from_string(text)
+        self.assertEqual(block_content.to_string(), text)
+        interval, due, due_ref = [o for o in block_content.block_items if type(o)==KeyValue]
+        self.assertEqual(interval._raw_value, "2.50")
+        self.assertEqual(due.value, dt.datetime(2020, 8, 1))
+        self.assertEqual(due_ref.value, dt.datetime(2020, 8, 1))
+        self.assertEqual(block_content.to_string(), text)
+        interval.value += 1
+        self.assertEqual(interval.to_string(), "#[[interval: 3.5]]")
+
+    def test_parse_date(self):
+        self.assertEqual(KeyValue.parse_date("2020-08-10"), dt.datetime(2020, 8, 10))
+        self.assertEqual(KeyValue.parse_date("2020-8-1"), dt.datetime(2020, 8, 1))
+        self.assertEqual(KeyValue.parse_date("August 1st, 2020"), dt.datetime(2020, 8, 1))
+        for string in ["2020-02-30", "ToReview", "Vote, ToReview", ""]:
+            self.assertEqual(KeyValue.parse_date(string), string)
+        now = dt.datetime.now()
+        self.assertEqual(strftime_roam(now), strftime_roam(now.date()))
+
+
+class TestBlockContent(unittest.TestCase):
+    strings = [
+        "Some thing I want to review later {{↑}} {{↓}} #[[[[feed]]:ToReview]] "\
+        "#[[[[schedule]]:ExpDefault]] #[[[[interval]]:2]] #[[[[due]]:[[August 8th, 2020]]]] #[[[[factor]]:3]] "\
+        "#[[[[feedback]]:Vote]] #[[[[↑_count]]:0]] #[[[[↓_count]]:0]]",
+        """{{[[TODO]]}} Look into how hard is it to get a pilot's license. #SomedayMaybe {{Review History: {"Interval": 4, "Past Reviews": ["[[reviewed: 2020-06-21]]"], "Next Review": "[[due: 2020-06-30]]"}}}""",
+        "#[[key: 2020-10-03]] #[[[[key]]:[[value]]]] #[[[[key]][[:]][[value]]]]",
+        "key:: [[a [[b]] c]] ((abcdefghi)) ![alt](http://x.com/a.png) [alias]([[Some Page]]) [ext](http://example.com)",
+        "```clojure\n(+ 1 2)``` {c1:cloze} {plain} [[{c2:]]pageref cloze[[}]] {{[[embed]]: ((abcdefghi))}} {{a:b}}",
+        "#[[x #y]] [[unclosed #[[c]] and [[[triple]]]",
+        # An unclosed "[[" cut by a higher priority item doesn't pair with the brackets after it
+        "#}}][[{{#((abcdefghi))[((abcdefghi))[[]])c1:```",
+        "[[unclosed #tag [[x]] #[[y]] {{b}} [[z]]",
+        "[[x ```code``` [[y]] [al]([[p]])",
+    ]
+
+    def test_single_pass_matches_multipass(self):
+        for string in self.strings:
+            single = BlockContent.find_and_replace(string)
+            multi = BlockContent.find_and_replace_multipass(string)
+            self.assertEqual(
+                [(type(o), o.to_string()) for o in single],
+                [(type(o), o.to_string()) for o in multi])
+
+    def test_patterns_are_compiled_once(self):
+        self.assertIs(Button.get_pattern(), Button.get_pattern())
+        self.assertIs(Attribute.get_pattern(anchored=True), Attribute.get_pattern(anchored=True))
+        # Patterns built from page refs are shared by strings with the same page refs
+        self.assertIs(PageRef.get_pattern("a [[b]] c"), PageRef.get_pattern("[[b]]"))
+        self.assertIsNone(PageRef.get_pattern("no page refs"))
+        self.assertTrue(PageTag.validate_string("#[[a [[b]]]]"))
+        self.assertFalse(PageRef.validate_string("no page refs"))
+
+
+class TestPageRefIndex(unittest.TestCase):
+    def test_spans(self):
+        index = PageRefIndex("a [[b [[c]] d]] ]] [[e]] [[f")
+        self.assertEqual(index.spans, [(2, 15, 0), (6, 11, 1), (19, 24, 0)])
+        self.assertEqual(index.opens[25], (None, 0))
+        self.assertEqual(
+            PageRef.extract_page_ref_strings("a [[b [[c]] d]] ]] [[e]] [[f"),
+            ["[[b [[c]] d]]", "[[e]]"])
+
+    def test_nested_titles(self):
+        item = PageTag.from_string("#[[[[key]][[:]][[value]]]]")
+        self.assertEqual([type(o) for o in item._title], [PageRef, PageRef, PageRef])
+        self.assertEqual(item._title[2].title, "value")
+        item = PageRef.from_string("[[a [[b [[c]]]] d]]")
+        self.assertEqual([o.to_string() for o in item._title], ["a ", "[[b [[c]]]]", " d"])
+        self.assertEqual(item._title[1]._title[1].title, "c")
+
+    def test_runs(self):
+        strings = [
+            # A copy of a top level page ref in an unclosed "[[" is a page ref
+            "[[a]] [[b [[a]]",
+            "[[a]] #[[b [[a]] #[[a]] [c](([[a]]))",
+            # The brackets after an item aren't paired with the ones before it
+            "[[a ((abcdefghi)) [[]] [[a]]",
+            "[[x ```[[y]]``` [[y]]",
+        ]
+        for string in strings:
+            self.assertEqual(
+                [(type(o), o.to_string()) for o in BlockContent.find_and_replace(string)],
+                [(type(o), o.to_string()) for o in BlockContent.find_and_replace_multipass(string)])
+        index = PageRefIndex("[[a]] [[b [[a]] [[a]]")
+        self.assertEqual(index.copy_end_at(10), 15)
+        self.assertIsNone(index.from_position(5).copy_end_at(10))
+        # The known difference: the "]]" of the button closes "[[b" when pairing
+        # to the end of the string, so the first "[[a]]" is a copy of the last
+        string = "[[b [[a]] {{c]]}} [[a]]"
+        self.assertEqual([type(o) for o in BlockContent.find_and_replace(string)][:2], [String, PageRef])
+        self.assertEqual([type(o) for o in BlockContent.find_and_replace_multipass(string)][:2], [String, Button])
+
+
+class TestBatch(unittest.TestCase):
+    def test_run_batch(self):
+        import io
+        lines = [
+            json.dumps({"text": "Some thing I want to review later", "action": "init", "arg": "ToReview"}),
+            "not json",
+            json.dumps({"text": "Some thing", "action": "fly"}),
+        ]
+        out = io.StringIO()
+        run_batch(lines, out)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]["text"], main("Some thing I want to review later", "init", "ToReview"))
+        self.assertIsNone(results[0]["error"])
+        self.assertIsNone(results[1]["text"])
+        self.assertTrue(results[1]["error"].startswith("JSONDecodeError"))
+        self.assertEqual(results[2]["error"], "ValueError: 'fly' isn't a supported action")
+
+
+class TestServer(unittest.TestCase):
+    def test_post_record(self):
+        import threading
+        import http.client
+        from orbit_server import make_server
+        server = make_server(port=0, workers=2)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            record = {"text": "Some thing I want to review later", "action": "init", "arg": "ToReview"}
+            conn = http.client.HTTPConnection(*server.server_address)
+            conn.request("POST", "/", json.dumps(record))
+            result = json.loads(conn.getresponse().read())
+            self.assertEqual(result, {"text": main(record["text"], "init", "ToReview"), "error": None})
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_bad_request(self):
+        import threading
+        import http.client
+        from orbit_server import make_server
+        server = make_server(port=0, workers=2)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            conn = http.client.HTTPConnection(*server.server_address)
+            conn.request("POST", "/", b"\xff\xfe")
+            response = conn.getresponse()
+            self.assertEqual(response.status, 400)
+            self.assertTrue(json.loads(response.read())["error"].startswith("request body isn't valid utf-8"))
+            conn = http.client.HTTPConnection(*server.server_address)
+            conn.putrequest("POST", "/")
+            conn.putheader("Content-Length", "abc")
+            conn.endheaders()
+            response = conn.getresponse()
+            self.assertEqual(response.status, 400)
+            self.assertTrue(json.loads(response.read())["error"].startswith("invalid Content-Length"))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestReschedule(unittest.TestCase):
+    def test_parallel_matches_serial(self):
+        from reschedule import reschedule_export
+        from roam.export import iter_blocks
+        orbiter = "Block %d #[[Roam Orbiter]] {{↑}} {{↓}} #[[feed: ToReview]] #[[schedule: ExpVarFactor]] "\
+                  "#[[interval: %d]] #[[due: 2020-08-10]] #[[factor_short: 2]] #[[factor_long: 3]] "\
+                  "#[[feedback: Vote]] #[[↑_count: 0]] #[[↓_count: 0]] #[[total_count: 0]]"
+        pages = [{"title": f"Page {p}", "children": [
+            {"uid": f"{p}-{b}", "string": orbiter % (b, 10 + b) if b%2 else "Not an orbiter", "children": [
+                {"uid": f"{p}-{b}-child", "string": "Child #[[Roam Orbiter]]"}]}
+            for b in range(4)]} for p in range(3)]
+        kwargs = {"action": "add_response", "arg": "1", "seed": 1}
+        serial = list(reschedule_export(iter_blocks(pages), workers=1, **kwargs))
+        parallel = list(reschedule_export(iter_blocks(pages), workers=2, chunksize=2, **kwargs))
+        self.assertEqual(serial, parallel)
+        self.assertEqual([r["uid"] for r in serial][:3], ["0-0-child", "0-1", "0-1-child"])
+
+    def test_hash_noise(self):
+        from reschedule import reschedule, reschedule_many
+        orbiter = "Block %d #[[Roam Orbiter]] {{↑}} {{↓}} #[[feed: ToReview]] #[[schedule: ExpVarFactor]] "\
+                  "#[[interval: 8]] #[[due: 2020-08-10]] #[[factor_short: 2]] #[[factor_long: 3]] "\
+                  "#[[feedback: Vote]] #[[↑_count: 0]] #[[↓_count: 0]] #[[total_count: %d]]"
+        blocks = [("Page", f"uid{i}", orbiter % (i, i%2)) for i in range(8)]
+        kwargs = {"action": "add_response", "arg": "1", "seed": 1, "hash_noise": True}
+        serial = list(reschedule(blocks, workers=1, **kwargs))
+        self.assertEqual(serial, list(reschedule(blocks, workers=2, chunksize=3, **kwargs)))
+        self.assertEqual(serial, reschedule_many(blocks, 1, seed=1, hash_noise=True))
+        self.assertEqual(serial[0], list(reschedule(blocks[:1], workers=1, **kwargs))[0])
+        self.assertEqual(main(blocks[0][2], "add_response", "1", "uid0", 1), serial[0]["string"])
+
+    def test_bulk(self):
+        from reschedule import reschedule_many
+        orbiter = "Block %d #[[Roam Orbiter]] {{↑}} {{↓}} #[[feed: ToReview]] #[[schedule: ExpVarFactor]] "\
+                  "#[[interval: 8]] #[[due: 2020-08-10]] #[[factor_short: 2]] #[[factor_long: 3]] "\
+                  "#[[feedback: Vote]] #[[↑_count: 0]] #[[↓_count: 0]] #[[total_count: 0]]"
+        think = "Think #[[Roam Orbiter]] {{thought-provoking}} {{not}} #[[feed: ToThink]] "\
+                "#[[interval: 5]] #[[due: 2020-08-10]]"
+        blocks = [("Page", f"uid{i}", orbiter % i) for i in range(10)] + [("Page", "think", think)]
+        blocks += [("Page", "other", "Not an orbiter")]
+        results = reschedule_many(blocks, 1, {"factor_long": 4}, feed="ToReview", seed=1)
+        self.assertEqual(results, reschedule_many(blocks, 1, {"factor_long": 4}, feed="ToReview", seed=1))
+        self.assertEqual([r["uid"] for r in results], [f"uid{i}" for i in range(10)])
+        for result in results:
+            block_content = BlockContentKV.from_string(result["string"])
+            interval = block_content.get_kv("interval").value
+            self.assertTrue(28 <= interval <= 36)
+            self.assertEqual(block_content.get_kv("factor_long").value, 4)
+            self.assertEqual(block_content.get_kv("↓_count").value, 1)
+            self.assertEqual(block_content.get_kv("due").value.date(), 
+                             dt.date.today() + dt.timedelta(days=interval))
+
+    def test_bulk_needs_arg(self):
+        import sys
+        import subprocess
+        result = subprocess.run([sys.executable, "reschedule.py", "export.json", "--bulk"], capture_output=True, text=True)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("--bulk needs the response number as --arg", result.stderr)
+
+
+class TestExport(unittest.TestCase):
+    def test_stream_matches_load(self):
+        import io
+        from roam.export import iter_export_blocks, iter_blocks
+        pages = [
+            {"title": "Page", "children": [
+                {"string": "a \"quoted\" [[Roam Orbiter]] ↑\n", "uid": "a", "refs": [{"uid": "r", "string": "no"}],
+                 "children": [{"string": "child", "uid": "b", "edit-time": 1.5e3, "open": True}]},
+                {"uid": "c", "string": "after", "heading": None}]},
+            {"title": "No children"},
+            {"title": "Empty", "children": []},
+        ]
+        for chunk_size in [1, 3, 64]:
+            blocks = iter_export_blocks(io.StringIO(json.dumps(pages, indent=1)), chunk_size=chunk_size)
+            self.assertEqual(list(blocks), list(iter_blocks(pages)))
+        blocks = iter_export_blocks(io.StringIO(json.dumps(pages)), contains="[[Roam Orbiter]]")
+        self.assertEqual([uid for _, uid, _ in blocks], ["a"])
+
+    def test_children_first(self):
+        import io
+        from roam.export import iter_export_blocks, iter_blocks
+        pages = [{"children": [{"children": [{"string": "child [[Roam Orbiter]]", "uid": "c"}],
+                                "string": "parent [[Roam Orbiter]]", "uid": "p"}], "title": "P"}]
+        for contains in [None, "Roam Orbiter"]:
+            blocks = list(iter_export_blocks(io.StringIO(json.dumps(pages)), contains=contains))
+            # The parent comes after its child, but nothing is lost
+            self.assertEqual(blocks, [("P", "c", "child [[Roam Orbiter]]"), ("P", "p", "parent [[Roam Orbiter]]")])
+            self.assertEqual(sorted(blocks), sorted(iter_blocks(pages, contains)))
+
+
+class TestBlockContentKV(unittest.TestCase):
+    def assertIndexMatchesScan(self, block_content):
+        items = block_content.block_items
+        for key in ["feed", "interval", "due", "missing"]:
+            expected = next((o for o in items if type(o)==KeyValue and o.key==key), None)
+            self.assertIs(block_content.get_kv(key), expected)
+        for item in [Button("↑"), Button("↓"), PageTag.from_string("#[[Roam Orbiter]]"), PageRef("Page")]:
+            expected = next((i for i, o in enumerate(items) if o==item), None)
+            self.assertEqual(block_content.index(item), expected)
+
+    def test_index_follows_changes(self):
+        block_content = BlockContentKV.from_string(
+            "Text [[Page]] {{↑}} {{↓}} #[[Roam Orbiter]] #[[feed: ToReview]] #[[interval: 2]] #[[due: 2020-08-10]]")
+        self.assertIndexMatchesScan(block_content)
+        block_content.remove(Button("↑"))
+        block_content.insert(0, Button("↑"))
+        self.assertIndexMatchesScan(block_content)
+        block_content.get_kv("feed").key = "old_feed"
+        block_content.set_kv("interval", 5)
+        block_content.delete_kv("due")
+        self.assertIndexMatchesScan(block_content)
+        items = block_content.block_items
+        items[items.index(PageRef("Page"))] = String("No page")
+        del items[0]
+        items.append(KeyValue("feed", "ToThink"))
+        items.insert(0, KeyValue("due", "2020-01-01"))
+        self.assertIndexMatchesScan(block_content)
+        items.reverse()
+        items.remove(Button("↓"))
+        self.assertIndexMatchesScan(block_content)
+        block_content.block_items = BlockContent.from_string("{{↓}} [[Page]]")
+        self.assertIndexMatchesScan(block_content)
+        self.assertRaises(ValueError, block_content.remove, Button("↑"))
+
+
+class TestIdentity(unittest.TestCase):
+    def test_equal_items_hash_equal(self):
+        strings = ["[[a [[b]]]]", "#[[a [[b]]]]", "#tag", "{{↑}}", "{{btn: text}}", "((abcdefghi))", 
+                   "{{[[TODO]]}}", "attr::", "[alias]([[dest]])", "![alt](src)", "```code```"]
+        for string in strings:
+            a, b = BlockContent.from_string(string)[0], BlockContent.from_string(string)[0]
+            self.assertEqual(a, b)
+            self.assertEqual(hash(a), hash(b))
+            self.assertEqual(len({a, b}), 1)
+        self.assertNotEqual(PageRef("a"), PageTag("a"))
+        self.assertNotEqual(BlockContent.from_string("[alias]([[x]])")[0], BlockContent.from_string("[alias]([[y]])")[0])
+        self.assertEqual(KeyValue("feed", "ToReview"), KeyValue("feed", "ToReview"))
+        self.assertEqual(len({String(" "), String(" ")}), 1)
+
+    def test_mutation_invalidates_identity(self):
+        button = Button("↑")
+        self.assertEqual(button, Button("↑"))
+        button.name = "↓"
+        self.assertEqual(button, Button("↓"))
+        self.assertEqual(hash(button), hash(Button("↓")))
+        kv = KeyValue("interval", 2)
+        self.assertEqual(kv, KeyValue("interval", 2))
+        kv.value = 3
+        self.assertEqual(kv, KeyValue("interval", 3))
+        tag = PageTag("old")
+        self.assertEqual(tag.title, "old")
+        tag._title = PageRef.parse_title("new")
+        self.assertEqual(tag.title, "new")
+
+    def test_slots(self):
+        for item in BlockContent.from_string("[[a]] #b #[[c [[d]]]] {{↑}} ((abcdefghi)) text"):
+            self.assertFalse(hasattr(item, "__dict__"), type(item).__name__)
+        ref = PageRef("plain")
+        self.assertEqual(ref.to_string(), "[[plain]]")
+        self.assertEqual(ref._title, BlockContent([String("plain")]))
+        self.assertEqual(ref, PageRef("plain"))
+        self.assertEqual(PageRef("a [[b]]")._title[1], PageRef("b"))
+
+
+class TestDueIndex(unittest.TestCase):
+    def test_due(self):
+        from due_index import DueIndex, process_response
+        orbiter = "Block #[[Roam Orbiter]] {{↑}} {{↓}} #[[feed: %s]] #[[schedule: ExpVarFactor]] "\
+                  "#[[interval: 2]] #[[due: 2020-08-%02d]] #[[↑_count: 0]] #[[↓_count: 0]]"
+        blocks = [("Page", f"uid{i}", orbiter % (["ToReview", "ToThink"][i%2], i+1)) for i in range(20)]
+        blocks += [("Page", "other", "Not an orbiter [[due]]"), ("Page", "think", "[[To-Think]] #[[due: 2020-08-01]]")]
+        with DueIndex() as index:
+            index.build(blocks)
+            self.assertEqual(len(index), 21)
+            due = index.due("2020-08-05", feed="ToReview")
+            self.assertEqual([e["uid"] for e in due], ["uid0", "uid2", "uid4"])
+            self.assertEqual(due[0]["counters"], {"↑_count": 0, "↓_count": 0})
+            self.assertEqual([e["uid"] for e in index.due(dt.datetime(2020, 8, 1))], ["think", "uid0"])
+
+            process_response(index, "uid0", blocks[0][2], 0)
+            entry = index.get("uid0")
+            self.assertEqual((entry["page"], entry["counters"]["↑_count"]), ("Page", 1))
+            self.assertGreater(entry["due"], "2020-08-05")
+            index.update("uid2", "Not an orbiter any more")
+            self.assertEqual([e["uid"] for e in index.due("2020-08-05", feed="ToReview")], ["uid4"])
+
+    def test_sync(self):
+        from due_index import DueIndex
+        blocks = [("Page", f"uid{i}", f"Block {i} #[[due: 2020-08-{i+1:02d}]]") for i in range(10)]
+        changed = [("Page", "uid0", "Block 0 #[[due: 2020-09-01]]"), ("Other page", "uid1", blocks[1][2])]
+        changed += blocks[2:9] + [("Page", "new", "New #[[due: 2020-07-01]]")]
+        with DueIndex() as index, DueIndex() as rebuilt:
+            self.assertEqual(index.sync(blocks), {"parsed": 10, "unchanged": 0, "removed": 0})
+            self.assertEqual(index.sync(changed), {"parsed": 2, "unchanged": 8, "removed": 1})
+            rebuilt.build(changed)
+            self.assertEqual([dict(r) for r in index.connection.execute("SELECT * FROM blocks ORDER BY uid")],
+                             [dict(r) for r in rebuilt.connection.execute("SELECT * FROM blocks ORDER BY uid")])
+            self.assertEqual(index.get("uid1")["page"], "Other page")
+
+
+class TestSimulator(unittest.TestCase):
+    def setUp(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy isn't installed")
+
+    def test_simulate(self):
+        from simulator import simulate
+        kwargs = {"days": 100, "cards": 1000, "new_per_day": 10, "seed": 1}
+        result = simulate(ExpVarFactor(), [0.5, 0.5], **kwargs)
+        self.assertEqual(result["reviews"].tolist(), simulate(ExpVarFactor(), [0.5, 0.5], **kwargs)["reviews"].tolist())
+        self.assertEqual(result["reviews"].shape, (100,))
+        self.assertFalse(result["backlog"].any())
+        limited = simulate(ExpVarFactor(), [0.5, 0.5], max_reviews_per_day=20, **kwargs)
+        self.assertLessEqual(limited["reviews"].max(), 20)
+        self.assertGreater(limited["backlog"][-1], 0)
+
+
+class TestScheduleHandlers(unittest.TestCase):
+    def test_schedule_many(self):
+        import schedule_handlers
+        if schedule_handlers.np is None:
+            self.skipTest("numpy isn't installed")
+        np = schedule_handlers.np
+        rng = np.random.default_rng(0)
+        intervals, factors = np.array([0., 8., 8.]), np.array([[2., 3.]]*3)
+        responses, dues = np.array([0, 0, 1]), np.array([5., 5., 5.])
+        next_intervals, next_dues = ExpVarFactor().schedule_many(intervals, factors, dues, responses, 10, rng)
+        self.assertEqual(next_intervals[0], 1)
+        self.assertTrue(14 <= next_intervals[1] <= 18 and 21 <= next_intervals[2] <= 27)
+        self.assertEqual(list(next_dues), list(10 + next_intervals))
+        next_intervals, _ = ExpReset().schedule_many(intervals, factors[:,:1], dues, responses, 10, rng)
+        self.assertEqual(list(next_intervals[:2]), [0, 8])
+        self.assertEqual(list(Periodically(7).schedule_many(intervals, factors[:,:0], dues, responses, 10, rng)[1]), 
+                         [5, 13, 13])
+
+    def test_schedule_many_without_numpy(self):
+        import random
+        import schedulers
+        import schedule_handlers
+        from unittest import mock
+        with mock.patch.object(schedule_handlers, "np", None):
+            intervals, dues = ExpVarFactor().schedule_many([0, 8, 8], [[2, 3]]*3, [5, 5, 5], [0, 0, 1], 10)
+            self.assertEqual(type(intervals), list)
+            self.assertEqual(intervals[0], 1)
+            self.assertTrue(14 <= intervals[1] <= 18 and 21 <= intervals[2] <= 27)
+            self.assertEqual(dues, [10 + i for i in intervals])
+            self.assertEqual(ExpReset().schedule_many([8], [[2]], [5], [0], 10)[0], [8])
+            self.assertRaises(ValueError, ExpVarFactor().schedule_many, [8], [[2, 3]], [5], [2], 10)
+            next_intervals = schedulers.sm2_many([0, 8, 8], 2, first_interval=3, rng=random.Random(0))
+            self.assertEqual(next_intervals[0], 3)
+            self.assertTrue(all(n in (14, 16, 18, 20) for n in next_intervals[1:]))
+
+    def test_hash_noise(self):
+        import schedule_handlers
+        from unittest import mock
+        uids, counts = [f"uid{i}" for i in range(20)], [i%3 for i in range(20)]
+        handler = ExpVarFactor(rng=schedule_handlers.HashNoise(["uid0"], [0]))
+        intervals = [handler.get_next_interval(8, 2, schedule_handlers.HashNoise([uid], [count], seed=1)) 
+                     for uid, count in zip(uids, counts)]
+        # Same noise whatever the order or the split of the blocks
+        reordered = [handler.get_next_interval(8, 2, schedule_handlers.HashNoise([uid], [count], seed=1)) 
+                     for uid, count in reversed(list(zip(uids, counts)))]
+        self.assertEqual(intervals, reordered[::-1])
+        self.assertEqual(handler.get_next_interval(8, 2), handler.get_next_interval(8, 2, 
+                         schedule_handlers.HashNoise(["uid0"], [0])))
+        self.assertGreater(len(set(intervals)), 1)
+        args = ([8]*20, [[2, 3]]*20, [0]*20, [0]*20, 0)
+        with mock.patch.object(schedule_handlers, "np", None):
+            self.assertEqual(list(handler.schedule_many(*args, schedule_handlers.HashNoise(uids, counts, seed=1))[0]), 
+                             intervals)
+        if schedule_handlers.np is not None:
+            self.assertEqual(list(handler.schedule_many(*args, schedule_handlers.HashNoise(uids, counts, seed=1))[0]), 
+                             intervals)
+
+    def test_sm2_many(self):
+        import schedulers
+        np = schedulers.load_numpy()
+        if np is None:
+            self.skipTest("numpy isn't installed")
+        next_intervals = schedulers.sm2_many([0] + [8]*100, [2]*101, first_interval=3, 
+                                             rng=np.random.default_rng(0))
+        self.assertEqual(next_intervals[0], 3)
+        self.assertEqual(set(next_intervals[1:]), {14, 16, 18, 20})
+
+
+class TestLoadHistogram(unittest.TestCase):
+    def test_least_loaded(self):
+        from load_histogram import LoadHistogram
+        start = dt.date(2020, 8, 1).toordinal()
+        load = LoadHistogram.from_dues(["2020-08-01", "2020-08-03", "2020-08-03"], start=start)
+        self.assertEqual((load.count("2020-08-03"), load.count(start + 1), len(load)), (2, 0, 3))
+        for day in range(start, start + 10):
+            load.add(day, 2)
+        load.remove(start + 6, 2)
+        load.remove(start + 8)
+        self.assertEqual(load.least_loaded(start, start + 9, start + 9), start + 6)
+        load.remove(start + 2, 4)
+        # Closest to the target among the least loaded
+        self.assertEqual(load.least_loaded(start, start + 9, start + 3), start + 2)
+        self.assertEqual(load.least_loaded(start, start + 9, start + 5), start + 6)
+        # Days outside the range have no blocks and grow it
+        self.assertEqual(load.least_loaded(start + 5000, start + 5010, start + 5004), start + 5004)
+        load.add(start - 100)
+        self.assertEqual((load.count(start - 100), load.count(start + 1), len(load)), (1, 2, 17))
+        self.assertRaises(ValueError, load.remove, start + 3000)
+
+    def test_balanced_schedule(self):
+        from load_histogram import LoadHistogram
+        today = dt.date.today()
+        load = LoadHistogram.from_counts({today.toordinal() + day: 10 for day in range(1, 60)})
+        load.remove(today.toordinal() + 26, 5)
+        handler = ExpVarFactor(load=load)
+        self.assertEqual(handler.get_balanced_interval(8, 3), 26)
+        self.assertEqual(handler.get_balanced_interval(0, 3), 1)
+        self.assertEqual(ExpVarFactor().get_balanced_interval(8, 3, rng=HashNoise(["uid"], [1])),
+                         ExpVarFactor().get_next_interval(8, 3, rng=HashNoise(["uid"], [1])))
+
+        string = "Block #[[Roam Orbiter]] {{↑}} {{↓}} #[[feed: ToReview]] #[[schedule: ExpVarFactor]] "\
+                 f"#[[interval: 8]] #[[due: {today + dt.timedelta(days=3)}]]"
+        manager = RoamOrbiterManager.from_string(string)
+        manager.schedule_handler.load = load
+        manager.process_response(1)
+        self.assertEqual(manager.block_content.get_kv("interval").value, 26)
+        self.assertEqual((load.count(today + dt.timedelta(days=3)), load.count(today + dt.timedelta(days=26))), 
+                         (9, 6))
+
+    def test_due_index(self):
+        from due_index import DueIndex, process_response
+        today = dt.date.today()
+        orbiter = "Block #[[Roam Orbiter]] {{↑}} {{↓}} #[[feed: ToReview]] #[[schedule: ExpVarFactor]] "\
+                  "#[[interval: 8]] #[[due: %s]] #[[↑_count: 0]] #[[↓_count: 0]]"
+        blocks = [("Page", f"uid{i}", orbiter % (today + dt.timedelta(days=i%20 + 1))) for i in range(100)]
+        with DueIndex() as index:
+            index.build(blocks)
+            load = index.load_histogram(feed="ToReview")
+            self.assertEqual(load.count(today + dt.timedelta(days=1)), 5)
+            self.assertEqual(len(index.load_histogram(feed="ToThink")), 0)
+            process_response(index, "uid0", blocks[0][2], 0, load=load)
+            due = index.get("uid0")["due"]
+            self.assertEqual((load.count(today + dt.timedelta(days=1)), load.count(due), len(load)), (4, 6, 100))
+
+
+class TestReviewQueue(unittest.TestCase):
+    def test_queue(self):
+        from review_queue import ReviewQueue
+        from due_index import DueIndex
+        today = dt.date(2020, 8, 10)
+        orbiter = "Block %d #[[Roam Orbiter]] #[[feed: %s]] #[[interval: 4]] #[[due: %s]] #[[total_count: %d]]"
+        blocks = [("Page", f"uid{i}", orbiter % (i, ["ToReview", "ToThink"][i%2], today - dt.timedelta(days=i%4 - 1), i%3))
+                  for i in range(40)]
+        queue = ReviewQueue.from_blocks(blocks, today=today)
+        ordered = sorted([b for b in queue], key=lambda b: (b["due"], b["feed"]!="ToReview", b["total_count"], b["uid"]))
+        self.assertEqual(len(queue), 30)
+        self.assertEqual(list(queue), ordered)
+        self.assertEqual(queue.page(1, size=7), ordered[7:14])
+        self.assertEqual(queue.page(5, size=7), [])
+        self.assertEqual(queue.next()["uid"], "uid15")
+        # An invalid response leaves the queue as it was
+        self.assertRaises(IndexError, queue.respond, 5)
+        self.assertEqual((len(queue), list(queue)), (30, ordered))
+
+        queue.respond(0)
+        self.assertEqual((len(queue), queue.next()), (29, ordered[1]))
+        self.assertEqual(list(queue), ordered[1:])
+        with DueIndex() as index:
+            index.build(blocks)
+            queue = ReviewQueue.from_index(index, dict((uid, string) for _, uid, string in blocks), today, "ToThink")
+            self.assertEqual(list(queue), [b for b in ordered if b["feed"]=="ToThink"])
+            string = queue.respond(1)
+            self.assertEqual(index.get("uid15")["counters"]["none_count"], 1)
+            self.assertIn("#[[none_count: 1]]", string)
+
+    def test_still_due(self):
+        from review_queue import ReviewQueue
+        # ExpReset leaves the interval the same for response 0, so an interval
+        # of 0 stays due
+        string = "Think #[[Roam Orbiter]] #[[feed: ToThink]] #[[interval: 0]] #[[due: 2020-08-01]]"
+        queue = ReviewQueue.from_blocks([("Page", "uid", string)])
+        queue.respond(0)
+        self.assertEqual((len(queue), queue.next()["total_count"]), (1, 1))
+        queue.respond(1)
+        self.assertEqual((len(queue), queue.next()), (0, None))
+        self.assertRaises(IndexError, queue.respond, 0)
+
+
+class TestStartup(unittest.TestCase):
+    def test_lazy_imports(self):
+        import sys
+        import subprocess
+        check = "import sys, roam_orbit; print(sorted(m for m in ['numpy', 'logging'] if m in sys.modules))"
+        output = subprocess.run([sys.executable, "-c", check], check=True, capture_output=True, text=True).stdout
+        self.assertEqual(output.strip(), "[]")
+
+    def test_handler_manifest(self):
+        import roam_orbit
+        self.assertEqual(roam_orbit.roam_orbit_keys, ["feed", "schedule", "interval", "due", "factor",
+            "factor_short", "factor_long", "feedback", "↑_count", "↓_count", "total_count", "thoughts_count",
+            "none_count", "thought-provoking_count", "not_count"])
+        self.assertEqual(roam_orbit.roam_orbit_btns, [Button(r) for r in
+                         ["↑", "↓", "thoughts", "none", "thought-provoking", "not"]])
+        self.assertEqual(ExpVarFactor().keys, ExpVarFactor.keys)
+        self.assertEqual(Vote().keys, Vote.keys)
+        self.assertEqual(FeedbackHandler(["a"]).keys, ["feedback", "a_count", "total_count"])
+
+
+class TestHandlerRegistry(unittest.TestCase):
+    def test_registry(self):
+        import os
+        import sys
+        import tempfile
+        import handler_registry
+        from unittest import mock
+        entry_points = {"feed": {"CustomFeed": "custom_handlers:CustomFeed"}, "schedule": {},
+                        "feedback": {"CustomFeedback": "custom_handlers:CustomFeedback"}}
+        class Local:
+            keys = ["feed"]
+            version = 1
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "custom_handlers.py"), "w") as f:
+                f.write("class CustomFeed:\n    keys = ['feed', 'mood']\n"\
+                        "class CustomFeedback:\n    keys = ['feedback', 'yes_count']\n    responses = ['yes']\n")
+            sys.path.insert(0, directory)
+            def make_registry():
+                registry = handler_registry.HandlerRegistry(os.path.join(directory, "cache", "manifest.json"))
+                registry.register("feed")(Local)
+                registry.register("feedback")(Vote)
+                return registry
+            try:
+                with mock.patch.object(handler_registry, "find_entry_points", return_value=entry_points) as find:
+                    manifest = make_registry().manifest()
+                    self.assertEqual(manifest["keys"], ["feed", "mood", "feedback", "↑_count", "↓_count",
+                                                        "total_count", "yes_count"])
+                    self.assertEqual(manifest["responses"], ["↑", "↓", "yes"])
+                    # The manifest is cached until a registered handler changes
+                    registry = make_registry()
+                    self.assertEqual(registry.manifest()["keys"], manifest["keys"])
+                    self.assertEqual(find.call_count, 1)
+                    self.assertEqual(registry.handlers["feed"]["CustomFeed"].keys, ["feed", "mood"])
+                    self.assertRaises(KeyError, registry.handlers["feed"].__getitem__, "Missing")
+                    Local.version = 2
+                    make_registry().manifest()
+                    self.assertEqual(find.call_count, 2)
+                    # And until the module of an external handler changes, eg: in an editable install
+                    path = os.path.join(directory, "custom_handlers.py")
+                    self.assertEqual(make_registry().manifest()["external"][0][-1], [path])
+                    stat = os.stat(path)
+                    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns+10**9))
+                    make_registry().manifest()
+                    self.assertEqual(find.call_count, 3)
+                    make_registry().manifest()
+                    self.assertEqual(find.call_count, 3)
+                    # Functions of the manifest are cached until it changes
+                    registry = make_registry()
+                    keys = registry.cached(lambda: list(registry.manifest()["keys"]))
+                    self.assertIs(keys(), keys())
+                    registry.register("feed")(type("Other", (), {"keys": ["other"]}))
+                    self.assertIn("other", keys())
+            finally:
+                sys.path.remove(directory)
+                sys.modules.pop("custom_handlers", None)
+
+
+class TestAsyncOrbiter(unittest.TestCase):
+    text = "Some thing I want to review later"
+
+    def test_merge_responses(self):
+        import asyncio
+        import async_orbit
+        from due_index import content_hash
+        from unittest import mock
+        calls = []
+        def counted(func):
+            def wrapper(*args):
+                calls.append(func.__name__)
+                return func(*args)
+            return wrapper
+        async def clicks(orbiter):
+            text = await orbiter.main(self.text, "init", "ToReview", uid="uid1")
+            # Clicks on the same block at once are merged into one parse, in order
+            results = await asyncio.gather(*[orbiter.process_response(text, r, uid="uid1") for r in (0, 1, 0)],
+                                           orbiter.process_response(text, 0, uid="uid2"))
+            # A click on the string from before those clicks is applied on top of them
+            stale = await orbiter.process_response(text, 1, uid="uid1", text_hash=content_hash(text).hex())
+            return text, results, stale
+        orbiter = async_orbit.AsyncOrbiter()
+        with mock.patch.object(async_orbit, "main", counted(main)), \
+                mock.patch.object(async_orbit, "process_responses", counted(process_responses)):
+            text, results, stale = asyncio.run(clicks(orbiter))
+        self.assertEqual(calls, ["main"] + ["process_responses"]*3)
+        merged = process_responses(text, [0, 1, 0], "uid1")
+        self.assertEqual(merged, main(main(main(text, "add_response", 0, "uid1"), "add_response", 1, "uid1"),
+                                      "add_response", 0, "uid1"))
+        self.assertEqual(results, [merged]*3 + [main(text, "add_response", 0, "uid2")])
+        self.assertEqual(stale, main(merged, "add_response", 1, "uid1"))
+        self.assertEqual(orbiter.stale_writes, 1)
+        self.assertEqual(orbiter.latest_version("uid1", text), stale)
+        self.assertEqual(orbiter.latest_version("uid2", self.text), self.text)
+
+    def test_errors_and_concurrency(self):
+        import time
+        import asyncio
+        import threading
+        import async_orbit
+        from unittest import mock
+        from concurrent.futures import ThreadPoolExecutor
+        running, most = [0], [0]
+        lock = threading.Lock()
+        def slow_main(*args):
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return main(*args)
+        async def clicks(orbiter):
+            return await asyncio.gather(*[orbiter.main(self.text, "init", None, uid=f"uid{i}") for i in range(8)],
+                                        orbiter.process_record('{"text": "x", "action": "fly", "uid": "other"}'),
+                                        orbiter.process_record("not json"),
+                                        orbiter.process_record('{"text": "x", "action": "update", "hash": "0"}'))
+        with ThreadPoolExecutor(8) as executor, mock.patch.object(async_orbit, "main", slow_main):
+            results = asyncio.run(clicks(async_orbit.AsyncOrbiter(executor, max_concurrency=2)))
+        self.assertEqual(most[0], 2)
+        self.assertEqual(results[1], main(self.text, "init", None))
+        self.assertEqual(results[8], {"text": None, "error": "ValueError: 'fly' isn't a supported action"})
+        self.assertTrue(results[9]["error"].startswith("JSONDecodeError"))
+        self.assertEqual(results[10]["error"], "ValueError: the hash doesn't match the block string")
+
+    def test_invalid_response(self):
+        import asyncio
+        import async_orbit
+        async def clicks(orbiter):
+            text = await orbiter.main(self.text, "init", "ToReview", uid="uid1")
+            results = await asyncio.gather(*[orbiter.process_response(text, r, uid="uid1") for r in (0, 7, 1)],
+                                           return_exceptions=True)
+            return text, results
+        orbiter = async_orbit.AsyncOrbiter()
+        text, results = asyncio.run(clicks(orbiter))
+        # Only the invalid response fails, the ones merged with it are still applied
+        merged = process_responses(text, [0, 1], "uid1")
+        self.assertEqual(results[0], merged)
+        self.assertIsInstance(results[1], IndexError)
+        self.assertEqual(results[2], merged)
+        self.assertEqual(orbiter.latest_version("uid1", text), merged)
+
+    def test_max_pending(self):
+        import asyncio
+        import async_orbit
+        from unittest import mock
+        most = [0]
+        def measured_main(*args):
+            most[0] = max(most[0], sum(map(len, orbiter._waiting.values())) + len(orbiter._tasks))
+            return main(*args)
+        async def clicks():
+            clicks = [orbiter.main(self.text, "init", None, uid=f"uid{i % 50}") for i in range(200)]
+            clicks[0] = asyncio.wait_for(clicks[0], 0)
+            return await asyncio.gather(*clicks, return_exceptions=True)
+        orbiter = async_orbit.AsyncOrbiter(max_pending=10)
+        with mock.patch.object(async_orbit, "main", measured_main):
+            results = asyncio.run(clicks())
+        # Waiting updates and the blocks being processed, at most one update each
+        self.assertLessEqual(most[0], 20)
+        self.assertIsInstance(results[0], asyncio.TimeoutError)
+        self.assertEqual(results[1:], [main(self.text, "init", None)]*199)
+        self.assertEqual((orbiter._waiting, orbiter._tasks), ({}, {}))
+
 
 if __name__=="__main__":
     #unittest.main()